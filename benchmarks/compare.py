@@ -0,0 +1,43 @@
+"""Compares two result files written by ``benchmarks.run``::
+
+    $ python -m benchmarks.compare before.json after.json
+
+Prints the jobs/sec of every benchmark found in both files and the change
+between them, plus the p95 latency of the end-to-end ones.
+
+"""
+import json
+import sys
+from optparse import OptionParser
+
+from benchmarks.run import _describe
+
+
+def _load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, dict((_describe(r), r) for r in report['results'])
+
+
+def main(argv=None):
+    parser = OptionParser(usage="usage: %prog [options] before.json after.json")
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("Please give two result files.")
+    before_report, before = _load(args[0])
+    after_report, after = _load(args[1])
+    sys.stdout.write('before: %s\nafter:  %s\n\n' % (before_report.get('commit'),
+                                                    after_report.get('commit')))
+    for key in sorted(set(before) & set(after)):
+        old = before[key]['jobs_per_second'] or 0
+        new = after[key]['jobs_per_second'] or 0
+        change = (new - old) / old * 100 if old else 0
+        line = '%-60s %10.0f -> %10.0f jobs/s %+7.1f%%' % (key, old, new, change)
+        if 'latency_ms' in before[key] and 'latency_ms' in after[key]:
+            line += '  p95 %.1f -> %.1f ms' % (before[key]['latency_ms']['p95'],
+                                               after[key]['latency_ms']['p95'])
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""Job classes used by the benchmarks. They live in their own module so
+forked workers and minions can import them by name."""
+import time
+
+from pyres import json_parser as json
+
+DONE_KEY = 'bench:done'
+
+
+class BenchJob(object):
+    """Sleeps ``duration_ms`` milliseconds, then records when it was
+    enqueued and when it finished in ``bench:done``."""
+    queue = 'bench'
+
+    @classmethod
+    def perform(cls, enqueued_at, duration_ms, blob):
+        if duration_ms:
+            time.sleep(duration_ms / 1000.0)
+        cls.resq.redis.rpush(DONE_KEY, json.dumps([enqueued_at, time.time()]))
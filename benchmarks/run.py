@@ -0,0 +1,268 @@
+"""Benchmarks for enqueueing, reserving and processing jobs.
+
+Run from the repository root against a local redis-server::
+
+    $ python -m benchmarks.run --db 15 -o before.json
+    $ git checkout my-branch
+    $ python -m benchmarks.run --db 15 -o after.json
+    $ python -m benchmarks.compare before.json after.json
+
+The benchmarks are:
+
+    ``enqueue`` -- ``ResQ.enqueue`` one job at a time, and ``enqueue_many``.
+
+    ``reserve`` -- ``Job.reserve`` one job at a time, and ``reserve_batch``,
+    from a prefilled queue.
+
+    ``worker`` -- end-to-end jobs/sec and per-job latency (from enqueue to
+    the end of ``perform``) of forking ``Worker`` processes.
+
+    ``khan`` -- the same for a ``Khan`` managing ``Minion`` processes.
+
+each for every combination of ``--payload-sizes`` and, for the end-to-end
+ones, ``--durations`` and ``--concurrency``. Results are written as JSON,
+together with the commit, python and redis versions they were taken with.
+
+The database given with ``--db`` must be empty, as the benchmarks use the
+regular ``resque:*`` keys; pass ``--flush`` to empty it first.
+
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import signal
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+from pyres import ResQ
+from pyres.horde import Khan
+from pyres.job import Job
+from pyres.worker import Worker
+
+from benchmarks.jobs import BenchJob, DONE_KEY
+
+CLASS_NAME = 'benchmarks.jobs.BenchJob'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def _args(size, duration_ms=0):
+    return [time.time(), duration_ms, 'x' * size]
+
+
+def _prefill(resq, count, size, duration_ms=0):
+    resq.enqueue_many_from_string(CLASS_NAME, BenchJob.queue,
+                                  [_args(size, duration_ms) for i in range(count)])
+
+
+def _reset(resq):
+    resq.redis.flushdb()
+
+
+def bench_enqueue(resq, jobs, size):
+    results = []
+    _reset(resq)
+    start = time.time()
+    for i in range(jobs):
+        resq.enqueue(BenchJob, *_args(size))
+    elapsed = time.time() - start
+    results.append(_result('enqueue', jobs, elapsed, payload_size=size))
+
+    _reset(resq)
+    start = time.time()
+    resq.enqueue_many(BenchJob, [_args(size) for i in range(jobs)])
+    elapsed = time.time() - start
+    results.append(_result('enqueue_many', jobs, elapsed, payload_size=size))
+    return results
+
+
+def bench_reserve(resq, jobs, size, batch=100):
+    results = []
+    _reset(resq)
+    _prefill(resq, jobs, size)
+    start = end = time.time()
+    reserved = 0
+    # the last, empty reserve blocks for its timeout, so stop the clock at
+    # the last job
+    while Job.reserve(BenchJob.queue, resq, timeout=1):
+        reserved += 1
+        end = time.time()
+    elapsed = end - start
+    results.append(_result('reserve', reserved, elapsed, payload_size=size))
+
+    _reset(resq)
+    _prefill(resq, jobs, size)
+    start = end = time.time()
+    reserved = 0
+    while True:
+        batch_jobs = Job.reserve_batch(BenchJob.queue, resq, batch, timeout=1)
+        if not batch_jobs:
+            break
+        reserved += len(batch_jobs)
+        end = time.time()
+    elapsed = end - start
+    results.append(_result('reserve_batch', reserved, elapsed, payload_size=size,
+                           batch=batch))
+    return results
+
+
+def _run_worker(server):
+    Worker.run([BenchJob.queue], server, interval=1)
+
+
+def _run_khan(server, pool_size):
+    Khan.run(pool_size=pool_size, queues=[BenchJob.queue], server=server,
+             interval=0.1, minions_interval=0.1, logging_level=logging.ERROR)
+
+
+def _wait_done(resq, jobs, timeout):
+    deadline = time.time() + timeout
+    while resq.redis.llen(DONE_KEY) < jobs:
+        if time.time() > deadline:
+            raise RuntimeError('only %d of %d jobs finished in %ss' %
+                               (resq.redis.llen(DONE_KEY), jobs, timeout))
+        time.sleep(0.01)
+
+
+def bench_end_to_end(resq, name, jobs, size, duration_ms, concurrency, timeout):
+    _reset(resq)
+    if name == 'worker':
+        processes = [multiprocessing.Process(target=_run_worker, args=(resq.dsn,))
+                     for i in range(concurrency)]
+        stop_signal = signal.SIGQUIT
+    else:
+        processes = [multiprocessing.Process(target=_run_khan,
+                                             args=(resq.dsn, concurrency))]
+        stop_signal = signal.SIGINT
+    for process in processes:
+        process.start()
+    try:
+        # let the workers start up and block on the empty queue
+        time.sleep(1)
+        start = time.time()
+        for i in range(jobs):
+            resq.enqueue(BenchJob, *_args(size, duration_ms))
+        _wait_done(resq, jobs, timeout)
+    finally:
+        for process in processes:
+            os.kill(process.pid, stop_signal)
+        for process in processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+    done = [json.loads(item) for item in resq.redis.lrange(DONE_KEY, 0, -1)]
+    elapsed = max(finished for enqueued, finished in done) - start
+    latencies = [(finished - enqueued) * 1000.0 for enqueued, finished in done]
+    return [_result(name, jobs, elapsed, payload_size=size, duration_ms=duration_ms,
+                    concurrency=concurrency,
+                    latency_ms=dict(('p%d' % p, percentile(latencies, p))
+                                    for p in (50, 95, 99)))]
+
+
+PARAMS = ('payload_size', 'duration_ms', 'concurrency', 'batch')
+
+
+def _describe(result):
+    """Identifies a result across runs, e.g. ``worker payload_size=1024
+    duration_ms=0 concurrency=4``."""
+    return ' '.join([result['benchmark']] +
+                    ['%s=%s' % (p, result[p]) for p in PARAMS if p in result])
+
+
+def _result(name, jobs, elapsed, **params):
+    result = {'benchmark': name, 'jobs': jobs, 'seconds': elapsed,
+              'jobs_per_second': jobs / elapsed if elapsed else None}
+    result.update(params)
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _redis_version(resq):
+    try:
+        return resq.redis.info().get('redis_version')
+    except Exception:
+        # e.g. INFO disabled on a managed server
+        return None
+
+
+def _ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main(argv=None):
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--host", dest="host", default="localhost")
+    parser.add_option("--port", dest="port", type="int", default=6379)
+    parser.add_option("--db", dest="db", type="int", default=15, help='redis database to run in. Defaults to 15.')
+    parser.add_option("--flush", action="store_true", dest="flush", default=False, help='empty the database before running.')
+    parser.add_option("-n", "--jobs", dest="jobs", type="int", default=10000, help='jobs per enqueue/reserve run. Defaults to 10000.')
+    parser.add_option("--e2e-jobs", dest="e2e_jobs", type="int", default=1000, help='jobs per end-to-end run. Defaults to 1000.')
+    parser.add_option("--payload-sizes", dest="payload_sizes", default="0,1024,65536", help='comma separated argument sizes in bytes.')
+    parser.add_option("--durations", dest="durations", default="0,10", help='comma separated job durations in milliseconds.')
+    parser.add_option("--concurrency", dest="concurrency", default="1,4", help='comma separated numbers of workers / minions.')
+    parser.add_option("--only", dest="only", default="enqueue,reserve,worker,khan", help='comma separated benchmarks to run.')
+    parser.add_option("--timeout", dest="timeout", type="float", default=300, help='seconds to wait for an end-to-end run.')
+    parser.add_option("-o", "--output", dest="output", default=None, help='file to write the JSON results to. Defaults to stdout.')
+    (options, args) = parser.parse_args(argv)
+
+    resq = ResQ(server='%s:%s/%s' % (options.host, options.port, options.db))
+    if resq.redis.dbsize() and not options.flush:
+        parser.error("database %d is not empty, pass --flush to empty it" % options.db)
+
+    only = options.only.split(',')
+    results = []
+
+    def collect(new):
+        for result in new:
+            sys.stderr.write('%s: %.0f jobs/s\n' % (_describe(result),
+                                                     result['jobs_per_second'] or 0))
+        results.extend(new)
+
+    for size in _ints(options.payload_sizes):
+        if 'enqueue' in only:
+            collect(bench_enqueue(resq, options.jobs, size))
+        if 'reserve' in only:
+            collect(bench_reserve(resq, options.jobs, size))
+        for name in ('worker', 'khan'):
+            if name not in only:
+                continue
+            for duration in _ints(options.durations):
+                for concurrency in _ints(options.concurrency):
+                    collect(bench_end_to_end(resq, name, options.e2e_jobs, size,
+                                             duration, concurrency, options.timeout))
+    _reset(resq)
+
+    report = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'redis': _redis_version(resq),
+        'timestamp': time.time(),
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,18 @@ __version__ = '1.5'
 from redis import Redis
 from pyres.compat import string_types
 import pyres.json_parser as json
+from pyres import compression, metrics as _metrics, serializers
+import pyres.payload_store as claim_check
 
 import os
 import time, datetime
 import sys
 import logging
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -84,8 +91,54 @@ def my_import(name):
         mod = getattr(mod, comp)
     return mod
 
+#: number of resolved classes ``safe_str_to_class`` keeps
+CLASS_CACHE_SIZE = 256
+
+_class_cache = OrderedDict()
+_class_cache_lock = threading.Lock()
+
 def safe_str_to_class(s):
-    """Helper function to map string class names to module classes."""
+    """Helper function to map string class names to module classes.
+
+    Resolved classes are cached, least recently used first out once there
+    are more than ``CLASS_CACHE_SIZE``; call ``clear_class_cache`` after
+    reloading job modules.
+
+    """
+    with _class_cache_lock:
+        klass = _class_cache.pop(s, None)
+        if klass is not None:
+            _class_cache[s] = klass
+            return klass
+    klass = _resolve_class(s)
+    with _class_cache_lock:
+        _class_cache[s] = klass
+        while len(_class_cache) > CLASS_CACHE_SIZE:
+            _class_cache.popitem(last=False)
+    return klass
+
+def clear_class_cache(s=None):
+    """Forgets the resolved class ``s``, or every class if ``s`` is None."""
+    with _class_cache_lock:
+        if s is None:
+            _class_cache.clear()
+        else:
+            _class_cache.pop(s, None)
+
+def preload_classes(names):
+    """Imports the job classes named in ``names`` ahead of time, so that
+    processes forked afterwards share the modules and find the classes
+    cached. Returns the names that could not be imported."""
+    failed = []
+    for name in names:
+        try:
+            safe_str_to_class(name)
+        except (ImportError, AttributeError):
+            logger.exception("Could not preload %s", name)
+            failed.append(name)
+    return failed
+
+def _resolve_class(s):
     lst = s.split(".")
     klass = lst[-1]
     mod_list = lst[:-1]
@@ -120,6 +173,233 @@ def str_to_class(s):
     except ImportError:
         return None
 
+#: pubsub channel delayed pushes are announced on when
+#: ``ResQ.delayed_notify`` is set
+DELAYED_CHANNEL = 'resque:delayed_notify'
+
+def _timestamp(dt):
+    """Seconds since the epoch of the local datetime ``dt``, microseconds
+    included."""
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
+
+def _delayed_member(timestamp):
+    """Formats a delayed schedule timestamp the way it is stored: whole
+    seconds as an integer, anything finer to the millisecond."""
+    if isinstance(timestamp, float):
+        return ('%.3f' % timestamp).rstrip('0').rstrip('.')
+    if isinstance(timestamp, bytes):
+        return timestamp.decode()
+    return str(timestamp)
+
+# KEYS: queue lists in priority order. ARGV[1]: max number of items,
+# ARGV[2]: optional in-flight list of the reserving worker.
+# Takes up to ARGV[1] items from the head of the first non-empty queue. When
+# an in-flight list is given, each item is also recorded there (wrapped with
+# its queue name) until the worker acknowledges it.
+_POP_BATCH_SCRIPT = """
+local count = tonumber(ARGV[1])
+local processing = ARGV[2]
+for _, key in ipairs(KEYS) do
+    local items = redis.call('lrange', key, 0, count - 1)
+    if #items > 0 then
+        redis.call('ltrim', key, #items, -1)
+        if not processing or processing == '' then
+            return {key, items}
+        end
+        local queue = string.sub(key, 14)
+        local entries = {}
+        for i, item in ipairs(items) do
+            entries[i] = cjson.encode({queue = queue, payload = item})
+            redis.call('rpush', processing, entries[i])
+        end
+        return {key, items, entries}
+    end
+end
+return false
+"""
+
+# KEYS[1]: in-flight list of a worker, KEYS[2]: its list of items moved as
+# they are, KEYS[3]: the queue those were moved from. Pushes every entry back
+# to the head of its original queue, preserving order, and deletes the lists.
+_REQUEUE_PROCESSING_SCRIPT = """
+local entries = redis.call('lrange', KEYS[1], 0, -1)
+for i = #entries, 1, -1 do
+    local entry = cjson.decode(entries[i])
+    redis.call('lpush', 'resque:queue:' .. entry.queue, entry.payload)
+end
+local moved = redis.call('lrange', KEYS[2], 0, -1)
+local queue = redis.call('get', KEYS[3])
+if queue then
+    for i = #moved, 1, -1 do
+        redis.call('lpush', 'resque:queue:' .. queue, moved[i])
+    end
+end
+redis.call('del', KEYS[1], KEYS[2], KEYS[3])
+return #entries + #moved
+"""
+
+# ARGV[1]: current timestamp, ARGV[2]: enqueue_timestamp to give the jobs,
+# ARGV[3]: max number of items, ARGV[4]: number of shards, ARGV[5]: shard,
+# ARGV[6]: max due timestamps to pass over.
+# Moves up to ARGV[3] items due by ARGV[1] from the delayed lists of the
+# timestamps in the shard (whole seconds modulo ARGV[4]) to their queues.
+# JSON payloads are promoted as they are, with the enqueue_timestamp spliced
+# in. A timestamp whose next item the script cannot promote (compressed,
+# claim-checked or msgpack payloads, or one that already has an
+# enqueue_timestamp) is left as it is from that item on and returned for the
+# client to drain. Due timestamps of other shards, and held ones, are passed
+# over; the call gives up after ARGV[6] of them so that the backlog of a
+# shard whose scheduler is down cannot make every call walk all of it.
+_PROMOTE_DELAYED_SCRIPT = """
+local limit = tonumber(ARGV[3])
+local shards = tonumber(ARGV[4])
+local shard = tonumber(ARGV[5])
+local scan = tonumber(ARGV[6])
+local moved = 0
+local held = {}
+local watched = {}
+-- timestamps of other shards stay in the schedule and are skipped over
+local skipped = 0
+while moved < limit and skipped < scan do
+    local due = redis.call('zrangebyscore', 'resque:delayed_queue_schedule',
+                           '-inf', ARGV[1], 'LIMIT', skipped, limit)
+    if #due == 0 then
+        break
+    end
+    for _, ts in ipairs(due) do
+        if skipped >= scan then
+            break
+        elseif math.floor(tonumber(ts)) % shards ~= shard then
+            skipped = skipped + 1
+        else
+            local key = 'resque:delayed:' .. ts
+            local items = redis.call('lrange', key, 0, limit - moved - 1)
+            local taken = 0
+            for _, item in ipairs(items) do
+                local queue = nil
+                if string.sub(item, 1, 1) == '{' then
+                    local ok, payload = pcall(cjson.decode, item)
+                    if ok and type(payload) == 'table' and type(payload.queue) == 'string'
+                            and payload.enqueue_timestamp == nil then
+                        queue = payload.queue
+                    end
+                end
+                if not queue then
+                    break
+                end
+                -- the payload has a queue key, so it is not empty
+                redis.call('rpush', 'resque:queue:' .. queue,
+                           '{"enqueue_timestamp": ' .. ARGV[2] .. ', ' .. string.sub(item, 2))
+                if not watched[queue] then
+                    redis.call('sadd', 'resque:queues', queue)
+                    watched[queue] = true
+                end
+                taken = taken + 1
+            end
+            moved = moved + taken
+            redis.call('ltrim', key, taken, -1)
+            if taken < #items then
+                held[#held + 1] = ts
+                skipped = skipped + 1
+            elseif redis.call('llen', key) == 0 then
+                redis.call('del', key)
+                redis.call('zrem', 'resque:delayed_queue_schedule', ts)
+            end
+            if moved >= limit then
+                break
+            end
+        end
+    end
+end
+return {moved, held}
+"""
+
+# ARGV[1]: number of shards, ARGV[2]: shard, ARGV[3]: max timestamps to look
+# at. Returns the score of the earliest timestamp in the shard, if any.
+_NEXT_DELAYED_SCRIPT = """
+local shards = tonumber(ARGV[1])
+local shard = tonumber(ARGV[2])
+local scan = tonumber(ARGV[3])
+local offset = 0
+while offset < scan do
+    local page = redis.call('zrange', 'resque:delayed_queue_schedule',
+                            offset, offset + 99, 'WITHSCORES')
+    if #page == 0 then
+        return false
+    end
+    for i = 1, #page, 2 do
+        if math.floor(tonumber(page[i])) % shards == shard then
+            return page[i + 1]
+        end
+    end
+    offset = offset + 100
+end
+return false
+"""
+
+# ARGV[1]: '1' to also count the jobs in every delayed timestamp list.
+# Gathers the figures of ``ResQ.snapshot`` server side in one call.
+_SNAPSHOT_SCRIPT = """
+local queues = redis.call('smembers', 'resque:queues')
+local sizes = {}
+for i, queue in ipairs(queues) do
+    sizes[i] = redis.call('llen', 'resque:queue:' .. queue)
+end
+local timestamps = redis.call('zcard', 'resque:delayed_queue_schedule')
+local delayed = -1
+if ARGV[1] == '1' then
+    delayed = 0
+    for _, ts in ipairs(redis.call('zrange', 'resque:delayed_queue_schedule', 0, -1)) do
+        delayed = delayed + redis.call('llen', 'resque:delayed:' .. ts)
+    end
+end
+return {queues, sizes,
+        redis.call('get', 'resque:stat:processed') or '0',
+        redis.call('get', 'resque:stat:failed') or '0',
+        redis.call('llen', 'resque:failed'),
+        redis.call('scard', 'resque:workers'),
+        redis.call('scard', 'resque:minions'),
+        redis.call('scard', 'resque:khans'),
+        timestamps, delayed}
+"""
+
+
+class Snapshot(object):
+    """A consistent view of the queues, stats and processes at one point
+    in time, as returned by ``ResQ.snapshot``.
+
+        ``queues`` -- dict of queue name to number of pending jobs.
+
+        ``processed``, ``failed`` -- the global stats.
+
+        ``failed_jobs`` -- jobs in the failed queue.
+
+        ``workers``, ``minions``, ``khans`` -- registered processes.
+
+        ``delayed_timestamps`` -- timestamps with delayed jobs.
+
+        ``delayed_jobs`` -- delayed jobs, or None if they were not counted.
+
+    """
+    def __init__(self, queues, processed, failed, failed_jobs, workers,
+                 minions, khans, delayed_timestamps, delayed_jobs=None):
+        self.queues = queues
+        self.processed = processed
+        self.failed = failed
+        self.failed_jobs = failed_jobs
+        self.workers = workers
+        self.minions = minions
+        self.khans = khans
+        self.delayed_timestamps = delayed_timestamps
+        self.delayed_jobs = delayed_jobs
+
+    @property
+    def pending(self):
+        return sum(self.queues.values())
+
+    def __repr__(self):
+        return '<Snapshot %d queues, %d pending>' % (len(self.queues), self.pending)
+
 class ResQ(object):
     """The ResQ class defines the Redis server object to which we will
     enqueue jobs into various queues.
@@ -144,6 +424,30 @@ class ResQ(object):
     attribute on it.
 
     """
+    reliable_poll_interval = 0.1
+    #: name of the ``pyres.serializers`` entry used to encode payloads
+    serializer = serializers.default
+    #: name of the ``pyres.compression`` codec used for large payloads, or
+    #: None to never compress
+    compression = None
+    #: size in bytes from which payloads are compressed
+    compression_threshold = 16 * 1024
+    #: a ``pyres.payload_store`` store to keep large payloads out of the
+    #: queues, or None to always push them inline
+    payload_store = None
+    #: encoded size in bytes from which payloads go to ``payload_store``
+    claim_check_threshold = 256 * 1024
+    #: schedule delayed jobs to the millisecond rather than the second. The
+    #: resulting schedule is not readable by resque-scheduler
+    delayed_precision_ms = False
+    #: announce delayed pushes on ``DELAYED_CHANNEL`` so that a
+    #: ``Scheduler`` with ``notify`` set wakes up for them
+    delayed_notify = False
+    #: set by ``pyres.profiling`` to add the time spent decoding reserved
+    #: payloads to ``last_decode_time``
+    measure_decode = False
+    last_decode_time = 0
+
     def __init__(self, server="localhost:6379", password=None):
         self.password = password
         self.redis = server
@@ -151,19 +455,137 @@ class ResQ(object):
 
     def push(self, queue, item):
         self.watch_queue(queue)
-        self.redis.rpush("resque:queue:%s" % queue, ResQ.encode(item))
+        self.redis.rpush("resque:queue:%s" % queue, self._dump(item))
 
     def pop(self, queues, timeout=10):
         if isinstance(queues, string_types):
             queues = [queues]
+        if not queues:
+            # e.g. no queue matches a worker's queue patterns yet
+            time.sleep(timeout)
+            return None, None
         ret = self.redis.blpop(["resque:queue:%s" % q for q in queues],
                                timeout=timeout)
         if ret:
             key, ret = ret
-            return key[13:].decode(), ResQ.decode(ret)  # trim "resque:queue:"
+            return key[13:].decode(), self._load(ret, delete=True)  # trim "resque:queue:"
         else:
             return None, None
 
+    def pop_batch(self, queues, count, timeout=10):
+        """Atomically take up to ``count`` items from the first non-empty
+        queue in ``queues``, preserving their order. When every queue is
+        empty this blocks for up to ``timeout`` seconds waiting for a single
+        item. Returns a ``(queue, items)`` tuple, or ``(None, [])``.
+
+        """
+        if isinstance(queues, string_types):
+            queues = [queues]
+        keys = ["resque:queue:%s" % q for q in queues]
+        ret = self._script('pop_batch', _POP_BATCH_SCRIPT)(keys=keys, args=[count])
+        if ret:
+            key, items = ret
+            payloads = [self._load(i, delete=True) for i in items]
+            return key[13:].decode(), [p for p in payloads if p is not None]
+        queue, item = self.pop(queues, timeout=timeout)
+        if item is None:
+            return None, []
+        return queue, [item]
+
+    def pop_reliable(self, queues, worker, count=1, timeout=10):
+        """Like ``pop_batch``, but each reserved item is also recorded in the
+        ``resque:processing:<worker>`` list until it is acknowledged with
+        ``ack``, so jobs held by a worker that dies can be recovered with
+        ``requeue_processing``.
+
+        A single job from a single queue is reserved with a blocking BLMOVE
+        into ``resque:processing:<worker>:moved``. Anything else is moved by
+        a Lua script, which cannot block, so empty queues are polled every
+        ``reliable_poll_interval`` seconds until ``timeout`` expires.
+        Returns a ``(queue, [(item, entry), ...])`` tuple, where ``entry`` is
+        the value to pass to ``ack``.
+
+        """
+        if isinstance(queues, string_types):
+            queues = [queues]
+        processing = "resque:processing:%s" % worker
+        if count == 1 and len(queues) == 1:
+            # BLMOVE leaves the item as it is, so the queue it came from is
+            # recorded for requeue_processing
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.set(processing + ':queue', queues[0])
+            pipe.execute_command('BLMOVE', "resque:queue:%s" % queues[0],
+                                 processing + ':moved', 'LEFT', 'RIGHT', timeout)
+            item = pipe.execute()[1]
+            if item is None:
+                return None, []
+            payload = self._load(item)
+            if payload is None:
+                self.ack(worker, item)
+                return None, []
+            return queues[0], [(payload, item)]
+        keys = ["resque:queue:%s" % q for q in queues]
+        deadline = time.time() + timeout
+        while True:
+            ret = self._script('pop_batch', _POP_BATCH_SCRIPT)(
+                keys=keys, args=[count, processing])
+            if ret:
+                key, items, entries = ret
+                reserved = []
+                for item, entry in zip(items, entries):
+                    payload = self._load(item)
+                    if payload is None:
+                        self.ack(worker, entry)
+                    else:
+                        reserved.append((payload, entry))
+                return key[13:].decode(), reserved
+            if timeout and time.time() >= deadline:
+                return None, []
+            time.sleep(self.reliable_poll_interval)
+
+    def ack(self, worker, entry):
+        """Remove a job reserved with ``pop_reliable`` from the worker's
+        in-flight list once it has been processed."""
+        processing = "resque:processing:%s" % worker
+        # LREM's arguments were reordered in redis-py 3, so it is sent raw
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.execute_command('LREM', processing, 1, entry)
+        pipe.execute_command('LREM', processing + ':moved', 1, entry)
+        pipe.execute()
+        if claim_check.is_reference(entry):
+            # moved by BLMOVE as it is
+            claim_check.delete(self, entry)
+            return
+        if not isinstance(entry, string_types):
+            try:
+                entry = entry.decode('utf-8')
+            except UnicodeDecodeError:
+                return
+        if claim_check.REFERENCE_PREFIX in entry:
+            try:
+                payload = json.loads(entry)
+            except ValueError:
+                return
+            if isinstance(payload, dict) and 'payload' in payload:
+                claim_check.delete(self, payload['payload'])
+
+    def requeue_processing(self, worker):
+        """Push every unacknowledged job of ``worker`` back to the head of
+        its queue. Returns the number of jobs requeued."""
+        processing = "resque:processing:%s" % worker
+        return self._script('requeue_processing', _REQUEUE_PROCESSING_SCRIPT)(
+            keys=[processing, processing + ':moved', processing + ':queue'])
+
+    def push_front(self, queue, items):
+        """Put ``items`` back at the head of ``queue`` in their original
+        order, e.g. to hand back prefetched jobs that were never processed.
+
+        """
+        if not items:
+            return
+        self.redis.lpush("resque:queue:%s" % queue,
+                         *[self._dump(i) for i in reversed(items)])
+
     def size(self, queue):
         return int(self.redis.llen("resque:queue:%s" % queue))
 
@@ -181,13 +603,14 @@ class ResQ(object):
         items = self.redis.lrange(key, start,start+count-1) or []
         ret_list = []
         for i in items:
-            ret_list.append(ResQ.decode(i))
+            ret_list.append(self._load(i))
         return ret_list
 
     def _get_redis(self):
         return self._redis
 
     def _set_redis(self, server):
+        self._scripts = {}
         if isinstance(server, string_types):
             self.dsn = server
             address, _, db = server.partition('/')
@@ -209,6 +632,12 @@ class ResQ(object):
             raise Exception("I don't know what to do with %s" % str(server))
     redis = property(_get_redis, _set_redis)
 
+    def _script(self, name, source):
+        script = self._scripts.get(name)
+        if script is None:
+            script = self._scripts[name] = self.redis.register_script(source)
+        return script
+
     def enqueue(self, klass, *args):
         """Enqueue a job into a specific queue. Make sure the class you are
         passing has **queue** attribute and a **perform** method on it.
@@ -232,6 +661,61 @@ class ResQ(object):
         else:
             logger.debug("no arguments passed in.")
 
+    def enqueue_many(self, klass, args_list, batch_size=1000):
+        """Enqueue one job of ``klass`` per item of ``args_list``, where
+        each item is the sequence of arguments for a single job.
+
+        Payloads are written ``batch_size`` at a time with a single
+        multi-value RPUSH inside a pipeline, so fanning out a large number
+        of jobs costs one round-trip per batch instead of one per job.
+        Returns the number of jobs enqueued.
+
+        """
+        queue = getattr(klass,'queue', None)
+        if queue:
+            class_name = '%s.%s' % (klass.__module__, klass.__name__)
+            return self.enqueue_many_from_string(class_name, queue, args_list,
+                                                 batch_size=batch_size)
+        else:
+            logger.warning("unable to enqueue jobs with class %s" % str(klass))
+            return 0
+
+    def enqueue_many_from_string(self, klass_as_string, queue, args_list,
+                                 batch_size=1000):
+        payloads = ({'class': klass_as_string, 'args': args,
+                     'enqueue_timestamp': time.time()} for args in args_list)
+        total = self.push_many(queue, payloads, batch_size=batch_size)
+        logger.info("enqueued %d '%s' jobs on queue %s" %
+                    (total, klass_as_string, queue))
+        return total
+
+    def push_many(self, queue, items, batch_size=1000):
+        """Push every item of ``items`` onto ``queue`` using one pipelined
+        round-trip per ``batch_size`` items. Returns the number of items
+        pushed.
+
+        """
+        key = "resque:queue:%s" % queue
+        total = 0
+        batch = []
+        for item in items:
+            batch.append(self._dump(item))
+            if len(batch) >= batch_size:
+                self._push_batch(queue, key, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            self._push_batch(queue, key, batch)
+            total += len(batch)
+        return total
+
+    def _push_batch(self, queue, key, batch):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd('resque:queues', str(queue))
+        pipe.rpush(key, *batch)
+        pipe.execute()
+        self._watched_queues.add(queue)
+
     def queues(self):
         return [sm.decode() for sm in self.redis.smembers("resque:queues")] or []
 
@@ -243,19 +727,44 @@ class ResQ(object):
         processed, no. of queues, no. of workers, no. of failed jobs.
 
         """
-        pending = 0
-        for q in self.queues():
-             pending += self.size(q)
+        snapshot = self.snapshot(delayed=False)
         return {
-            'pending'   : pending,
-            'processed' : Stat('processed',self).get(),
-            'queues'    : len(self.queues()),
-            'workers'   : len(self.workers()),
+            'pending'   : snapshot.pending,
+            'processed' : snapshot.processed,
+            'queues'    : len(snapshot.queues),
+            'workers'   : snapshot.workers,
             #'working'   : len(self.working()),
-            'failed'    : Stat('failed',self).get(),
+            'failed'    : snapshot.failed,
             'servers'   : ['%s:%s' % (self.host, self.port)]
         }
 
+    def snapshot(self, delayed=True):
+        """Returns a ``Snapshot`` of the pending jobs per queue, the stats,
+        the number of registered workers, minions and khans and the size of
+        the delayed queue, gathered atomically in a single round-trip.
+
+        Counting delayed jobs takes an LLEN per scheduled timestamp on the
+        server; pass ``delayed=False`` to skip it.
+
+        """
+        ret = self._script('snapshot', _SNAPSHOT_SCRIPT)(args=['1' if delayed else '0'])
+        (queues, sizes, processed, failed, failed_jobs, workers, minions, khans,
+         timestamps, delayed_jobs) = ret
+        return Snapshot(dict(zip([q.decode() for q in queues], sizes)),
+                        int(processed), int(failed), failed_jobs, workers,
+                        minions, khans, timestamps,
+                        delayed_jobs if delayed_jobs >= 0 else None)
+
+    def metrics(self, queue, window=300):
+        """Returns the throughput and the wait and run time percentiles of
+        jobs performed from ``queue`` over the last ``window`` seconds,
+        rounded up to whole minutes. See ``pyres.metrics``."""
+        minutes, seconds = _metrics.minutes(window)
+        pipe = self.redis.pipeline(transaction=False)
+        for minute in minutes:
+            pipe.hgetall(_metrics.key(queue, minute))
+        return _metrics.summarize(pipe.execute(), seconds)
+
     def keys(self):
         return [key.decode().replace('resque:','')
                 for key in self.redis.keys('resque:*')]
@@ -297,31 +806,109 @@ class ResQ(object):
             payload['first_attempt'] = kwargs['first_attempt']
         self.delayed_push(datetime, payload)
 
+    def enqueue_in(self, seconds, klass, *args, **kwargs):
+        """Enqueue a job of ``klass`` to run ``seconds`` from now."""
+        at = ResQ._current_time() + datetime.timedelta(seconds=seconds)
+        self.enqueue_at(at, klass, *args, **kwargs)
+
+    def enqueue_in_from_string(self, seconds, klass_as_string, queue, *args, **kwargs):
+        at = ResQ._current_time() + datetime.timedelta(seconds=seconds)
+        self.enqueue_at_from_string(at, klass_as_string, queue, *args, **kwargs)
+
+    def enqueue_at_many(self, klass, items, batch_size=1000):
+        """Schedule one job of ``klass`` per ``(datetime, args)`` pair of
+        ``items``, ``batch_size`` at a time in one pipelined round-trip,
+        see ``delayed_push_many``. Returns the number of jobs scheduled.
+
+        """
+        class_name = '%s.%s' % (klass.__module__, klass.__name__)
+        return self.enqueue_at_many_from_string(class_name, klass.queue, items,
+                                                batch_size=batch_size)
+
+    def enqueue_at_many_from_string(self, klass_as_string, queue, items,
+                                    batch_size=1000):
+        payloads = ((at, {'class': klass_as_string, 'queue': queue, 'args': args})
+                    for at, args in items)
+        total = self.delayed_push_many(payloads, batch_size=batch_size)
+        logger.info("scheduled %d '%s' jobs on queue %s" %
+                    (total, klass_as_string, queue))
+        return total
+
+    def _delayed_key(self, datetime):
+        if self.delayed_precision_ms:
+            return _delayed_member(round(_timestamp(datetime), 3))
+        return int(time.mktime(datetime.timetuple()))
+
     def delayed_push(self, datetime, item):
-        key = int(time.mktime(datetime.timetuple()))
-        self.redis.rpush('resque:delayed:%s' % key, ResQ.encode(item))
-        self.redis.zadd('resque:delayed_queue_schedule', key, key)
+        key = self._delayed_key(datetime)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush('resque:delayed:%s' % key, self._dump(item))
+        pipe.zadd('resque:delayed_queue_schedule', key, key)
+        if self.delayed_notify:
+            pipe.publish(DELAYED_CHANNEL, key)
+        pipe.execute()
+
+    def delayed_push_many(self, items, batch_size=1000):
+        """Push every ``(datetime, item)`` pair of ``items`` onto the delayed
+        schedule. Each batch of ``batch_size`` items is grouped by timestamp
+        and written in one pipeline: a multi-value RPUSH per timestamp and
+        a single ZADD. Returns the number of items pushed.
+
+        """
+        total = 0
+        batch = []
+        for at, item in items:
+            batch.append((self._delayed_key(at), self._dump(item)))
+            if len(batch) >= batch_size:
+                self._delayed_push_batch(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            self._delayed_push_batch(batch)
+            total += len(batch)
+        return total
+
+    def _delayed_push_batch(self, batch):
+        grouped = OrderedDict()
+        for key, data in batch:
+            grouped.setdefault(key, []).append(data)
+        pipe = self.redis.pipeline(transaction=False)
+        for key, datas in grouped.items():
+            pipe.rpush('resque:delayed:%s' % key, *datas)
+        scores = []
+        for key in grouped:
+            scores.extend([key, key])
+        pipe.zadd('resque:delayed_queue_schedule', *scores)
+        if self.delayed_notify:
+            # one announcement wakes the scheduler for the earliest of them
+            pipe.publish(DELAYED_CHANNEL, min(grouped, key=float))
+        pipe.execute()
 
     def delayed_queue_peek(self, start, count):
-        return [int(item) for item in self.redis.zrange(
-                'resque:delayed_queue_schedule', start, start+count) or []]
+        timestamps = []
+        for item in self.redis.zrange('resque:delayed_queue_schedule',
+                                      start, start+count) or []:
+            item = item.decode()
+            timestamps.append(float(item) if '.' in item else int(item))
+        return timestamps
 
     def delayed_timestamp_peek(self, timestamp, start, count):
-        return self.list_range('resque:delayed:%s' % timestamp, start, count)
+        return self.list_range('resque:delayed:%s' % _delayed_member(timestamp),
+                               start, count)
 
     def delayed_queue_schedule_size(self):
-        size = 0
-        length = self.redis.zcard('resque:delayed_queue_schedule')
-        for i in self.redis.zrange('resque:delayed_queue_schedule',0,length):
-            size += self.delayed_timestamp_size(i.decode())
-        return size
+        timestamps = self.redis.zrange('resque:delayed_queue_schedule', 0, -1)
+        pipe = self.redis.pipeline(transaction=False)
+        for timestamp in timestamps:
+            pipe.llen('resque:delayed:%s' % timestamp.decode())
+        return sum(pipe.execute())
 
     def delayed_timestamp_size(self, timestamp):
         #key = int(time.mktime(timestamp.timetuple()))
-        return self.redis.llen("resque:delayed:%s" % timestamp)
+        return self.redis.llen("resque:delayed:%s" % _delayed_member(timestamp))
 
     def next_delayed_timestamp(self):
-        key = int(time.mktime(ResQ._current_time().timetuple()))
+        key = _timestamp(ResQ._current_time())
         array = self.redis.zrangebyscore('resque:delayed_queue_schedule',
                                          '-inf', key, start=0, num=1)
         timestamp = None
@@ -331,28 +918,94 @@ class ResQ(object):
         if timestamp:
             return timestamp.decode()
 
+    def promote_delayed(self, count=1000, shard=0, shards=1, scan=1000):
+        """Moves up to ``count`` delayed jobs that are due to their queues
+        in one atomic call and returns how many were moved. With ``shards``
+        greater than one, only timestamps whose whole seconds modulo
+        ``shards`` equal ``shard`` are promoted, and the call stops after
+        passing over ``scan`` due timestamps of other shards.
+
+        Payloads that are compressed, claim-checked or not JSON stop the
+        call at their timestamp; they stay on its delayed list and are popped
+        and enqueued from here one at a time, within the same ``count``.
+
+        """
+        now = _timestamp(ResQ._current_time())
+        moved, held = self._script('promote_delayed', _PROMOTE_DELAYED_SCRIPT)(
+            args=[repr(now), repr(time.time()), count, shards, shard, scan])
+        for timestamp in held:
+            while moved < count and self.delayed_timestamp_size(timestamp):
+                item = self.next_item_for_timestamp(timestamp)
+                moved += 1
+                if item is None:
+                    continue
+                kwargs = {}
+                if 'first_attempt' in item:
+                    kwargs['first_attempt'] = item['first_attempt']
+                self.enqueue_from_string(item['class'], item['queue'], *item['args'], **kwargs)
+        return moved
+
+    def next_delayed_time(self, shard=0, shards=1, scan=1000):
+        """Returns when the earliest delayed job is due, in seconds since
+        the epoch, or None if there are none. With ``shards`` greater than
+        one, only the first ``scan`` timestamps are searched for one in
+        ``shard``."""
+        if shards > 1:
+            score = self._script('next_delayed', _NEXT_DELAYED_SCRIPT)(
+                args=[shards, shard, scan])
+            return float(score) if score else None
+        earliest = self.redis.zrange('resque:delayed_queue_schedule', 0, 0,
+                                     withscores=True)
+        if earliest:
+            return earliest[0][1]
+
     def next_item_for_timestamp(self, timestamp):
         #key = int(time.mktime(timestamp.timetuple()))
+        timestamp = _delayed_member(timestamp)
         key = "resque:delayed:%s" % timestamp
         ret = self.redis.lpop(key)
         item = None
         if ret:
-            item = ResQ.decode(ret)
+            item = self._load(ret, delete=True)
         if self.redis.llen(key) == 0:
             self.redis.delete(key)
             self.redis.zrem('resque:delayed_queue_schedule', timestamp)
         return item
 
+    def _dump(self, item):
+        """Encodes ``item`` for pushing, moving it to ``payload_store`` if
+        it is large enough."""
+        data = ResQ.encode(item)
+        if (self.payload_store is not None and
+                len(data) >= self.claim_check_threshold):
+            data = claim_check.put(self, data)
+        return data
+
+    def _load(self, data, delete=False):
+        """Decodes a pushed item, fetching it from its payload store if it
+        is a reference. Returns None if the stored payload is gone."""
+        data = claim_check.resolve(self, data, delete=delete)
+        if data is None:
+            return None
+        if not self.measure_decode:
+            return ResQ.decode(data)
+        start = time.time()
+        try:
+            return ResQ.decode(data)
+        finally:
+            self.last_decode_time += time.time() - start
+
     @classmethod
     def encode(cls, item):
-        return json.dumps(item)
+        data = serializers.get(cls.serializer).dumps(item)
+        if cls.compression:
+            data = compression.compress(data, cls.compression,
+                                        cls.compression_threshold)
+        return data
 
     @classmethod
     def decode(cls, item):
-        if not isinstance(item, string_types):
-            item = item.decode()
-        ret = json.loads(item)
-        return ret
+        return serializers.get(cls.serializer).loads(compression.decompress(item))
 
     @classmethod
     def _enqueue(cls, klass, *args):
@@ -383,12 +1036,83 @@ class Stat(object):
             return int(val)
         return 0
 
-    def incr(self, ammount=1):
-        self.resq.redis.incr(self.key, ammount)
+    def _client(self, pipe):
+        if pipe is None:
+            return self.resq.redis
+        return pipe
 
-    def decr(self, ammount=1):
-        self.resq.redis.decr(self.key, ammount)
+    def incr(self, ammount=1, pipe=None):
+        """Increments the stat, queued on ``pipe`` if a pipeline is given."""
+        self._client(pipe).incr(self.key, ammount)
 
-    def clear(self):
-        self.resq.redis.delete(self.key)
+    def decr(self, ammount=1, pipe=None):
+        self._client(pipe).decr(self.key, ammount)
 
+    def clear(self, pipe=None):
+        self._client(pipe).delete(self.key)
+
+
+
+class StatBuffer(object):
+    """Accumulates stat increments in-process and writes them to the usual
+    ``resque:stat:*`` keys with INCRBY, all in one pipeline, once
+    ``flush_interval`` seconds have passed since the last flush or
+    ``flush_jobs`` increments are pending, whichever comes first. Either
+    may be None to disable that trigger.
+
+    Counts not yet flushed are lost if the process dies, so owners must
+    call ``flush`` before exiting.
+
+    """
+    def __init__(self, resq, flush_interval=5, flush_jobs=None):
+        self.resq = resq
+        self.flush_interval = flush_interval
+        self.flush_jobs = flush_jobs
+        self._counts = {}
+        self._increments = 0
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def incr(self, name, ammount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + ammount
+            self._increments += 1
+
+    def pending(self, name):
+        """Returns the count buffered for ``name`` since the last flush."""
+        return self._counts.get(name, 0)
+
+    def due(self):
+        if not self._counts:
+            return False
+        if self.flush_jobs is not None and self._increments >= self.flush_jobs:
+            return True
+        return (self.flush_interval is not None and
+                time.time() - self._last_flush >= self.flush_interval)
+
+    def drain(self):
+        """Returns the buffered counts and forgets them without writing
+        them out."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._increments = 0
+            self._last_flush = time.time()
+        return counts
+
+    def flush(self, pipe=None):
+        """Writes out the buffered counts, queued on ``pipe`` if given
+        (the caller then executes it), or in a pipeline of its own."""
+        counts = self.drain()
+        if not counts:
+            return
+        execute = pipe is None
+        if execute:
+            pipe = self.resq.redis.pipeline(transaction=False)
+        for name, ammount in counts.items():
+            pipe.incr("resque:stat:%s" % name, ammount)
+        if execute:
+            pipe.execute()
+
+    def flush_if_due(self, pipe=None):
+        if self.due():
+            self.flush(pipe)
@@ -0,0 +1,299 @@
+"""An asyncio based worker for job classes whose ``perform`` is a coroutine.
+
+Requires Python 3.7+ and redis-py 4.2+ (for ``redis.asyncio``)::
+
+    >>> from pyres.aio import AsyncWorker
+    >>> AsyncWorker.run(['webhooks'], server="localhost:6379", concurrency=500)
+
+Jobs are reserved with BLPOP like the other workers and performed as tasks
+on a single event loop, at most ``concurrency`` of them at a time. Job
+classes with a regular ``perform`` still work, but block the loop while
+they run. ``before_perform``/``after_perform`` hooks, retries and the
+failure backend behave as in :class:`pyres.job.Job`; the latter two, which
+only use the blocking client, are run in the loop's default executor.
+"""
+import asyncio
+import datetime
+import inspect
+import logging
+import os
+import signal
+import time
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+from pyres import ResQ, __version__
+from pyres import failure, metrics
+from pyres import payload_store as claim_check
+from pyres import json_parser as json
+from pyres.compat import string_types
+from pyres.exceptions import NoQueueError, TimeoutError
+from pyres.job import Job
+from pyres.queues import QueueSelector, parse_queues
+
+logger = logging.getLogger(__name__)
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AsyncJob(Job):
+    """A :class:`pyres.job.Job` whose ``perform`` is a coroutine."""
+
+    async def perform(self):
+        """Coroutine version of :meth:`pyres.job.Job.perform`. The payload
+        class' ``perform``, ``before_perform`` and ``after_perform`` may be
+        either coroutine functions or regular functions.
+
+        """
+        loop = asyncio.get_event_loop()
+        payload_class_str = self._payload["class"]
+        payload_class = self.safe_str_to_class(payload_class_str)
+        self._bind_resq(payload_class)
+        args = self._payload.get("args")
+
+        metadata = dict(args=args)
+        if self.enqueue_timestamp:
+            metadata["enqueue_timestamp"] = self.enqueue_timestamp
+
+        before_perform = getattr(payload_class, "before_perform", None)
+
+        metadata["failed"] = False
+        metadata["perform_timestamp"] = self.perform_timestamp = time.time()
+        try:
+            if before_perform:
+                await _maybe_await(payload_class.before_perform(metadata))
+            return await _maybe_await(payload_class.perform(*args))
+        except Exception as e:
+            metadata["failed"] = True
+            metadata["exception"] = e
+            retried = await loop.run_in_executor(None, self.retry, payload_class, args)
+            if not retried:
+                metadata["retried"] = False
+                raise
+            else:
+                metadata["retried"] = True
+                logging.exception("Retry scheduled after error in %s", self._payload)
+        finally:
+            self.perform_time = time.time() - self.perform_timestamp
+            after_perform = getattr(payload_class, "after_perform", None)
+
+            if after_perform:
+                await _maybe_await(payload_class.after_perform(metadata))
+
+            self._unbind_resq(payload_class)
+
+
+class AsyncWorker(object):
+    """Defines an asyncio worker. ``concurrency`` bounds the number of jobs
+    performed at the same time and ``timeout``, if given, cancels jobs that
+    run longer than that many seconds and records them as failed.
+
+    """
+
+    job_class = AsyncJob
+
+    def __init__(self, queues=(), server="localhost:6379", password=None,
+                 concurrency=100, timeout=None, queue_policy=None, record_metrics=False):
+        if aioredis is None:
+            raise ImportError("AsyncWorker requires redis-py 4.2 or newer")
+        self.queues, weights = parse_queues(queues)
+        self.validate_queues()
+        self._shutdown = False
+        self.pid = os.getpid()
+        self.hostname = os.uname()[1]
+        self.concurrency = concurrency
+        self.timeout = timeout
+        # record wait and run times in the ``pyres.metrics`` histograms
+        self.record_metrics = record_metrics
+        self._slot_ids = set()
+
+        if isinstance(server, string_types):
+            self.resq = ResQ(server=server, password=password)
+        elif isinstance(server, ResQ):
+            self.resq = server
+        else:
+            raise Exception("Bad server argument")
+        self.queue_selector = QueueSelector(self.queues, weights, queue_policy, self.resq)
+        address, _, db = self.resq.dsn.partition('/')
+        host, port = address.split(':')
+        self.redis = aioredis.Redis(host=host, port=int(port), db=int(db or 0),
+                                    password=self.resq.password)
+
+    def validate_queues(self):
+        """Checks if a worker is given at least one queue to work on."""
+        if not self.queues:
+            raise NoQueueError("Please give each worker at least one queue.")
+
+    def __str__(self):
+        return '%s:%s:%s' % (self.hostname, self.pid, ','.join(self.queues))
+
+    def _slot_id(self, slot):
+        return '%s:%s-%s:%s' % (self.hostname, self.pid, slot, ','.join(self.queues))
+
+    def schedule_shutdown(self):
+        logger.info('shutdown scheduled')
+        self._shutdown = True
+
+    async def register_worker(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd('resque:workers', str(self))
+        pipe.set('resque:worker:%s:started' % self,
+                 int(time.mktime(datetime.datetime.now().timetuple())))
+        await pipe.execute()
+
+    async def unregister_worker(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.srem('resque:workers', str(self), *self._slot_ids)
+        for worker_id in self._slot_ids:
+            pipe.delete('resque:worker:%s' % worker_id)
+        pipe.delete('resque:worker:%s:started' % self)
+        pipe.delete('resque:stat:processed:%s' % self)
+        pipe.delete('resque:stat:failed:%s' % self)
+        await pipe.execute()
+
+    async def reserve(self, timeout=5):
+        queues = self.queue_selector.order()
+        if not queues:
+            await asyncio.sleep(timeout)
+            return
+        ret = await self.redis.blpop(["resque:queue:%s" % q for q in queues],
+                                     timeout=timeout)
+        if ret:
+            key, payload = ret
+            if claim_check.is_reference(payload):
+                payload = await asyncio.get_event_loop().run_in_executor(
+                    None, self.resq._load, payload, True)
+                if payload is None:
+                    return
+            else:
+                payload = ResQ.decode(payload)
+            job = self.job_class(key[13:].decode(), payload, self.resq, str(self))
+            logger.info('Found job on %s: %s' % (job._queue, job))
+            return job
+
+    async def process(self, job, slot):
+        """Performs ``job``, recording it under the worker id of ``slot``
+        while it runs and updating the processed/failed stats. The id is
+        added to ``resque:workers`` the first time the slot is used."""
+        worker_id = self._slot_id(slot)
+        data = json.dumps({
+            'queue': job._queue,
+            'run_at': str(int(time.mktime(datetime.datetime.now().timetuple()))),
+            'payload': job._payload
+        })
+        pipe = self.redis.pipeline(transaction=False)
+        if worker_id not in self._slot_ids:
+            self._slot_ids.add(worker_id)
+            pipe.sadd('resque:workers', worker_id)
+        pipe.set("resque:worker:%s" % worker_id, data)
+        await pipe.execute()
+        job_failed = False
+        try:
+            if self.timeout:
+                await asyncio.wait_for(job.perform(), self.timeout)
+            else:
+                await job.perform()
+        except asyncio.TimeoutError:
+            job_failed = True
+            try:
+                raise TimeoutError("Timed out after %d seconds" % self.timeout)
+            except TimeoutError as e:
+                await self._handle_job_exception(job, e)
+        except Exception as e:
+            job_failed = True
+            await self._handle_job_exception(job, e)
+        finally:
+            pipe = self.redis.pipeline(transaction=False)
+            if job_failed:
+                pipe.incr("resque:stat:failed")
+                pipe.incr("resque:stat:failed:%s" % self)
+            pipe.incr("resque:stat:processed")
+            pipe.incr("resque:stat:processed:%s" % self)
+            pipe.delete("resque:worker:%s" % worker_id)
+            if self.record_metrics and job.perform_timestamp:
+                metrics.record_job(pipe, job, job_failed)
+            await pipe.execute()
+        if not job_failed:
+            logger.debug('completed job: %s' % job)
+
+    async def _handle_job_exception(self, job, exception):
+        logger.exception("%s failed: %s" % (job, exception))
+        # the failure backend reads sys.exc_info(), so create it here and
+        # only run the blocking save in the executor
+        fail = failure.create(exception, job._queue, job._payload, job._worker)
+        await asyncio.get_event_loop().run_in_executor(None, fail.save, self.resq)
+
+    async def work(self, interval=5):
+        """Reserve and perform jobs until a SIGTERM, SIGINT or SIGQUIT is
+        received, then wait for the running jobs before returning."""
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+            loop.add_signal_handler(signum, self.schedule_shutdown)
+        _setproctitle(self, "Starting")
+        await self.register_worker()
+
+        slots = asyncio.Semaphore(self.concurrency)
+        free_slots = list(range(self.concurrency))
+        running = set()
+
+        async def run(job):
+            slot = free_slots.pop()
+            try:
+                await self.process(job, slot)
+            finally:
+                free_slots.append(slot)
+                slots.release()
+
+        try:
+            while not self._shutdown:
+                await slots.acquire()
+                if self._shutdown:
+                    slots.release()
+                    break
+                _setproctitle(self, "Waiting (%d running)" % len(running))
+                job = await self.reserve(interval)
+                if job:
+                    task = loop.create_task(run(job))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                else:
+                    slots.release()
+            if running:
+                logger.info('waiting for %d running jobs' % len(running))
+                await asyncio.gather(*running, return_exceptions=True)
+        finally:
+            await self.unregister_worker()
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+                loop.remove_signal_handler(signum)
+            # redis-py < 5 only has close()
+            await getattr(self.redis, 'aclose', self.redis.close)()
+
+    @classmethod
+    def run(cls, queues, server="localhost:6379", password=None, interval=None,
+            concurrency=100, timeout=None, queue_policy=None, record_metrics=False):
+        worker = cls(queues=queues, server=server, password=password,
+                     concurrency=concurrency, timeout=timeout, queue_policy=queue_policy,
+                     record_metrics=record_metrics)
+        if interval is not None:
+            asyncio.run(worker.work(interval))
+        else:
+            asyncio.run(worker.work())
+
+
+try:
+    from setproctitle import setproctitle
+except ImportError:
+    def setproctitle(name):
+        pass
+
+def _setproctitle(worker, msg):
+    setproctitle("pyres_async_worker-%s [%s]: %s" % (__version__,
+                                                     ','.join(worker.queues),
+                                                     msg))
@@ -0,0 +1,96 @@
+"""Optional compression of large job payloads.
+
+When ``ResQ.compression`` names a codec, ``ResQ.encode`` compresses
+serialized payloads of at least ``ResQ.compression_threshold`` bytes and
+stores them base64 encoded behind a short marker, e.g. ``@Z:eJyrVkrOz...``.
+Smaller payloads are left as they are, so they stay readable by resque and
+older pyres workers. ``ResQ.decode`` recognises the markers of every
+registered codec whatever the current setting::
+
+    >>> from pyres import ResQ
+    >>> ResQ.compression = 'zlib'
+    >>> ResQ.compression_threshold = 16 * 1024
+
+Built in are ``zlib`` and, when the `lz4`_ package is installed, ``lz4``.
+
+.. _lz4: https://github.com/python-lz4/python-lz4
+"""
+import zlib
+from base64 import b64decode, b64encode
+
+from pyres.compat import binary_type
+
+_registry = {}
+_markers = {}
+
+
+class Codec(object):
+    """A named ``compress``/``decompress`` pair working on bytes, and the
+    marker its payloads are prefixed with."""
+
+    def __init__(self, name, marker, compress, decompress):
+        self.name = name
+        self.marker = marker
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return '<Codec %s>' % self.name
+
+
+def register(name, marker, compress, decompress):
+    """Register a codec under ``name``. ``marker`` must be three unique
+    characters starting with ``@``, so it cannot be mistaken for a
+    serialized payload."""
+    codec = Codec(name, marker, compress, decompress)
+    _registry[name] = codec
+    _markers[marker.encode('ascii')] = codec
+    return codec
+
+
+def get(name):
+    try:
+        return _registry[name]
+    except KeyError:
+        raise ValueError("Unknown compression %r, available: %s" %
+                         (name, ', '.join(sorted(_registry))))
+
+
+def available():
+    return sorted(_registry)
+
+
+def compress(data, name, threshold=0):
+    """Compresses ``data`` with the codec ``name`` if it is at least
+    ``threshold`` bytes long and compressing actually makes it smaller."""
+    if len(data) < threshold:
+        return data
+    codec = get(name)
+    raw = data if isinstance(data, binary_type) else data.encode('utf-8')
+    packed = codec.marker + b64encode(codec.compress(raw)).decode('ascii')
+    if len(packed) >= len(data):
+        return data
+    return packed
+
+
+def decompress(data):
+    """Returns ``data`` decompressed if it carries a codec marker, and
+    unchanged otherwise."""
+    if not data or data[:1] not in ('@', b'@'):
+        return data
+    raw = data if isinstance(data, binary_type) else data.encode('ascii')
+    codec = _markers.get(raw[:3])
+    if codec is None:
+        return data
+    return codec.decompress(b64decode(raw[3:]))
+
+
+register('zlib', '@Z:', zlib.compress, zlib.decompress)
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+if lz4 is not None:
+    register('lz4', '@L:', lz4.frame.compress, lz4.frame.decompress)
@@ -0,0 +1,229 @@
+"""Recurring jobs for the ``Scheduler``.
+
+A schedule maps entry names to a cron expression, a job class and its
+arguments, as a dict or a JSON file of the same shape::
+
+    {
+        "tenant-42-report": {
+            "cron": "*/15 * * * *",
+            "class": "jobs.Report",
+            "queue": "reports",
+            "args": [42]
+        }
+    }
+
+``queue`` defaults to the ``queue`` attribute of the class and ``args`` to
+no arguments. Expressions have the usual five fields (minute, hour, day of
+month, month, day of week), in local time, with ``*``, lists, ranges,
+steps, month and day names, and the ``@hourly``/``@daily``/``@weekly``/
+``@monthly``/``@yearly`` shorthands.
+
+Entries are kept in a heap ordered by their next fire time, so each tick
+only looks at the entries that are due. Firing is de-duplicated server side
+by recording the last fire time of each entry in ``resque:cron:last_fired``
+in the same script that pushes the job, so schedulers taking over from one
+another never run a tick twice.
+
+"""
+import datetime
+import heapq
+import json
+import time
+import zlib
+
+from pyres import ResQ, _timestamp, safe_str_to_class
+from pyres.compat import string_types
+
+LAST_FIRED_KEY = 'resque:cron:last_fired'
+
+# KEYS[1]: last fire times, ARGV: groups of entry name, fire time, queue and
+# encoded payload. Pushes each payload unless its entry has already fired at
+# or after that time.
+_FIRE_SCRIPT = """
+local fired = 0
+for i = 1, #ARGV, 4 do
+    local last = redis.call('hget', KEYS[1], ARGV[i])
+    if not last or tonumber(last) < tonumber(ARGV[i + 1]) then
+        redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+        redis.call('rpush', 'resque:queue:' .. ARGV[i + 2], ARGV[i + 3])
+        redis.call('sadd', 'resque:queues', ARGV[i + 2])
+        fired = fired + 1
+    end
+end
+return fired
+"""
+
+_ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+_MONTHS = dict((name, i + 1) for i, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']))
+
+_DAYS = dict((name, i) for i, name in enumerate(
+    ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']))
+
+# (low, high, names) of each field
+_FIELDS = ((0, 59, {}), (0, 23, {}), (1, 31, {}), (1, 12, _MONTHS), (0, 7, _DAYS))
+
+
+class CronExpression(object):
+    """A parsed five-field cron expression."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = _ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError("%r does not have five fields" % expression)
+        parsed = [self._parse(field, *spec) for field, spec in zip(fields, _FIELDS)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = parsed
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        # as in cron, a day matches either field when both are restricted
+        self._any_day = fields[2] == '*' or fields[4] == '*'
+
+    def _parse(self, field, low, high, names):
+        values = set()
+        for part in field.lower().split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [self._value(v, names) for v in part.split('-', 1)]
+            else:
+                start = self._value(part, names)
+                end = high if step > 1 else start
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError("%r is out of range in %r" % (field, self.expression))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _value(self, value, names):
+        if value in names:
+            return names[value]
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError("%r is not valid in %r" % (value, self.expression))
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, dt):
+        """Returns the first time after ``dt`` the expression matches."""
+        t = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        last_year = t.year + 5
+        while t.year <= last_year:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) +
+                     datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError("%r never matches" % self.expression)
+
+
+class Entry(object):
+    """A recurring job."""
+
+    def __init__(self, name, cron, klass, queue=None, args=()):
+        self.name = name
+        self.cron = CronExpression(cron)
+        self.klass = klass
+        if queue is None:
+            queue = getattr(safe_str_to_class(klass), 'queue', None)
+            if queue is None:
+                raise ValueError("%s has no queue and %s no queue attribute" % (name, klass))
+        self.queue = queue
+        self.args = list(args)
+
+    def payload(self):
+        return {'class': self.klass, 'args': self.args, 'enqueue_timestamp': time.time()}
+
+
+def _in_shard(name, shard, shards):
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % shards == shard
+
+
+class CronSchedule(object):
+    """Keeps ``entries`` in a heap by their next fire time after ``now``."""
+
+    #: entries fired per call to redis
+    batch_size = 1000
+
+    def __init__(self, entries, now=None):
+        if now is None:
+            now = ResQ._current_time()
+        self.entries = entries
+        self._heap = [(entry.cron.next_after(now), i, entry)
+                      for i, entry in enumerate(entries)]
+        heapq.heapify(self._heap)
+
+    @classmethod
+    def load(cls, schedule, now=None, shard=0, shards=1):
+        """Builds a schedule from a dict or the path of a JSON file. With
+        ``shards`` greater than one only the entries whose name hashes to
+        ``shard`` are kept."""
+        if isinstance(schedule, string_types):
+            with open(schedule) as f:
+                schedule = json.load(f)
+        entries = []
+        for name in sorted(schedule):
+            if shards > 1 and not _in_shard(name, shard, shards):
+                continue
+            spec = schedule[name]
+            try:
+                entries.append(Entry(name, spec['cron'], spec['class'],
+                                     spec.get('queue'), spec.get('args', ())))
+            except KeyError as e:
+                raise ValueError("%s is missing %s" % (name, e))
+        return cls(entries, now)
+
+    def next_fire(self):
+        """Returns the next time an entry is due, or None if empty."""
+        if self._heap:
+            return self._heap[0][0]
+
+    def due(self, now):
+        """Pops the entries due by ``now``, as ``(fire time, entry)``, and
+        reschedules them after ``now``; missed ticks are not caught up."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, i, entry = heapq.heappop(self._heap)
+            due.append((fire_at, entry))
+            heapq.heappush(self._heap, (entry.cron.next_after(now), i, entry))
+        return due
+
+    def fire(self, resq, now=None):
+        """Enqueues the entries due by ``now`` and returns how many were
+        enqueued, leaving out those another scheduler already fired."""
+        if now is None:
+            now = ResQ._current_time()
+        due = self.due(now)
+        fired = 0
+        for start in range(0, len(due), self.batch_size):
+            args = []
+            for fire_at, entry in due[start:start + self.batch_size]:
+                args.extend([entry.name, int(_timestamp(fire_at)), entry.queue,
+                             resq._dump(entry.payload())])
+            fired += resq._script('cron_fire', _FIRE_SCRIPT)(keys=[LAST_FIRED_KEY],
+                                                             args=args)
+        return fired
@@ -0,0 +1,212 @@
+"""Prometheus exporter for queues, workers and job timings.
+
+Serves the metrics below in the Prometheus text exposition format, which
+OpenMetrics scrapers also accept::
+
+    pyres_queue_length{queue}             jobs waiting in each queue
+    pyres_jobs_processed_total            resque:stat:processed
+    pyres_jobs_failed_total               resque:stat:failed
+    pyres_failed_queue_length             jobs in resque:failed
+    pyres_delayed_timestamps              timestamps with delayed jobs
+    pyres_workers, pyres_minions,
+    pyres_khans                           registered processes
+    pyres_queue_jobs_processed_total{queue},
+    pyres_queue_jobs_failed_total{queue}  jobs performed per queue
+    pyres_job_wait_seconds{queue},
+    pyres_job_run_seconds{queue}          histograms of queue wait and run
+                                          time, see ``pyres.metrics``
+
+The per-queue series are only there for queues whose workers run with
+``--record-metrics``.
+
+Everything is read in two round-trips however many queues there are,
+a ``ResQ.snapshot`` and a pipeline of the per-queue histograms, and the
+result is cached for ``cache_ttl`` seconds so that several scrapers do not
+multiply the load on redis. Delayed jobs are not counted, as that takes an
+LLEN per scheduled timestamp; only the number of timestamps is exported.
+
+Run it standalone with the ``pyres_exporter`` script, or from a manager
+with ``pyres_manager --metrics-port``::
+
+    >>> from pyres import ResQ
+    >>> from pyres.exporter import Exporter
+    >>> Exporter(ResQ()).serve(port=9123)
+
+"""
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from pyres import metrics
+from pyres.compat import text_type
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _text(value):
+    if isinstance(value, text_type):
+        return value
+    return value.decode('utf-8')
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value is None:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class Exporter(object):
+    """Collects the metrics of the queues ``resq`` is connected to."""
+
+    def __init__(self, resq, cache_ttl=5):
+        self.resq = resq
+        self.cache_ttl = cache_ttl
+        self._cache = None
+        self._cached_at = 0
+        self._lock = threading.Lock()
+
+    def collect(self):
+        """Reads the current values from redis and returns a list of
+        ``(name, type, help, [(labels, value), ...])`` families."""
+        snapshot = self.resq.snapshot(delayed=False)
+        queues = sorted(snapshot.queues)
+
+        pipe = self.resq.redis.pipeline(transaction=False)
+        for queue in queues:
+            pipe.hgetall(metrics.total_key(queue))
+        totals = pipe.execute()
+
+        families = [
+            ('pyres_queue_length', 'gauge', 'Jobs waiting in the queue.',
+             [({'queue': q}, snapshot.queues[q]) for q in queues]),
+            ('pyres_jobs_processed_total', 'counter', 'Jobs processed by all workers.',
+             [({}, snapshot.processed)]),
+            ('pyres_jobs_failed_total', 'counter', 'Jobs failed on all workers.',
+             [({}, snapshot.failed)]),
+            ('pyres_failed_queue_length', 'gauge', 'Jobs in the failed queue.',
+             [({}, snapshot.failed_jobs)]),
+            ('pyres_delayed_timestamps', 'gauge', 'Timestamps with delayed jobs scheduled.',
+             [({}, snapshot.delayed_timestamps)]),
+            ('pyres_workers', 'gauge', 'Registered workers.', [({}, snapshot.workers)]),
+            ('pyres_minions', 'gauge', 'Registered minions.', [({}, snapshot.minions)]),
+            ('pyres_khans', 'gauge', 'Registered managers.', [({}, snapshot.khans)]),
+        ]
+
+        queue_processed = []
+        queue_failed = []
+        histograms = {'wait': [], 'run': []}
+        for queue, data in zip(queues, totals):
+            data = dict((_text(k), v) for k, v in (data or {}).items())
+            if not data:
+                continue
+            labels = {'queue': queue}
+            queue_processed.append((labels, _number(data.get('processed'))))
+            queue_failed.append((labels, _number(data.get('failed'))))
+            for name, samples in histograms.items():
+                samples.extend(self._histogram(labels, name, data))
+        families.extend([
+            ('pyres_queue_jobs_processed_total', 'counter',
+             'Jobs performed from the queue.', queue_processed),
+            ('pyres_queue_jobs_failed_total', 'counter',
+             'Jobs from the queue that failed.', queue_failed),
+            ('pyres_job_wait_seconds', 'histogram',
+             'Time jobs waited in the queue before being performed.', histograms['wait']),
+            ('pyres_job_run_seconds', 'histogram',
+             'Time jobs took to perform.', histograms['run']),
+        ])
+        return families
+
+    def _histogram(self, labels, name, data):
+        samples = []
+        count = 0
+        for le in metrics.BUCKETS:
+            count += _number(data.get('%s:%s' % (name, le)))
+            if le == 'inf':
+                bound = '+Inf'
+            else:
+                bound = repr(le / 1000.0)
+            samples.append((dict(labels, le=bound), count, '_bucket'))
+        samples.append((labels, _number(data.get('%s_sum' % name)) / 1000.0, '_sum'))
+        samples.append((labels, count, '_count'))
+        return samples
+
+    def render(self):
+        """Returns the metrics in the text exposition format, served from
+        the cache while it is younger than ``cache_ttl`` seconds."""
+        with self._lock:
+            now = time.time()
+            if self._cache is None or now - self._cached_at >= self.cache_ttl:
+                self._cache = self._format(self.collect())
+                self._cached_at = now
+            return self._cache
+
+    def _format(self, families):
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample in samples:
+                labels, value = sample[:2]
+                suffix = sample[2] if len(sample) > 2 else ''
+                if labels:
+                    label_str = ','.join('%s="%s"' % (k, _escape(v))
+                                         for k, v in sorted(labels.items()))
+                    lines.append('%s%s{%s} %s' % (name, suffix, label_str, value))
+                else:
+                    lines.append('%s%s %s' % (name, suffix, value))
+        return '\n'.join(lines) + '\n'
+
+    def make_server(self, host='', port=9123):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                try:
+                    body = exporter.render().encode('utf-8')
+                except Exception:
+                    logger.exception('failed to collect metrics')
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return HTTPServer((host, port), Handler)
+
+    def serve(self, host='', port=9123):
+        """Serves ``/metrics`` on ``host``:``port`` until interrupted."""
+        server = self.make_server(host, port)
+        logger.info('serving metrics on %s:%s' % (host, port))
+        server.serve_forever()
+
+    def start(self, host='', port=9123):
+        """Serves ``/metrics`` from a daemon thread and returns the server,
+        whose ``shutdown`` method stops it."""
+        server = self.make_server(host, port)
+        thread = threading.Thread(target=server.serve_forever, name='pyres-exporter')
+        thread.daemon = True
+        thread.start()
+        logger.info('serving metrics on %s:%s' % (host, port))
+        return server
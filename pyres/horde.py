@@ -5,16 +5,22 @@ except:
     sys.exit("multiprocessing was not available")
 
 import time, os, signal
+import errno
+import itertools
+import threading
 import datetime
+from collections import deque
 import logging
 import logging.handlers
-from pyres import ResQ, Stat, get_logging_handler, special_log_file
+from pyres import ResQ, Stat, StatBuffer, get_logging_handler, special_log_file, preload_classes
+from pyres import metrics, profiling
 from pyres.exceptions import NoQueueError
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 from pyres.job import Job
+from pyres.queues import QueueSelector, parse_queues
 from pyres.compat import string_types
 import pyres.json_parser as json
 try:
@@ -32,9 +38,18 @@ def setup_logging(procname, namespace='', log_level=logging.INFO, log_file=None)
     logger.addHandler(handler)
     return logger
 
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
 class Minion(multiprocessing.Process):
     def __init__(self, queues, server, password, log_level=logging.INFO, log_path=None, interval=5, concat_logs=False,
-                 max_jobs=0):
+                 max_jobs=0, prefetch=1, reliable=False, threads=1, queue_policy=None,
+                 stats_flush_interval=None, stats_flush_jobs=None, profile_rate=None,
+                 profile_dir=None, record_metrics=False):
         multiprocessing.Process.__init__(self, name='Minion')
 
         #format = '%(asctime)s %(levelname)s %(filename)s-%(lineno)d: %(message)s'
@@ -44,7 +59,8 @@ class Minion(multiprocessing.Process):
         #self.logger.addHandler(logHandler)
         #self.logger.setLevel(logging.DEBUG)
 
-        self.queues = queues
+        self.queues, weights = parse_queues(queues)
+        self.queue_selector = QueueSelector(self.queues, weights, queue_policy)
         self._shutdown = False
         self.hostname = os.uname()[1]
         self.server = server
@@ -56,6 +72,18 @@ class Minion(multiprocessing.Process):
         self.log_file = None
         self.concat_logs = concat_logs
         self.max_jobs = max_jobs
+        self.prefetch = prefetch
+        self._prefetched = deque()
+        self.reliable = reliable
+        self.threads = threads
+        self.stats_flush_interval = stats_flush_interval
+        self.stats_flush_jobs = stats_flush_jobs
+        self.stats = None
+        self.profiler = None
+        if profile_rate:
+            self.profiler = profiling.Profiler(profile_rate, profile_dir)
+        # record wait and run times in the ``pyres.metrics`` histograms
+        self.record_metrics = record_metrics
 
     def prune_dead_workers(self):
         pass
@@ -80,29 +108,73 @@ class Minion(multiprocessing.Process):
     def __str__(self):
         return '%s:%s:%s' % (self.hostname, self.pid, ','.join(self.queues))
 
+    def _worker_id(self):
+        """Key used for the ``resque:minion:*`` bookkeeping of the current
+        job. When jobs run on a thread pool each thread gets its own id."""
+        index = getattr(getattr(self, '_local', None), 'index', None)
+        if index is None:
+            return str(self)
+        return '%s:%s-%s:%s' % (self.hostname, self.pid, index, ','.join(self.queues))
+
     def reserve(self):
-        self.logger.debug('checking queues: %s' % self.queues)
-        job = Job.reserve(self.queues, self.resq, self.__str__())
+        if self._prefetched:
+            job = self._prefetched.popleft()
+        elif self.prefetch > 1:
+            queues = self.queue_selector.order()
+            self.logger.debug('checking queues: %s' % queues)
+            self._prefetched.extend(Job.reserve_batch(queues, self.resq,
+                                                      self.prefetch, self.__str__(),
+                                                      reliable=self.reliable))
+            job = self._prefetched.popleft() if self._prefetched else None
+        else:
+            queues = self.queue_selector.order()
+            self.logger.debug('checking queues: %s' % queues)
+            job = Job.reserve(queues, self.resq, self.__str__(), reliable=self.reliable)
         if job:
             self.logger.info('Found job on %s' % job._queue)
             return job
 
+    def _reserve(self):
+        if self.profiler:
+            return self.profiler.reserve(self.resq, self.reserve)
+        return self.reserve()
+
+    def requeue_prefetched(self):
+        if not self._prefetched:
+            return
+        jobs = list(self._prefetched)
+        self._prefetched.clear()
+        self.logger.info('returning %d prefetched jobs' % len(jobs))
+        if self.reliable:
+            self.resq.requeue_processing(str(self))
+            return
+        for queue in set(job._queue for job in jobs):
+            self.resq.push_front(queue, [job._payload for job in jobs
+                                         if job._queue == queue])
+
     def process(self, job):
         if not job:
             return
+        profile = job._profile
+        job_failed = False
         try:
-            self.working_on(job)
+            profiling.timed(profile, 'bookkeeping', self.working_on, job)
             job.perform()
         except Exception as e:
-            exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
+            job_failed = True
             self.logger.error("%s failed: %s" % (job, e))
-            job.fail(exceptionTraceback)
-            self.failed()
+            profiling.timed(profile, 'failure', self._fail, job)
         else:
             self.logger.debug("Hells yeah")
             self.logger.info('completed job: %s' % job)
         finally:
-            self.done_working()
+            profiling.timed(profile, 'bookkeeping', self.done_working, job, job_failed)
+            if profile is not None:
+                profile.record(self.resq, job)
+
+    def _fail(self, job):
+        exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
+        job.fail(exceptionTraceback)
 
     def working_on(self, job):
         setproctitle('pyres_minion:%s: working on job: %s' % (os.getppid(), job._payload))
@@ -113,21 +185,42 @@ class Minion(multiprocessing.Process):
             'payload': job._payload
         }
         data = json.dumps(data)
-        self.resq.redis["resque:minion:%s" % str(self)] = data
-        self.logger.debug("minion:%s" % str(self))
+        self.resq.redis["resque:minion:%s" % self._worker_id()] = data
+        self.logger.debug("minion:%s" % self._worker_id())
         #self.logger.debug(self.resq.redis["resque:minion:%s" % str(self)])
 
-    def failed(self):
-        Stat("failed", self.resq).incr()
+    def failed(self, pipe=None):
+        if self.stats:
+            self.stats.incr("failed")
+        else:
+            Stat("failed", self.resq).incr(pipe=pipe)
 
-    def processed(self):
-        total_processed = Stat("processed", self.resq)
-        total_processed.incr()
+    def processed(self, pipe=None):
+        if self.stats:
+            self.stats.incr("processed")
+        else:
+            total_processed = Stat("processed", self.resq)
+            total_processed.incr(pipe=pipe)
 
-    def done_working(self):
+    def flush_stats(self):
+        """Writes out any buffered stats now."""
+        if self.stats:
+            self.stats.flush()
+
+    def done_working(self, job=None, failed=False):
         self.logger.debug('done working')
-        self.processed()
-        self.resq.redis.delete("resque:minion:%s" % str(self))
+        pipe = self.resq.redis.pipeline(transaction=False)
+        if failed:
+            self.failed(pipe)
+        self.processed(pipe)
+        pipe.delete("resque:minion:%s" % self._worker_id())
+        if self.record_metrics and job and job.perform_timestamp:
+            metrics.record_job(pipe, job, failed)
+        if self.stats:
+            self.stats.flush_if_due(pipe)
+        pipe.execute()
+        if job:
+            job.ack()
 
     def unregister_minion(self):
         self.resq.redis.srem('resque:minions',str(self))
@@ -135,7 +228,17 @@ class Minion(multiprocessing.Process):
 
     def work(self, interval=5):
 
+        self._local = threading.local()
         self.startup()
+        if self.threads > 1:
+            self._work_threaded(interval)
+        else:
+            self._work(interval)
+        self.requeue_prefetched()
+        self.flush_stats()
+        self.unregister_minion()
+
+    def _work(self, interval):
         cur_job = 0
         while True:
             setproctitle('pyres_minion:%s: waiting for job on: %s' % (os.getppid(),self.queues))
@@ -149,15 +252,68 @@ class Minion(multiprocessing.Process):
                 self.logger.debug('minion sleeping for: %d secs' % interval)
                 time.sleep(interval)
                 cur_job = 0
-            job = self.reserve()
+            job = self._reserve()
             if job:
                 self.process(job)
                 cur_job = cur_job + 1
             else:
                 cur_job = 0
+                if self.stats:
+                    self.stats.flush_if_due()
                 self.logger.debug('minion sleeping for: %d secs' % interval)
                 time.sleep(interval)
-        self.unregister_minion()
+
+    def _work_threaded(self, interval):
+        """Reserve jobs in the main thread and perform them on a pool of
+        ``threads`` threads. A job is only reserved once a thread is free
+        to run it."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        slots = threading.BoundedSemaphore(self.threads)
+        indexes = itertools.count()
+        thread_ids = []
+
+        def perform(job):
+            if getattr(self._local, 'index', None) is None:
+                # register the thread so its jobs show up like a minion's
+                self._local.index = next(indexes)
+                thread_ids.append(self._worker_id())
+                self.resq.redis.sadd('resque:minions', thread_ids[-1])
+            try:
+                self.process(job)
+            finally:
+                slots.release()
+
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        cur_job = 0
+        try:
+            while True:
+                setproctitle('pyres_minion:%s: waiting for job on: %s' % (os.getppid(),self.queues))
+                slots.acquire()
+                if self._shutdown:
+                    self.logger.info('shutdown scheduled')
+                    slots.release()
+                    break
+                if (self.max_jobs > 0 and self.max_jobs < cur_job):
+                    self.logger.debug('max_jobs reached on %s: %d' % (self.pid, cur_job))
+                    time.sleep(interval)
+                    cur_job = 0
+                job = self._reserve()
+                if job:
+                    executor.submit(perform, job)
+                    cur_job = cur_job + 1
+                else:
+                    slots.release()
+                    cur_job = 0
+                    if self.stats:
+                        self.stats.flush_if_due()
+                    self.logger.debug('minion sleeping for: %d secs' % interval)
+                    time.sleep(interval)
+        finally:
+            self.logger.info('waiting for running jobs to finish')
+            executor.shutdown(wait=True)
+            if thread_ids:
+                self.resq.redis.srem('resque:minions', *thread_ids)
 
     def clear_logger(self):
         for handler in self.logger.handlers:
@@ -181,7 +337,10 @@ class Minion(multiprocessing.Process):
             self.resq = self.server
         else:
             raise Exception("Bad server argument")
-
+        self.queue_selector.resq = self.resq
+        if self.stats_flush_interval is not None or self.stats_flush_jobs is not None:
+            self.stats = StatBuffer(self.resq, self.stats_flush_interval,
+                                    self.stats_flush_jobs)
 
         self.work(self.interval)
         #while True:
@@ -196,7 +355,10 @@ class Khan(object):
         'SHUTDOWN': '_schedule_shutdown'
     }
     def __init__(self, pool_size=5, queues=[], server='localhost:6379', password=None, logging_level=logging.INFO,
-            log_file=None, minions_interval=5, concat_minions_logs=False, max_jobs=0):
+            log_file=None, minions_interval=5, concat_minions_logs=False, max_jobs=0, prefetch=1,
+            reliable=False, threads=1, queue_policy=None, stats_flush_interval=None,
+            stats_flush_jobs=None, metrics_port=None, profile_rate=None, profile_dir=None,
+            preload=None, record_metrics=False):
         #super(Khan,self).__init__(queues=queues,server=server,password=password)
         self._shutdown = False
         self.pool_size = int(pool_size)
@@ -213,6 +375,18 @@ class Khan(object):
         self.minions_interval = minions_interval
         self.concat_minions_logs = concat_minions_logs
         self.max_jobs = max_jobs
+        self.prefetch = prefetch
+        self.reliable = reliable
+        self.threads = threads
+        self.queue_policy = queue_policy
+        self.stats_flush_interval = stats_flush_interval
+        self.stats_flush_jobs = stats_flush_jobs
+        self.metrics_port = metrics_port
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.preload = preload
+        self.record_metrics = record_metrics
+        self._metrics_server = None
 
         #self._workers = list()
 
@@ -329,7 +503,11 @@ class Khan(object):
             log_path = None
         m = Minion(self.queues, self.server, self.password, interval=self.minions_interval,
                    log_level=self.logging_level, log_path=log_path, concat_logs=self.concat_minions_logs,
-                   max_jobs=self.max_jobs)
+                   max_jobs=self.max_jobs, prefetch=self.prefetch, reliable=self.reliable,
+                   threads=self.threads, queue_policy=self.queue_policy,
+                   stats_flush_interval=self.stats_flush_interval,
+                   stats_flush_jobs=self.stats_flush_jobs, profile_rate=self.profile_rate,
+                   profile_dir=self.profile_dir, record_metrics=self.record_metrics)
         m.start()
         self._workers[m.pid] = m
         if hasattr(self,'logger'):
@@ -355,6 +533,31 @@ class Khan(object):
         self.resq.redis.sadd('resque:khans',str(self))
         return m
 
+    def prune_dead_minions(self):
+        """Requeue the in-flight jobs of minions on this host that died
+        without unregistering, e.g. because they were SIGKILLed."""
+        hostname = os.uname()[1]
+        for minion in [m.decode() for m in self.resq.redis.smembers('resque:minions')]:
+            host, pid, queues = minion.split(':', 2)
+            # the threads of a minion are registered as <pid>-<index>
+            if host != hostname or _pid_alive(int(pid.split('-')[0])):
+                continue
+            self.logger.warning('pruning dead minion: %s' % minion)
+            requeued = self.resq.requeue_processing(minion)
+            if requeued:
+                self.logger.warning('requeued %d in-flight jobs of %s' % (requeued, minion))
+            self.resq.redis.srem('resque:minions', minion)
+            self.resq.redis.delete('resque:minion:%s' % minion)
+
+    def _reap_minions(self):
+        """Replace minions that exited on their own and recover their jobs."""
+        for pid, m in list(self._workers.items()):
+            if not m.is_alive():
+                self.logger.warning('minion %s exited with code %s' % (pid, m.exitcode))
+                del self._workers[pid]
+                self._add_minion()
+        self.prune_dead_minions()
+
     def unregister_khan(self):
         if hasattr(self,'logger'):
             self.logger.debug('unregistering khan')
@@ -371,6 +574,9 @@ class Khan(object):
     def work(self, interval=2):
         setproctitle('pyres_manager: Starting')
         self.startup()
+        if self.preload:
+            # import job classes before forking so minions share them
+            preload_classes(self.preload)
         self.setup_minions()
         self._setup_logging()
         self.logger.info('Running as pid: %s' % self.pid)
@@ -378,9 +584,16 @@ class Khan(object):
         self.logger.info('Setting up pyres connection')
         self.setup_resq()
         self.register_khan()
+        if self.reliable:
+            self.prune_dead_minions()
+        if self.metrics_port:
+            from pyres.exporter import Exporter
+            self._metrics_server = Exporter(self.resq).start(port=self.metrics_port)
         setproctitle('pyres_manager: running %s' % self.queues)
         while True:
             self._check_commands()
+            if self.reliable and not self._shutdown:
+                self._reap_minions()
             if self._shutdown:
                 #send signals to each child
                 self._shutdown_minions()
@@ -389,6 +602,8 @@ class Khan(object):
             else:
                 self.logger.debug('manager sleeping for: %d secs' % interval)
                 time.sleep(interval)
+        if self._metrics_server:
+            self._metrics_server.shutdown()
         self.unregister_khan()
 
     def __str__(self):
@@ -397,10 +612,17 @@ class Khan(object):
 
     @classmethod
     def run(cls, pool_size=5, queues=[], server='localhost:6379', password=None, interval=2,
-            logging_level=logging.INFO, log_file=None, minions_interval=5, concat_minions_logs=False, max_jobs=0):
+            logging_level=logging.INFO, log_file=None, minions_interval=5, concat_minions_logs=False, max_jobs=0,
+            prefetch=1, reliable=False, threads=1, queue_policy=None, stats_flush_interval=None,
+            stats_flush_jobs=None, metrics_port=None, profile_rate=None, profile_dir=None,
+            preload=None, record_metrics=False):
         worker = cls(pool_size=pool_size, queues=queues, server=server, password=password, logging_level=logging_level,
                      log_file=log_file, minions_interval=minions_interval, concat_minions_logs=concat_minions_logs,
-                     max_jobs=max_jobs)
+                     max_jobs=max_jobs, prefetch=prefetch, reliable=reliable, threads=threads,
+                     queue_policy=queue_policy, stats_flush_interval=stats_flush_interval,
+                     stats_flush_jobs=stats_flush_jobs, metrics_port=metrics_port,
+                     profile_rate=profile_rate, profile_dir=profile_dir, preload=preload,
+                     record_metrics=record_metrics)
         worker.work(interval=interval)
 
 #if __name__ == "__main__":
@@ -1,11 +1,17 @@
 import logging
+import threading
 import time
 from datetime import timedelta
 from pyres import ResQ, safe_str_to_class
-from pyres import failure
+from pyres import failure, profiling
 from pyres.failure.redis import RedisBackend
 from pyres.compat import string_types
 
+# number of jobs currently performing per payload class, so that ``resq`` is
+# only removed from the class once the last concurrent job has finished
+_bound_classes = {}
+_bound_lock = threading.Lock()
+
 class Job(object):
     """Every job on the ResQ is an instance of the *Job* class.
 
@@ -32,8 +38,16 @@ class Job(object):
         self._payload = payload
         self.resq = resq
         self._worker = worker
+        # Set when the job was reserved in reliable mode; identifies it in
+        # the worker's in-flight list until it is acknowledged.
+        self._processing_entry = None
 
         self.enqueue_timestamp = self._payload.get("enqueue_timestamp")
+        # When ``perform`` started and how many seconds it took
+        self.perform_timestamp = None
+        self.perform_time = None
+        # A ``pyres.profiling.JobProfile`` when this job is being profiled
+        self._profile = None
 
         # Set the default back end, jobs can override when we import them
         # inside perform().
@@ -64,8 +78,9 @@ class Job(object):
 
         """
         payload_class_str = self._payload["class"]
-        payload_class = self.safe_str_to_class(payload_class_str)
-        payload_class.resq = self.resq
+        payload_class = profiling.timed(self._profile, 'import',
+                                        self.safe_str_to_class, payload_class_str)
+        self._bind_resq(payload_class)
         args = self._payload.get("args")
 
         metadata = dict(args=args)
@@ -75,11 +90,13 @@ class Job(object):
         before_perform = getattr(payload_class, "before_perform", None)
 
         metadata["failed"] = False
-        metadata["perform_timestamp"] = time.time()
+        metadata["perform_timestamp"] = self.perform_timestamp = time.time()
         check_after = True
         try:
             if before_perform:
                 payload_class.before_perform(metadata)
+            if self._profile is not None:
+                return self._profile.perform(payload_class.perform, *args)
             return payload_class.perform(*args)
         except Exception as e:
             metadata["failed"] = True
@@ -91,12 +108,26 @@ class Job(object):
                 metadata["retried"] = True
                 logging.exception("Retry scheduled after error in %s", self._payload)
         finally:
+            self.perform_time = time.time() - self.perform_timestamp
             after_perform = getattr(payload_class, "after_perform", None)
 
             if after_perform:
                 payload_class.after_perform(metadata)
 
-            delattr(payload_class,'resq')
+            self._unbind_resq(payload_class)
+
+    def _bind_resq(self, payload_class):
+        with _bound_lock:
+            payload_class.resq = self.resq
+            _bound_classes[payload_class] = _bound_classes.get(payload_class, 0) + 1
+
+    def _unbind_resq(self, payload_class):
+        with _bound_lock:
+            count = _bound_classes.pop(payload_class, 1) - 1
+            if count:
+                _bound_classes[payload_class] = count
+            else:
+                delattr(payload_class,'resq')
 
     def fail(self, exception):
         """This method provides a way to fail a job and will use whatever
@@ -128,14 +159,49 @@ class Job(object):
                 return True
         return False
 
+    def ack(self):
+        """Acknowledge a job reserved in reliable mode, removing it from the
+        worker's in-flight list."""
+        if self._processing_entry is not None:
+            self.resq.ack(self._worker, self._processing_entry)
+            self._processing_entry = None
+
     @classmethod
-    def reserve(cls, queues, res, worker=None, timeout=10):
+    def reserve(cls, queues, res, worker=None, timeout=10, reliable=False):
         """Reserve a job on one of the queues. This marks this job so
         that other workers will not pick it up.
 
+        With ``reliable`` set, the job is kept in the in-flight list of
+        ``worker`` until it is acknowledged, so that it can be requeued if
+        the worker dies while processing it.
+
         """
         if isinstance(queues, string_types):
             queues = [queues]
+        if reliable:
+            jobs = cls.reserve_batch(queues, res, 1, worker, timeout=timeout,
+                                     reliable=True)
+            return jobs[0] if jobs else None
         queue, payload = res.pop(queues, timeout=timeout)
         if payload:
             return cls(queue, payload, res, worker)
+
+    @classmethod
+    def reserve_batch(cls, queues, res, count, worker=None, timeout=10, reliable=False):
+        """Reserve up to ``count`` jobs from the highest-priority non-empty
+        queue in a single round-trip. Returns a (possibly empty) list of
+        jobs in the order they were queued.
+
+        """
+        if isinstance(queues, string_types):
+            queues = [queues]
+        if not reliable:
+            queue, payloads = res.pop_batch(queues, count, timeout=timeout)
+            return [cls(queue, payload, res, worker) for payload in payloads]
+        queue, items = res.pop_reliable(queues, worker, count, timeout=timeout)
+        jobs = []
+        for payload, entry in items:
+            job = cls(queue, payload, res, worker)
+            job._processing_entry = entry
+            jobs.append(job)
+        return jobs
@@ -43,9 +43,21 @@ class CustomJSONDecoder(json.JSONDecoder):
         return value
 
 
+_decoder = CustomJSONDecoder()
+
+
+def convert_dates(value):
+    """Converts ``@D:`` prefixed strings in a decoded value back into
+    datetimes, in place where possible."""
+    return _decoder.convert(value)
+
+
 def dumps(values):
     return json.dumps(values, cls=CustomJSONEncoder)
 
 
 def loads(string):
+    if DATE_PREFIX not in string:
+        # nothing to convert, skip walking the decoded value
+        return json.loads(string)
     return json.loads(string, cls=CustomJSONDecoder)
@@ -0,0 +1,149 @@
+"""Per-queue throughput and latency metrics.
+
+Workers record how long each job waited in its queue (from its
+``enqueue_timestamp`` until it started performing) and how long it ran.
+Both go into histograms bucketed by minute, one redis hash per queue and
+minute, ``resque:metrics:<queue>:<minute>``, holding:
+
+    ``processed``, ``failed`` -- job counts.
+
+    ``wait:<le>``, ``run:<le>`` -- the number of jobs that waited or ran for
+    at most ``<le>`` milliseconds (and more than the previous bucket's).
+
+    ``wait_sum``, ``run_sum`` -- total milliseconds, for averages.
+
+The hashes expire after ``TTL`` seconds. The same fields are also kept in
+``resque:metrics:<queue>:total`` for exporters that need ever-increasing
+counters; that hash expires once no job has been recorded on the queue for
+``TOTAL_TTL`` seconds, so totals of queues that are gone do not pile up.
+
+Recording costs about a dozen more writes per job, in the same pipeline as
+the rest of the bookkeeping, so it is off by default. Turn it on with
+``record_metrics=True`` or the ``--record-metrics`` option of the worker
+scripts. The per-minute hashes are read back with ``ResQ.metrics``::
+
+    >>> from pyres import ResQ
+    >>> ResQ().metrics('reports', window=300)['wait']['p95']
+    2500
+
+Percentiles are estimated as the upper bound of the bucket they fall in.
+
+"""
+import time
+
+from pyres.compat import text_type
+
+#: upper bounds of the histogram buckets in milliseconds; the last one
+#: catches everything slower
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+           30000, 60000, 300000, 'inf')
+
+#: seconds a minute's hash is kept for
+TTL = 24 * 60 * 60
+
+#: seconds a queue's totals are kept for after its last recorded job
+TOTAL_TTL = 7 * 24 * 60 * 60
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def key(queue, minute):
+    return 'resque:metrics:%s:%s' % (queue, minute)
+
+
+def total_key(queue):
+    return 'resque:metrics:%s:total' % queue
+
+
+def bucket(ms):
+    """Returns the upper bound of the bucket ``ms`` milliseconds fall in."""
+    for le in BUCKETS[:-1]:
+        if ms <= le:
+            return le
+    return BUCKETS[-1]
+
+
+def record(pipe, queue, wait=None, run=None, failed=False, now=None):
+    """Queues the commands recording one job on ``queue`` onto ``pipe``.
+    ``wait`` and ``run`` are in seconds and skipped when None."""
+    if now is None:
+        now = time.time()
+    minute = key(queue, int(now // 60))
+    for name in (minute, total_key(queue)):
+        pipe.hincrby(name, 'processed', 1)
+        if failed:
+            pipe.hincrby(name, 'failed', 1)
+        for field, seconds in (('wait', wait), ('run', run)):
+            if seconds is None:
+                continue
+            ms = max(seconds * 1000.0, 0)
+            pipe.hincrby(name, '%s:%s' % (field, bucket(ms)), 1)
+            pipe.hincrbyfloat(name, '%s_sum' % field, ms)
+    pipe.expire(minute, TTL)
+    pipe.expire(total_key(queue), TOTAL_TTL)
+
+
+def record_job(pipe, job, failed=False):
+    """Records a performed ``job``, see ``record``."""
+    wait = None
+    if job.enqueue_timestamp and job.perform_timestamp:
+        wait = job.perform_timestamp - job.enqueue_timestamp
+    record(pipe, job._queue, wait, job.perform_time, failed)
+
+
+def _histogram(counts, total_ms):
+    """Summarises a ``{le: count}`` histogram."""
+    count = sum(counts.values())
+    summary = {'count': count, 'mean': None}
+    for p in PERCENTILES:
+        summary['p%d' % p] = None
+    if not count:
+        return summary
+    summary['mean'] = total_ms / count
+    for p in PERCENTILES:
+        rank = count * p / 100.0
+        seen = 0
+        for le in BUCKETS:
+            seen += counts.get(le, 0)
+            if seen >= rank:
+                summary['p%d' % p] = le
+                break
+    return summary
+
+
+def minutes(window, now=None):
+    """Returns the minutes whose hashes cover the last ``window`` seconds,
+    the current one included, and the number of seconds they span."""
+    if now is None:
+        now = time.time()
+    last = int(now // 60)
+    first = last - max(int(-(-window // 60)), 1) + 1
+    return list(range(first, last + 1)), now - first * 60
+
+
+def summarize(hashes, seconds):
+    """Aggregates the per-minute ``hashes`` (as returned by HGETALL)
+    spanning ``seconds`` seconds into a dict of counts, throughput in jobs
+    per second, and ``wait``/``run`` histogram summaries in
+    milliseconds."""
+    totals = {}
+    histograms = {'wait': {}, 'run': {}}
+    for data in hashes:
+        for field, value in (data or {}).items():
+            if not isinstance(field, text_type):
+                field = field.decode('utf-8')
+            name, _, le = field.partition(':')
+            if le:
+                le = le if le == 'inf' else int(le)
+                counts = histograms[name]
+                counts[le] = counts.get(le, 0) + int(value)
+            else:
+                totals[field] = totals.get(field, 0) + float(value)
+    processed = int(totals.get('processed', 0))
+    return {
+        'processed': processed,
+        'failed': int(totals.get('failed', 0)),
+        'throughput': processed / float(max(seconds, 1)),
+        'wait': _histogram(histograms['wait'], totals.get('wait_sum', 0)),
+        'run': _histogram(histograms['run'], totals.get('run_sum', 0)),
+    }
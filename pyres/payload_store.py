@@ -0,0 +1,152 @@
+"""Claim-check storage for oversized payloads.
+
+When ``ResQ.payload_store`` is set, payloads whose encoded size (after any
+compression) reaches ``ResQ.claim_check_threshold`` bytes are written to
+the store and only a short reference such as
+``@R:redis:resque:payload:9f0c...`` is pushed to the queue. Queue lists stay
+small however large the arguments are, which keeps BLPOP, ``peek`` and
+replication fast::
+
+    >>> from pyres import ResQ
+    >>> from pyres.payload_store import RedisPayloadStore
+    >>> ResQ.payload_store = RedisPayloadStore()
+
+References are resolved when a job is reserved, and the stored body is
+deleted then, or once the job is acknowledged when it was reserved in
+reliable mode. ``peek`` and ``list_range`` resolve references without
+deleting anything.
+
+References name the store they belong to and are resolved through the
+stores registered here, so workers do not need any configuration to read
+them: ``redis`` keeps bodies in the same redis server and ``file`` in a
+directory, which must be shared by producers and workers.
+
+"""
+import logging
+import os
+import uuid
+
+from pyres.compat import binary_type
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_PREFIX = '@R:'
+
+_BINARY_REFERENCE_PREFIX = REFERENCE_PREFIX.encode('ascii')
+
+_stores = {}
+
+
+class RedisPayloadStore(object):
+    """Keeps payloads in ``resque:payload:<id>`` keys of the queue's redis
+    server, expiring after ``ttl`` seconds if given."""
+    scheme = 'redis'
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    def put(self, resq, data):
+        key = 'resque:payload:%s' % uuid.uuid4().hex
+        resq.redis.set(key, data, ex=self.ttl)
+        return key
+
+    def get(self, resq, location, delete=False):
+        if not delete:
+            return resq.redis.get(location)
+        pipe = resq.redis.pipeline(transaction=False)
+        pipe.get(location)
+        pipe.delete(location)
+        return pipe.execute()[0]
+
+    def delete(self, resq, location):
+        resq.redis.delete(location)
+
+
+class FilePayloadStore(object):
+    """Keeps payloads as files in ``directory``."""
+    scheme = 'file'
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def put(self, resq, data):
+        if isinstance(data, binary_type):
+            mode = 'wb'
+        else:
+            mode = 'w'
+        path = os.path.join(os.path.abspath(self.directory), uuid.uuid4().hex)
+        # write under a temporary name so readers never see a partial file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        return path
+
+    def get(self, resq, location, delete=False):
+        try:
+            with open(location, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if delete:
+            self.delete(resq, location)
+        return data
+
+    def delete(self, resq, location):
+        try:
+            os.remove(location)
+        except OSError:
+            pass
+
+
+def register(store):
+    """Use ``store`` to resolve references with its ``scheme``."""
+    _stores[store.scheme] = store
+
+
+def put(resq, data):
+    """Writes ``data`` to ``resq.payload_store`` and returns a reference."""
+    store = resq.payload_store
+    return '%s%s:%s' % (REFERENCE_PREFIX, store.scheme, store.put(resq, data))
+
+
+def is_reference(data):
+    if isinstance(data, binary_type):
+        return data.startswith(_BINARY_REFERENCE_PREFIX)
+    return data.startswith(REFERENCE_PREFIX)
+
+
+def _parse(reference):
+    if isinstance(reference, binary_type):
+        reference = reference.decode('utf-8')
+    scheme, _, location = reference[len(REFERENCE_PREFIX):].partition(':')
+    try:
+        return _stores[scheme], location
+    except KeyError:
+        raise ValueError("No payload store registered for %r" % reference)
+
+
+def resolve(resq, data, delete=False):
+    """Returns the payload ``data`` refers to, or ``data`` itself if it is
+    not a reference. Returns None if the stored payload no longer exists.
+
+    """
+    if not is_reference(data):
+        return data
+    store, location = _parse(data)
+    body = store.get(resq, location, delete=delete)
+    if body is None:
+        logger.error("Payload %s is missing from the %s store",
+                     location, store.scheme)
+    return body
+
+
+def delete(resq, data):
+    """Deletes the stored payload ``data`` refers to, if it is a reference."""
+    if is_reference(data):
+        store, location = _parse(data)
+        store.delete(resq, location)
+
+
+register(RedisPayloadStore())
+register(FilePayloadStore())
@@ -0,0 +1,181 @@
+"""Sampling profiler for job execution.
+
+With a ``profile_rate`` set, workers and minions time a random fraction of
+the jobs they reserve, broken down into these phases:
+
+    ``reserve`` -- popping the job from redis. This includes any time spent
+    waiting for a job to arrive, so it is only meaningful for busy queues.
+
+    ``decode`` -- decoding the payload.
+
+    ``import`` -- looking up the job class.
+
+    ``perform`` -- the job class' ``perform``.
+
+    ``failure`` -- saving the failure of a job that raised.
+
+    ``bookkeeping`` -- updating the worker state and stats.
+
+With ``prefetch`` greater than one, ``reserve`` and ``decode`` are timed
+per reservation rather than per job: the sampled job whose reservation
+fills the prefetch buffer is charged for popping and decoding the whole
+batch, and jobs taken from the buffer show next to nothing. Means over
+many samples still come out per job, individual samples do not. Use
+``prefetch=1`` when these two phases matter.
+
+The timings are summed per job class in ``resque:profile:<class>`` hashes,
+read back with ``summary``::
+
+    >>> from pyres import ResQ, profiling
+    >>> profiling.summary(ResQ())['reports.Monthly']['perform']
+    1.84
+
+When a ``profile_dir`` is given as well, ``perform`` of sampled jobs runs
+under cProfile and the stats are dumped there, one file per job, for
+``load_stats`` to merge per job class.
+
+"""
+import cProfile
+import os
+import pstats
+import random
+import time
+
+from pyres.compat import text_type
+
+PHASES = ('reserve', 'decode', 'import', 'perform', 'failure', 'bookkeeping')
+
+CLASSES_KEY = 'resque:profiles'
+
+
+def key(class_name):
+    return 'resque:profile:%s' % class_name
+
+
+def timed(profile, phase, func, *args):
+    """Returns ``func(*args)``, adding the time it took to ``phase`` of
+    ``profile`` unless ``profile`` is None."""
+    if profile is None:
+        return func(*args)
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        profile.add(phase, time.time() - start)
+
+
+class JobProfile(object):
+    """The timings of one sampled job."""
+
+    def __init__(self, profiler, timings=None):
+        self.profiler = profiler
+        self.timings = dict(timings or {})
+        self.stats = None
+
+    def add(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def perform(self, func, *args):
+        """Returns ``func(*args)``, timed as ``perform`` and run under
+        cProfile if the profiler has a ``directory``."""
+        if self.profiler.directory is None:
+            return timed(self, 'perform', func, *args)
+        self.stats = cProfile.Profile()
+        return timed(self, 'perform', self.stats.runcall, func, *args)
+
+    def record(self, resq, job):
+        """Adds these timings to the totals of the class of ``job`` and
+        dumps the cProfile stats, if any."""
+        class_name = job._payload['class']
+        pipe = resq.redis.pipeline(transaction=False)
+        pipe.sadd(CLASSES_KEY, class_name)
+        pipe.hincrby(key(class_name), 'count', 1)
+        for phase, seconds in self.timings.items():
+            pipe.hincrbyfloat(key(class_name), phase, seconds)
+        pipe.execute()
+        if self.stats is not None:
+            directory = self.profiler.directory
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, '%s.%s.%s.prof' % (
+                class_name, os.getpid(), int(time.time() * 1000000)))
+            self.stats.dump_stats(path)
+
+
+class Profiler(object):
+    """Samples ``rate`` (0 to 1) of the reserved jobs, dumping cProfile
+    stats of their ``perform`` to ``directory`` if given."""
+
+    def __init__(self, rate, directory=None):
+        self.rate = rate
+        self.directory = directory
+
+    def sample(self):
+        return random.random() < self.rate
+
+    def reserve(self, resq, reserve, *args):
+        """Returns ``reserve(*args)``. If this reservation is sampled, the
+        job is given a ``JobProfile`` with the reserve and decode times of
+        the call, which covers a whole batch when it fills a prefetch
+        buffer."""
+        if not self.sample():
+            return reserve(*args)
+        resq.measure_decode = True
+        resq.last_decode_time = 0
+        start = time.time()
+        try:
+            job = reserve(*args)
+        finally:
+            resq.measure_decode = False
+        if job is not None:
+            profile = JobProfile(self)
+            profile.add('decode', resq.last_decode_time)
+            profile.add('reserve', time.time() - start - resq.last_decode_time)
+            job._profile = profile
+        return job
+
+
+def _text(value):
+    if isinstance(value, text_type):
+        return value
+    return value.decode('utf-8')
+
+
+def summary(resq):
+    """Returns ``{class: {'count': n, phase: mean seconds, ...}}`` for every
+    profiled job class."""
+    classes = sorted(_text(c) for c in resq.redis.smembers(CLASSES_KEY))
+    pipe = resq.redis.pipeline(transaction=False)
+    for class_name in classes:
+        pipe.hgetall(key(class_name))
+    ret = {}
+    for class_name, data in zip(classes, pipe.execute()):
+        data = dict((_text(k), float(v)) for k, v in data.items())
+        count = int(data.pop('count', 0))
+        if not count:
+            continue
+        ret[class_name] = dict((phase, total / count) for phase, total in data.items())
+        ret[class_name]['count'] = count
+    return ret
+
+
+def clear(resq):
+    """Deletes the timings of every job class."""
+    classes = resq.redis.smembers(CLASSES_KEY)
+    if classes:
+        resq.redis.delete(*[key(_text(c)) for c in classes])
+    resq.redis.delete(CLASSES_KEY)
+
+
+def load_stats(directory, class_name):
+    """Merges the cProfile stats dumped for ``class_name`` into a
+    ``pstats.Stats``, or returns None if there are none."""
+    if not os.path.isdir(directory):
+        return None
+    prefix = class_name + '.'
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.startswith(prefix) and name.endswith('.prof') and
+             name[len(prefix):].count('.') == 2]
+    if not paths:
+        return None
+    return pstats.Stats(*paths)
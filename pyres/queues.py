@@ -0,0 +1,138 @@
+"""Queue polling policies.
+
+Workers are given a list of queues and pass them to BLPOP, which takes from
+the first non-empty one. The policy decides the order of that list on every
+poll:
+
+    ``strict`` -- the order the queues were given in. A backlog in the first
+    queue starves the others. This is the default.
+
+    ``weighted`` -- smooth weighted round-robin. Each queue is polled first
+    in proportion to its weight, given as ``name:weight`` (e.g.
+    ``high:5,low:1``); queues without a weight count as 1.
+
+    ``random`` -- a fresh random order on every poll.
+
+Queue names may also be shell-style patterns such as ``*`` or ``reports_*``,
+which are matched against the known queues (``ResQ.queues()``). The match
+is cached and refreshed every ``QueueSelector.refresh_interval`` seconds,
+so new queues are picked up without restarting workers. Queues matched by a
+pattern get the pattern's weight.
+
+"""
+import random
+import time
+from fnmatch import fnmatchcase
+
+from pyres.compat import string_types
+
+POLICIES = ('strict', 'weighted', 'random')
+
+
+def parse_queues(queues):
+    """Splits a comma-separated string or a list of queue names, each
+    optionally suffixed with ``:weight``, into a list of names and a dict
+    of weights.
+
+        >>> parse_queues('high:5,low')
+        (['high', 'low'], {'high': 5, 'low': 1})
+
+    """
+    if isinstance(queues, string_types):
+        queues = queues.split(',')
+    names = []
+    weights = {}
+    for queue in queues:
+        name, _, weight = queue.rpartition(':')
+        if name and weight.isdigit():
+            weights[name] = int(weight)
+        else:
+            name = queue
+            weights.setdefault(name, 1)
+        names.append(name)
+    return names, weights
+
+
+def is_pattern(queue):
+    return '*' in queue or '?' in queue or '[' in queue
+
+
+class QueueSelector(object):
+    """Orders a worker's queues for each poll according to ``policy``.
+    When no policy is given, ``weighted`` is used if any queue has a
+    weight other than 1 and ``strict`` otherwise.
+
+    ``resq`` is only needed to resolve queue patterns and may be set
+    after construction.
+
+    """
+    refresh_interval = 5
+
+    def __init__(self, queues, weights=None, policy=None, resq=None):
+        self.queues = list(queues)
+        self.resq = resq
+        self.dynamic = any(is_pattern(q) for q in self.queues)
+        self._resolved = None
+        self._resolved_at = 0
+        self.weights = dict((q, 1) for q in self.queues)
+        self.weights.update(weights or {})
+        if policy is None:
+            if any(w != 1 for w in self.weights.values()):
+                policy = 'weighted'
+            else:
+                policy = 'strict'
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy %r, expected one of %s" %
+                             (policy, ', '.join(POLICIES)))
+        self.policy = policy
+        self._current = dict((q, 0) for q in self.queues)
+
+    def active_queues(self):
+        """Returns the queues to poll, with any patterns resolved."""
+        if not self.dynamic:
+            return self.queues
+        now = time.time()
+        if self._resolved is None or now - self._resolved_at >= self.refresh_interval:
+            self._resolved = self.resolve(self.resq.queues())
+            self._resolved_at = now
+        return self._resolved
+
+    def resolve(self, known):
+        """Expands patterns against the ``known`` queue names, keeping the
+        configured order; the queues matching one pattern are sorted."""
+        known = sorted(known)
+        queues = []
+        seen = set()
+        for queue in self.queues:
+            if is_pattern(queue):
+                matches = [q for q in known if fnmatchcase(q, queue)]
+            else:
+                matches = [queue]
+            for match in matches:
+                if match not in seen:
+                    seen.add(match)
+                    queues.append(match)
+                    self.weights.setdefault(match, self.weights[queue])
+        return queues
+
+    def order(self):
+        """Returns the queues in the order they should be polled next."""
+        queues = self.active_queues()
+        if self.policy == 'random':
+            queues = list(queues)
+            random.shuffle(queues)
+            return queues
+        if self.policy == 'weighted' and queues:
+            return self._weighted_order(queues)
+        return queues
+
+    def _weighted_order(self, queues):
+        total = 0
+        for queue in queues:
+            self._current[queue] = self._current.get(queue, 0) + self.weights[queue]
+            total += self.weights[queue]
+        first = max(queues, key=lambda q: self._current[q])
+        self._current[first] -= total
+        rest = sorted((q for q in queues if q != first),
+                      key=lambda q: -self.weights[q])
+        return [first] + rest
@@ -1,26 +1,73 @@
+import os
 import signal
 import time
 import logging
 
-from pyres import ResQ, __version__
+from pyres import ResQ, DELAYED_CHANNEL, _timestamp, __version__
+from pyres import cron
 from pyres.compat import string_types
 
 logger = logging.getLogger(__name__)
 
+# KEYS[1]: lease, ARGV[1]: holder, ARGV[2]: ttl in milliseconds.
+_RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1]: lease, ARGV[1]: holder.
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 class Scheduler(object):
+    #: delayed jobs promoted per call to redis
+    batch_size = 1000
 
-    def __init__(self, server="localhost:6379", password=None):
+    def __init__(self, server="localhost:6379", password=None, max_interval=5,
+                 notify=False, lease_ttl=None, shard=0, shards=1, schedule=None):
         """
         >>> from pyres.scheduler import Scheduler
         >>> scheduler = Scheduler('localhost:6379')
+
+        The scheduler sleeps until the earliest delayed job is due, but no
+        longer than ``max_interval`` seconds. With ``notify`` set it also
+        wakes up when a job due earlier is pushed by a ``ResQ`` with
+        ``delayed_notify`` set.
+
+        With ``lease_ttl`` set, only the scheduler holding a lease of that
+        many seconds promotes jobs, so that several can run as hot
+        standbys. The lease is renewed while promoting and on every wake-up.
+
+        With ``shards`` greater than one, the scheduler only handles the
+        timestamps whose whole seconds modulo ``shards`` equal ``shard``,
+        and holds a lease of its own shard. Run one (or more, with a lease)
+        per shard to spread promotion over several processes.
+
+        ``schedule`` is a recurring schedule, see ``load_schedule``.
         """
         self._shutdown = False
+        self.max_interval = max_interval
+        self.notify = notify
+        self.lease_ttl = lease_ttl
+        self.shard = shard
+        self.shards = shards
+        self.id = '%s:%s' % (os.uname()[1], os.getpid())
+        self._leader = False
         if isinstance(server, string_types):
             self.resq = ResQ(server=server, password=password)
         elif isinstance(server, ResQ):
             self.resq = server
         else:
             raise Exception("Bad server argument")
+        self.schedule = None
+        if schedule is not None:
+            self.load_schedule(schedule)
 
     def register_signal_handlers(self):
         logger.info('registering signals')
@@ -36,17 +83,88 @@ class Scheduler(object):
         _setproctitle("Starting")
         logger.info('starting up')
         self.register_signal_handlers()
-        #self.load_schedule()
         logger.info('looking for delayed items')
-        while True:
-            if self._shutdown:
-                break
-            self.handle_delayed_items()
-            _setproctitle("Waiting")
-            logger.debug('sleeping')
-            time.sleep(5)
+        pubsub = None
+        if self.notify:
+            pubsub = self.resq.redis.pubsub()
+            pubsub.subscribe(DELAYED_CHANNEL)
+        try:
+            while True:
+                if self._shutdown:
+                    break
+                if self.lease_ttl is None or self.acquire_lease():
+                    self.handle_delayed_items()
+                    self.handle_schedule()
+                    _setproctitle("Waiting")
+                else:
+                    _setproctitle("Standing by")
+                self.wait(pubsub)
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+            self.release_lease()
         logger.info('shutting down complete')
 
+    def lease_key(self):
+        if self.shards > 1:
+            return 'resque:scheduler:lease:%s-%s' % (self.shard, self.shards)
+        return 'resque:scheduler:lease'
+
+    def acquire_lease(self):
+        """Takes or renews the lease and returns whether this scheduler
+        holds it."""
+        ttl = int(self.lease_ttl * 1000)
+        if self._leader:
+            if self.resq._script('renew_lease', _RENEW_LEASE_SCRIPT)(
+                    keys=[self.lease_key()], args=[self.id, ttl]):
+                return True
+            logger.warning('lost the scheduler lease')
+            self._leader = False
+        if self.resq.redis.set(self.lease_key(), self.id, nx=True, px=ttl):
+            logger.info('acquired the scheduler lease')
+            self._leader = True
+        return self._leader
+
+    def release_lease(self):
+        if self._leader:
+            self.resq._script('release_lease', _RELEASE_LEASE_SCRIPT)(
+                keys=[self.lease_key()], args=[self.id])
+            self._leader = False
+
+    def sleep_time(self):
+        """Seconds until the earliest delayed job is due, at most
+        ``max_interval``, and short enough to renew the lease in time."""
+        timeout = self.max_interval
+        if self.lease_ttl is not None:
+            timeout = min(timeout, self.lease_ttl / 3.0)
+        now = _timestamp(ResQ._current_time())
+        if self.schedule is not None and self.schedule.next_fire() is not None:
+            timeout = min(timeout, max(_timestamp(self.schedule.next_fire()) - now, 0))
+        due = self.resq.next_delayed_time(self.shard, self.shards)
+        if due is None:
+            return timeout
+        return min(max(due - now, 0), timeout)
+
+    def wait(self, pubsub=None):
+        """Sleeps for ``sleep_time``, or until ``pubsub`` announces a job
+        due before then."""
+        timeout = self.sleep_time()
+        logger.debug('sleeping for %.3f seconds' % timeout)
+        if pubsub is None:
+            time.sleep(timeout)
+            return
+        wake_at = _timestamp(ResQ._current_time()) + timeout
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            message = pubsub.get_message(timeout=remaining)
+            if (message and message['type'] == 'message' and
+                    self._wakes_up(float(message['data']), wake_at)):
+                logger.debug('woken up for %s' % message['data'])
+                return
+
     def next_timestamp(self):
         while True:
             timestamp = self.resq.next_delayed_timestamp()
@@ -64,24 +182,50 @@ class Scheduler(object):
             else:
                 break
 
+    def load_schedule(self, schedule):
+        """Loads the recurring jobs of ``schedule``, a dict or the path of
+        a JSON file (see ``pyres.cron``). With ``shards`` greater than one
+        only the entries whose name hashes to this shard are loaded."""
+        self.schedule = cron.CronSchedule.load(schedule, shard=self.shard,
+                                               shards=self.shards)
+        logger.info('loaded %d recurring jobs' % len(self.schedule.entries))
+
+    def handle_schedule(self):
+        """Enqueues the recurring jobs that are due."""
+        if self.schedule is None:
+            return
+        fired = self.schedule.fire(self.resq)
+        if fired:
+            logger.debug('enqueued %d recurring jobs' % fired)
+
+    def _wakes_up(self, timestamp, wake_at):
+        return (timestamp < wake_at and
+                int(timestamp) % self.shards == self.shard)
+
     def handle_delayed_items(self):
-        for timestamp in self.next_timestamp():
-            _setproctitle('Handling timestamp %s' % timestamp)
-            logger.debug('handling timestamp: %s' % timestamp)
-            for item in self.next_item(timestamp):
-                logger.debug('queueing item %s' % item)
-                klass = item['class']
-                queue = item['queue']
-                args = item['args']
-                kwargs = {}
-                if 'first_attempt' in item:
-                    kwargs['first_attempt'] = item['first_attempt']
-                self.resq.enqueue_from_string(klass, queue, *args, **kwargs)
+        """Moves every due delayed job to its queue, ``batch_size`` at a
+        time so that a large backlog does not block redis in one call.
+
+        Promotion is atomic, so a scheduler that lost its lease while
+        promoting cannot lose or duplicate jobs; it stops at the next
+        batch.
+        """
+        while True:
+            _setproctitle('Promoting delayed items')
+            moved = self.resq.promote_delayed(self.batch_size, self.shard, self.shards)
+            logger.debug('promoted %d delayed items' % moved)
+            if moved < self.batch_size:
+                break
+            if self.lease_ttl is not None and not self.acquire_lease():
+                break
 
 
     @classmethod
-    def run(cls, server, password=None):
-        sched = cls(server=server, password=password)
+    def run(cls, server, password=None, max_interval=5, notify=False, lease_ttl=None,
+            shard=0, shards=1, schedule=None):
+        sched = cls(server=server, password=password, max_interval=max_interval,
+                    notify=notify, lease_ttl=lease_ttl, shard=shard, shards=shards,
+                    schedule=schedule)
         sched()
 
 
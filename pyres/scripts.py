@@ -23,6 +23,17 @@ def pyres_manager():
     parser.add_option('-f', dest='logfile', help='If present, a logfile will be used.  "stderr", "stdout", and "syslog" are all special values.')
     parser.add_option('-p', dest='pidfile', help='If present, a pidfile will be used.')
     parser.add_option("--concat_minions_logs", action="store_true", dest="concat_minions_logs", help='Concat all minions logs on same file.')
+    parser.add_option("--prefetch", dest="prefetch", type="int", default=1, help='how many jobs each minion reserves per round-trip to redis.')
+    parser.add_option("--reliable", action="store_true", dest="reliable", default=False, help='Keep reserved jobs in a per-minion in-flight list so they are requeued if the minion dies.')
+    parser.add_option("--threads", dest="threads", type="int", default=1, help='Number of threads each minion runs jobs on. Useful for I/O bound jobs.')
+    parser.add_option("--queue-policy", dest="queue_policy", default=None, choices=['strict', 'weighted', 'random'], help='Order in which queues are polled: "strict" (as listed), "weighted" (by name:weight in the queue list) or "random". Defaults to "weighted" if any weights are given, "strict" otherwise.')
+    parser.add_option("--stats-flush-interval", dest="stats_flush_interval", type="float", default=None, help='Buffer processed/failed stats in each minion and write them to redis every this many seconds.')
+    parser.add_option("--stats-flush-jobs", dest="stats_flush_jobs", type="int", default=None, help='Buffer processed/failed stats in each minion and write them to redis after this many updates.')
+    parser.add_option("--metrics-port", dest="metrics_port", type="int", default=None, help='If present, serve Prometheus metrics on this port.')
+    parser.add_option("--record-metrics", action="store_true", dest="record_metrics", default=False, help='Record per-queue wait and run time histograms, see pyres.metrics.')
+    parser.add_option("--profile-rate", dest="profile_rate", type="float", default=None, help='Fraction (0 to 1) of jobs to time phase by phase into resque:profile:<class>. See pyres.profiling.')
+    parser.add_option("--profile-dir", dest="profile_dir", default=None, help='With --profile-rate, also run sampled jobs under cProfile and dump the stats to this directory.')
+    parser.add_option("--preload", dest="preload", default=None, help='comma separated job classes to import before forking, e.g. "jobs.Report,jobs.Mailer".')
     (options,args) = parser.parse_args()
 
     if len(args) != 1:
@@ -43,11 +54,16 @@ def pyres_manager():
         minions_interval = float(minions_interval)
 
     queues = args[0].split(',')
+    preload = options.preload and options.preload.split(',')
     server = '%s:%s' % (options.host,options.port)
     password = options.password
     Khan.run(pool_size=options.pool_size, queues=queues, server=server, password=password, interval=manager_interval,
             logging_level=log_level, log_file=options.logfile, minions_interval=minions_interval,
-            concat_minions_logs=concat_minions_logs, max_jobs=options.max_jobs)
+            concat_minions_logs=concat_minions_logs, max_jobs=options.max_jobs, prefetch=options.prefetch,
+            reliable=options.reliable, threads=options.threads, queue_policy=options.queue_policy,
+            stats_flush_interval=options.stats_flush_interval, stats_flush_jobs=options.stats_flush_jobs,
+            metrics_port=options.metrics_port, profile_rate=options.profile_rate,
+            profile_dir=options.profile_dir, preload=preload, record_metrics=options.record_metrics)
 
 
 def pyres_scheduler():
@@ -60,6 +76,11 @@ def pyres_scheduler():
     parser.add_option('-l', '--log-level', dest='log_level', default='info', help='log level.  Valid values are "debug", "info", "warning", "error", "critical", in decreasing order of verbosity. Defaults to "info" if parameter not specified.')
     parser.add_option('-f', dest='logfile', help='If present, a logfile will be used.  "stderr", "stdout", and "syslog" are all special values.')
     parser.add_option('-p', dest='pidfile', help='If present, a pidfile will be used.')
+    parser.add_option("--max-interval", dest="max_interval", type="float", default=5, help='longest time in seconds to sleep between checks for due jobs. Defaults to 5.')
+    parser.add_option("--notify", action="store_true", dest="notify", default=False, help='also wake up when a delayed job is pushed with ResQ.delayed_notify set.')
+    parser.add_option("--lease-ttl", dest="lease_ttl", type="float", default=None, help='If present, only promote jobs while holding a lease of this many seconds, so that several schedulers can run as hot standbys.')
+    parser.add_option("--schedule", dest="schedule", default=None, help='JSON file of recurring jobs to enqueue, see pyres.cron.')
+    parser.add_option("--shard", dest="shard", default=None, help='handle only part of the schedule, given as "index/count", e.g. "0/4". Timestamps are split by their whole seconds modulo count.')
     (options,args) = parser.parse_args()
     log_level = getattr(logging, options.log_level.upper(),'INFO')
     #logging.basicConfig(level=log_level, format="%(module)s: %(asctime)s: %(levelname)s: %(message)s")
@@ -67,7 +88,17 @@ def pyres_scheduler():
     setup_pidfile(options.pidfile)
     server = '%s:%s' % (options.host, options.port)
     password = options.password
-    Scheduler.run(server, password)
+    shard, shards = 0, 1
+    if options.shard:
+        try:
+            shard, shards = [int(part) for part in options.shard.split('/')]
+        except ValueError:
+            parser.error('--shard must be given as "index/count"')
+        if not 0 <= shard < shards:
+            parser.error('--shard index must be between 0 and count - 1')
+    Scheduler.run(server, password, max_interval=options.max_interval,
+                  notify=options.notify, lease_ttl=options.lease_ttl, shard=shard,
+                  shards=shards, schedule=options.schedule)
 
 
 def pyres_worker():
@@ -82,6 +113,17 @@ def pyres_worker():
     parser.add_option('-f', dest='logfile', help='If present, a logfile will be used.  "stderr", "stdout", and "syslog" are all special values.')
     parser.add_option('-p', dest='pidfile', help='If present, a pidfile will be used.')
     parser.add_option("-t", '--timeout', dest='timeout', default=None, help='the timeout in seconds for this worker')
+    parser.add_option("--prefetch", dest="prefetch", type="int", default=1, help='how many jobs to reserve per round-trip to redis.')
+    parser.add_option("--reliable", action="store_true", dest="reliable", default=False, help='Keep reserved jobs in a per-worker in-flight list so they are requeued if the worker dies.')
+    parser.add_option("--child-max-jobs", dest="child_max_jobs", type="int", default=1, help='how many jobs a forked child processes before it is replaced. Defaults to 1 (fork per job).')
+    parser.add_option("--child-max-memory", dest="child_max_memory", type="int", default=None, help='replace a forked child once its peak memory exceeds this many megabytes.')
+    parser.add_option("--queue-policy", dest="queue_policy", default=None, choices=['strict', 'weighted', 'random'], help='Order in which queues are polled: "strict" (as listed), "weighted" (by name:weight in the queue list) or "random". Defaults to "weighted" if any weights are given, "strict" otherwise.')
+    parser.add_option("--stats-flush-interval", dest="stats_flush_interval", type="float", default=None, help='Buffer processed/failed stats in the worker and write them to redis every this many seconds.')
+    parser.add_option("--stats-flush-jobs", dest="stats_flush_jobs", type="int", default=None, help='Buffer processed/failed stats in the worker and write them to redis after this many updates.')
+    parser.add_option("--record-metrics", action="store_true", dest="record_metrics", default=False, help='Record per-queue wait and run time histograms, see pyres.metrics.')
+    parser.add_option("--profile-rate", dest="profile_rate", type="float", default=None, help='Fraction (0 to 1) of jobs to time phase by phase into resque:profile:<class>. See pyres.profiling.')
+    parser.add_option("--profile-dir", dest="profile_dir", default=None, help='With --profile-rate, also run sampled jobs under cProfile and dump the stats to this directory.')
+    parser.add_option("--preload", dest="preload", default=None, help='comma separated job classes to import before forking, e.g. "jobs.Report,jobs.Mailer".')
     (options,args) = parser.parse_args()
 
     if len(args) != 1:
@@ -99,6 +141,82 @@ def pyres_worker():
     timeout = options.timeout and int(options.timeout)
 
     queues = args[0].split(',')
+    preload = options.preload and options.preload.split(',')
     server = '%s:%s' % (options.host,options.port)
     password = options.password
-    Worker.run(queues, server, password, interval, timeout=timeout)
+    Worker.run(queues, server, password, interval, timeout=timeout, prefetch=options.prefetch,
+               reliable=options.reliable, child_max_jobs=options.child_max_jobs,
+               child_max_memory=options.child_max_memory, queue_policy=options.queue_policy,
+               stats_flush_interval=options.stats_flush_interval,
+               stats_flush_jobs=options.stats_flush_jobs, profile_rate=options.profile_rate,
+               profile_dir=options.profile_dir, preload=preload,
+               record_metrics=options.record_metrics)
+
+
+def pyres_async_worker():
+    usage = "usage: %prog [options] arg1"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("--host", dest="host", default="localhost")
+    parser.add_option("--port", dest="port",type="int", default=6379)
+    parser.add_option("--password", dest="password", default=None)
+    parser.add_option("-i", '--interval', dest='interval', default=None, help='the default time interval to sleep between runs')
+    parser.add_option('-l', '--log-level', dest='log_level', default='info', help='log level.  Valid values are "debug", "info", "warning", "error", "critical", in decreasing order of verbosity. Defaults to "info" if parameter not specified.')
+    parser.add_option('-f', dest='logfile', help='If present, a logfile will be used.  "stderr", "stdout", and "syslog" are all special values.')
+    parser.add_option('-p', dest='pidfile', help='If present, a pidfile will be used.')
+    parser.add_option("-t", '--timeout', dest='timeout', default=None, help='the timeout in seconds for each job')
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int", default=100, help='how many jobs to run at the same time.')
+    parser.add_option("--queue-policy", dest="queue_policy", default=None, choices=['strict', 'weighted', 'random'], help='Order in which queues are polled: "strict" (as listed), "weighted" (by name:weight in the queue list) or "random". Defaults to "weighted" if any weights are given, "strict" otherwise.')
+    parser.add_option("--record-metrics", action="store_true", dest="record_metrics", default=False, help='Record per-queue wait and run time histograms, see pyres.metrics.')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        parser.error("Argument must be a comma seperated list of queues")
+
+    # imported here as the asyncio worker needs python 3
+    from pyres.aio import AsyncWorker
+
+    log_level = getattr(logging, options.log_level.upper(), 'INFO')
+    setup_logging(procname="pyres_async_worker", log_level=log_level, filename=options.logfile)
+    setup_pidfile(options.pidfile)
+
+    interval = options.interval
+    if interval is not None:
+        interval = int(interval)
+
+    timeout = options.timeout and int(options.timeout)
+
+    queues = args[0].split(',')
+    server = '%s:%s' % (options.host,options.port)
+    password = options.password
+    AsyncWorker.run(queues, server, password, interval, concurrency=options.concurrency,
+                    timeout=timeout, queue_policy=options.queue_policy,
+                    record_metrics=options.record_metrics)
+
+
+def pyres_exporter():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("--host", dest="host", default="localhost")
+    parser.add_option("--port", dest="port",type="int", default=6379)
+    parser.add_option("--password", dest="password", default=None)
+    parser.add_option("--listen", dest="listen", default="", help='address to serve metrics on. Defaults to all interfaces.')
+    parser.add_option("--listen-port", dest="listen_port", type="int", default=9123, help='port to serve metrics on. Defaults to 9123.')
+    parser.add_option("--cache-ttl", dest="cache_ttl", type="float", default=5, help='seconds to reuse collected metrics for. Defaults to 5.')
+    parser.add_option('-l', '--log-level', dest='log_level', default='info', help='log level.  Valid values are "debug", "info", "warning", "error", "critical", in decreasing order of verbosity. Defaults to "info" if parameter not specified.')
+    parser.add_option('-f', dest='logfile', help='If present, a logfile will be used.  "stderr", "stdout", and "syslog" are all special values.')
+    parser.add_option('-p', dest='pidfile', help='If present, a pidfile will be used.')
+    (options,args) = parser.parse_args()
+
+    log_level = getattr(logging, options.log_level.upper(), 'INFO')
+    setup_logging(procname="pyres_exporter", log_level=log_level, filename=options.logfile)
+    setup_pidfile(options.pidfile)
+
+    from pyres import ResQ
+    from pyres.exporter import Exporter
+
+    server = '%s:%s' % (options.host, options.port)
+    resq = ResQ(server=server, password=options.password)
+    Exporter(resq, cache_ttl=options.cache_ttl).serve(options.listen, options.listen_port)
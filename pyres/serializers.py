@@ -0,0 +1,149 @@
+"""Registry of the serializers ``ResQ.encode`` and ``ResQ.decode`` use for
+job payloads.
+
+Built in are:
+
+    ``json`` -- the stdlib based ``pyres.json_parser``.
+
+    ``orjson`` -- the same JSON format produced and parsed with `orjson`_,
+    registered when it is installed. Payloads it cannot parse exactly
+    (integers over 64 bits, ``NaN``/``Infinity``, lone surrogates) fall
+    back to ``json``. Note that it writes ``NaN`` and ``Infinity`` as
+    ``null``.
+
+    ``msgpack`` -- `msgpack`_, registered when it is installed. This is
+    *not* understood by resque or older pyres workers, so only use it when
+    every producer and consumer of the queues is on the same setting.
+
+All of them encode datetimes as ``@D:`` prefixed strings and only walk the
+decoded payload to convert them back when the raw data contains the prefix.
+
+``json`` is the default. To choose another one, set ``ResQ.serializer``::
+
+    >>> from pyres import ResQ
+    >>> ResQ.serializer = 'orjson'
+
+Custom serializers can be added with ``register``.
+
+.. _orjson: https://github.com/ijl/orjson
+.. _msgpack: https://msgpack.org/
+"""
+import re
+from datetime import datetime
+
+from pyres import json_parser
+from pyres.json_parser import DATE_FORMAT, DATE_PREFIX, convert_dates
+from pyres.compat import binary_type
+
+_registry = {}
+
+_BINARY_DATE_PREFIX = DATE_PREFIX.encode('ascii')
+
+
+class Serializer(object):
+    """A named pair of ``dumps``/``loads`` functions. ``loads`` must accept
+    both text and bytes, as read back from redis."""
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<Serializer %s>' % self.name
+
+
+def register(name, dumps, loads):
+    """Register a serializer under ``name``, replacing any existing one."""
+    serializer = Serializer(name, dumps, loads)
+    _registry[name] = serializer
+    return serializer
+
+
+def get(name):
+    try:
+        return _registry[name]
+    except KeyError:
+        raise ValueError("Unknown serializer %r, available: %s" %
+                         (name, ', '.join(sorted(_registry))))
+
+
+def available():
+    return sorted(_registry)
+
+
+def _has_dates(data):
+    if isinstance(data, binary_type):
+        return _BINARY_DATE_PREFIX in data
+    return DATE_PREFIX in data
+
+
+def _encode_date(o):
+    if isinstance(o, datetime):
+        return o.strftime(DATE_PREFIX + DATE_FORMAT)
+    raise TypeError("%r is not serializable" % (o,))
+
+
+def _json_loads(data):
+    if isinstance(data, binary_type):
+        data = data.decode('utf-8')
+    return json_parser.loads(data)
+
+
+register('json', json_parser.dumps, _json_loads)
+default = 'json'
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+                       orjson.OPT_PASSTHROUGH_DATACLASS)
+
+    def _orjson_dumps(values):
+        try:
+            return orjson.dumps(values, default=_encode_date,
+                                option=_ORJSON_OPTIONS).decode('utf-8')
+        except TypeError:
+            return json_parser.dumps(values)
+
+    # orjson parses integers beyond 64 bits as floats, leave any payload
+    # with a long enough run of digits to the stdlib
+    _LONG_DIGITS = re.compile(r'\d{19}')
+    _BINARY_LONG_DIGITS = re.compile(br'\d{19}')
+
+    def _orjson_loads(data):
+        if isinstance(data, binary_type):
+            if _BINARY_LONG_DIGITS.search(data):
+                return _json_loads(data)
+        elif _LONG_DIGITS.search(data):
+            return _json_loads(data)
+        try:
+            value = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. NaN written by the stdlib, which orjson rejects
+            return _json_loads(data)
+        if _has_dates(data):
+            value = convert_dates(value)
+        return value
+
+    register('orjson', _orjson_dumps, _orjson_loads)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if msgpack is not None:
+    def _msgpack_dumps(values):
+        return msgpack.packb(values, default=_encode_date, use_bin_type=True)
+
+    def _msgpack_loads(data):
+        value = msgpack.unpackb(data, raw=False, strict_map_key=False)
+        if _has_dates(data):
+            value = convert_dates(value)
+        return value
+
+    register('msgpack', _msgpack_dumps, _msgpack_loads)
@@ -5,10 +5,13 @@ import os, sys
 from pyres import json_parser as json
 from pyres.compat import commands
 import random
+from collections import deque
 
 from pyres.exceptions import NoQueueError, JobError, TimeoutError, CrashError
 from pyres.job import Job
-from pyres import ResQ, Stat, __version__
+from pyres.queues import QueueSelector, parse_queues
+from pyres import ResQ, Stat, StatBuffer, preload_classes, __version__
+from pyres import metrics, profiling
 from pyres.compat import string_types
 
 
@@ -25,14 +28,23 @@ class Worker(object):
 
     job_class = Job
 
-    def __init__(self, queues=(), server="localhost:6379", password=None, timeout=None):
-        self.queues = queues
+    def __init__(self, queues=(), server="localhost:6379", password=None, timeout=None,
+                 prefetch=1, reliable=False, child_max_jobs=1, child_max_memory=None,
+                 queue_policy=None, stats_flush_interval=None, stats_flush_jobs=None,
+                 profile_rate=None, profile_dir=None, preload=None, record_metrics=False):
+        self.queues, weights = parse_queues(queues)
         self.validate_queues()
         self._shutdown = False
         self.child = None
         self.pid = os.getpid()
         self.hostname = os.uname()[1]
         self.timeout = timeout
+        self.prefetch = prefetch
+        self._prefetched = deque()
+        self.reliable = reliable
+        self.child_max_jobs = child_max_jobs
+        self.child_max_memory = child_max_memory
+        self._child_in = self._child_out = None
 
         if isinstance(server, string_types):
             self.resq = ResQ(server=server, password=password)
@@ -40,6 +52,16 @@ class Worker(object):
             self.resq = server
         else:
             raise Exception("Bad server argument")
+        self.queue_selector = QueueSelector(self.queues, weights, queue_policy, self.resq)
+        self.stats = None
+        if stats_flush_interval is not None or stats_flush_jobs is not None:
+            self.stats = StatBuffer(self.resq, stats_flush_interval, stats_flush_jobs)
+        self.profiler = None
+        if profile_rate:
+            self.profiler = profiling.Profiler(profile_rate, profile_dir)
+        self.preload = preload
+        # record wait and run times in the ``pyres.metrics`` histograms
+        self.record_metrics = record_metrics
 
     def validate_queues(self):
         """Checks if a worker is given at least one queue to work on."""
@@ -47,9 +69,11 @@ class Worker(object):
             raise NoQueueError("Please give each worker at least one queue.")
 
     def register_worker(self):
-        self.resq.redis.sadd('resque:workers', str(self))
-        #self.resq._redis.add("worker:#{self}:started", Time.now.to_s)
-        self.started = datetime.datetime.now()
+        pipe = self.resq.redis.pipeline(transaction=False)
+        pipe.sadd('resque:workers', str(self))
+        pipe.set("resque:worker:%s:started" % self,
+                 int(time.mktime(datetime.datetime.now().timetuple())))
+        pipe.execute()
 
     def _set_started(self, dt):
         if dt:
@@ -68,10 +92,13 @@ class Worker(object):
     started = property(_get_started, _set_started)
 
     def unregister_worker(self):
-        self.resq.redis.srem('resque:workers', str(self))
-        self.started = None
-        Stat("processed:%s" % self, self.resq).clear()
-        Stat("failed:%s" % self, self.resq).clear()
+        pipe = self.resq.redis.pipeline(transaction=False)
+        pipe.srem('resque:workers', str(self))
+        pipe.delete("resque:worker:%s" % self)
+        pipe.delete("resque:worker:%s:started" % self)
+        Stat("processed:%s" % self, self.resq).clear(pipe)
+        Stat("failed:%s" % self, self.resq).clear(pipe)
+        pipe.execute()
 
     def prune_dead_workers(self):
         all_workers = Worker.all(self.resq)
@@ -80,12 +107,19 @@ class Worker(object):
             host, pid, queues = worker.id.split(':')
             if host != self.hostname:
                 continue
-            if pid in known_workers:
+            # the slots of an AsyncWorker are registered as <pid>-<slot>
+            if pid.split('-')[0] in known_workers:
                 continue
             logger.warning("pruning dead worker: %s" % worker)
+            requeued = self.resq.requeue_processing(str(worker))
+            if requeued:
+                logger.warning("requeued %d in-flight jobs of %s" % (requeued, worker))
             worker.unregister_worker()
 
     def startup(self):
+        if self.preload:
+            # import job classes before the first fork so children share them
+            preload_classes(self.preload)
         self.register_signal_handlers()
         self.prune_dead_workers()
         self.register_worker()
@@ -138,18 +172,24 @@ class Worker(object):
                 logger.info('shutdown scheduled')
                 break
 
-            self.register_worker()
-
-            job = self.reserve(interval)
+            if self.profiler:
+                job = self.profiler.reserve(self.resq, self.reserve, interval)
+            else:
+                job = self.reserve(interval)
 
             if job:
                 self.fork_worker(job)
             else:
+                if self.stats:
+                    self.stats.flush_if_due()
                 if interval == 0:
                     break
                 #procline @paused ? "Paused" : "Waiting for #{@queues.join(',')}"
                 self._setproctitle("Waiting")
                 #time.sleep(interval)
+        self.requeue_prefetched()
+        self.stop_child()
+        self.flush_stats()
         self.unregister_worker()
 
     def fork_worker(self, job):
@@ -160,41 +200,41 @@ class Worker(object):
         Finally, the ``process`` method actually processes the job by eventually calling the Job
         instance's ``perform`` method.
 
+        When ``child_max_jobs`` is greater than one the job is handed to a
+        persistent child instead, see ``fork_persistent_worker``.
+
         """
+        if self.child_max_jobs > 1:
+            return self.fork_persistent_worker(job)
         logger.debug('picked up job')
         logger.debug('job details: %s' % job)
         self.before_fork(job)
+        report_r, report_w = os.pipe()
+        started = time.time()
         self.child = os.fork()
         if self.child:
+            os.close(report_w)
             self._setproctitle("Forked %s at %s" %
                                (self.child,
                                 datetime.datetime.now()))
             logger.info('Forked %s at %s' % (self.child,
                                               datetime.datetime.now()))
 
+            job_failed = False
             try:
-                start = datetime.datetime.now()
+                deadline = None
+                if self.timeout:
+                    deadline = time.time() + self.timeout
 
                 # waits for the result or times out
                 while True:
-                    pid, status = os.waitpid(self.child, os.WNOHANG)
-                    if pid != 0:
-                        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
-                            break
-                        if os.WIFSTOPPED(status):
-                            logger.warning("Process stopped by signal %d" % os.WSTOPSIG(status))
-                        else:
-                            if os.WIFSIGNALED(status):
-                                raise CrashError("Unexpected exit by signal %d" % os.WTERMSIG(status))
-                            raise CrashError("Unexpected exit status %d" % os.WEXITSTATUS(status))
-
-                    time.sleep(0.5)
-
-                    now = datetime.datetime.now()
-                    if self.timeout and ((now - start).seconds > self.timeout):
+                    status = self._wait_for_child(deadline)
+                    if status is None:
                         os.kill(self.child, signal.SIGKILL)
-                        os.waitpid(-1, os.WNOHANG)
+                        os.waitpid(self.child, 0)
                         raise TimeoutError("Timed out after %d seconds" % self.timeout)
+                    if self._check_child_status(status):
+                        break
 
             except OSError as ose:
                 import errno
@@ -202,15 +242,29 @@ class Worker(object):
                 if ose.errno != errno.EINTR:
                     raise ose
             except JobError:
+                job_failed = True
                 self._handle_job_exception(job)
             finally:
-                # If the child process' job called os._exit manually we need to
-                # finish the clean up here.
-                if self.job():
-                    self.done_working(job)
+                # If the child process crashed or its job called os._exit
+                # manually we need to finish the clean up here.
+                report = self._read_child_report(report_r)
+                os.close(report_r)
+                if report is None:
+                    # time the job from the fork, for the metrics
+                    job.perform_timestamp = started
+                    job.perform_time = time.time() - started
+                    self.done_working(job, job_failed)
+                elif self.stats:
+                    for name, ammount in json.loads(report.decode('utf-8')).items():
+                        self.stats.incr(name, ammount)
+                    self.stats.flush_if_due()
 
             logger.debug('done waiting')
         else:
+            os.close(report_r)
+            if self.stats:
+                # only count here, the parent buffers and flushes the stats
+                self.stats = StatBuffer(self.resq, None, None)
             self._setproctitle("Processing %s since %s" %
                                (job,
                                 datetime.datetime.now()))
@@ -224,9 +278,245 @@ class Worker(object):
             random.seed()
 
             self.process(job)
+            counts = self.stats.drain() if self.stats else {}
+            os.write(report_w, json.dumps(counts).encode('utf-8'))
             os._exit(0)
         self.child = None
 
+    def _read_child_report(self, fd):
+        """Returns what the forked child wrote to ``fd`` once it was done
+        working on its job, the stats it counted, or None if it exited
+        without getting that far."""
+        import select
+
+        if not select.select([fd], [], [], 0)[0]:
+            return None
+        report = b''
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                return report or None
+            report += data
+
+    def _wait_for_child(self, deadline=None):
+        """Blocks until the child exits and returns its ``os.waitpid``
+        status, or returns None once ``deadline`` (a ``time.time()`` value)
+        has passed.
+
+        Where ``os.pidfd_open`` is available the child's exit is noticed as
+        soon as it happens by polling its pidfd; otherwise ``waitpid`` is
+        polled with a short backoff.
+
+        """
+        if deadline is None:
+            return os.waitpid(self.child, 0)[1]
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(self.child)
+            except OSError:
+                pass
+        if pidfd is not None:
+            import select
+
+            try:
+                poller = select.poll()
+                poller.register(pidfd, select.POLLIN)
+                remaining = max(deadline - time.time(), 0)
+                if not poller.poll(remaining * 1000):
+                    return None
+                return os.waitpid(self.child, 0)[1]
+            finally:
+                os.close(pidfd)
+        delay = 0.001
+        while True:
+            pid, status = os.waitpid(self.child, os.WNOHANG)
+            if pid != 0:
+                return status
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+
+    def _check_child_status(self, status):
+        """Returns True if ``status``, as returned by ``os.waitpid``, is a
+        clean exit and False if the child was only stopped. Raises
+        ``CrashError`` for any other exit."""
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            return True
+        if os.WIFSTOPPED(status):
+            logger.warning("Process stopped by signal %d" % os.WSTOPSIG(status))
+            return False
+        if os.WIFSIGNALED(status):
+            raise CrashError("Unexpected exit by signal %d" % os.WTERMSIG(status))
+        raise CrashError("Unexpected exit status %d" % os.WEXITSTATUS(status))
+
+    def fork_persistent_worker(self, job):
+        """Invoked by ``fork_worker`` when ``child_max_jobs`` is greater than
+        one. Jobs are sent over a pipe to a long-lived child, which processes
+        up to ``child_max_jobs`` of them (or until its peak memory exceeds
+        ``child_max_memory`` megabytes) before exiting, and is then replaced
+        by a fresh fork on the next job. The parent still enforces
+        ``timeout`` and treats an unexpected exit of the child as a crash of
+        the job it was working on.
+
+        ``before_fork`` and ``after_fork`` are only called when a new child
+        is started, with the first job that child processes.
+
+        """
+        logger.debug('picked up job')
+        logger.debug('job details: %s' % job)
+        if self.child and os.waitpid(self.child, os.WNOHANG)[0]:
+            # the idle child went away (e.g. SIGUSR1), start a fresh one
+            self._close_child_pipes()
+        if not self.child:
+            self._start_persistent_child(job)
+
+        entry = job._processing_entry
+        if isinstance(entry, bytes):
+            entry = entry.decode()
+        profile = job._profile and job._profile.timings
+        message = json.dumps({'queue': job._queue, 'payload': job._payload,
+                              'entry': entry, 'profile': profile})
+        job_failed = False
+        reply = None
+        started = time.time()
+        try:
+            try:
+                os.write(self._child_in, (message + '\n').encode('utf-8'))
+                reply = self._wait_for_child_reply()
+            except OSError as ose:
+                import errno
+
+                if ose.errno == errno.EPIPE:
+                    reply = b''
+                elif ose.errno == errno.EINTR:
+                    return
+                else:
+                    raise ose
+            if reply == b'recycle':
+                logger.info('recycling child %s' % self.child)
+                os.waitpid(self.child, 0)
+                self._close_child_pipes()
+            elif not reply:
+                # the child died while working on this job
+                pid, status = os.waitpid(self.child, 0)
+                self._close_child_pipes()
+                self._check_child_status(status)
+        except JobError:
+            job_failed = True
+            self._handle_job_exception(job)
+        finally:
+            # the child replies once it is done working on the job
+            if reply not in (b'ok', b'recycle'):
+                job.perform_timestamp = started
+                job.perform_time = time.time() - started
+                self.done_working(job, job_failed)
+        logger.debug('done waiting')
+
+    def _start_persistent_child(self, job):
+        self.before_fork(job)
+        job_r, job_w = os.pipe()
+        reply_r, reply_w = os.pipe()
+        self.child = os.fork()
+        if self.child:
+            os.close(job_r)
+            os.close(reply_w)
+            self._child_in, self._child_out = job_w, reply_r
+            self._setproctitle("Forked %s at %s" %
+                               (self.child,
+                                datetime.datetime.now()))
+            logger.info('Forked persistent child %s at %s' %
+                        (self.child, datetime.datetime.now()))
+        else:
+            os.close(job_w)
+            os.close(reply_r)
+            self.child = None
+            if self.stats:
+                # drop the counts still pending in the parent's buffer
+                self.stats = StatBuffer(self.resq, self.stats.flush_interval,
+                                        self.stats.flush_jobs)
+            # a non-zero exit makes the parent treat the job it sent as crashed
+            status = 1
+            try:
+                self.after_fork(job)
+                random.seed()
+                self._persistent_child_loop(job_r, reply_w)
+                self.flush_stats()
+                status = 0
+            except Exception:
+                logger.exception('persistent child %s failed' % os.getpid())
+            finally:
+                os._exit(status)
+
+    def _persistent_child_loop(self, job_fd, reply_fd):
+        jobs = os.fdopen(job_fd, 'rb')
+        processed = 0
+        while True:
+            self._setproctitle("Waiting for a job from %s" % self.pid)
+            line = jobs.readline()
+            if not line:
+                # the parent closed the pipe, it is shutting down
+                break
+            message = json.loads(line.decode('utf-8'))
+            job = self.job_class(message['queue'], message['payload'], self.resq,
+                                 self.__str__())
+            job._processing_entry = message.get('entry')
+            if message.get('profile') is not None:
+                job._profile = profiling.JobProfile(self.profiler, message['profile'])
+            self._setproctitle("Processing %s since %s" %
+                               (job,
+                                datetime.datetime.now()))
+            logger.info('Processing %s since %s' %
+                         (job, datetime.datetime.now()))
+            self.process(job)
+            processed += 1
+            if processed >= self.child_max_jobs or self._child_memory_exceeded():
+                os.write(reply_fd, b'recycle\n')
+                break
+            os.write(reply_fd, b'ok\n')
+
+    def _child_memory_exceeded(self):
+        if not self.child_max_memory:
+            return False
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            # reported in bytes rather than kilobytes
+            peak = peak / 1024
+        return peak > self.child_max_memory * 1024
+
+    def _wait_for_child_reply(self):
+        import select
+
+        ready, _, _ = select.select([self._child_out], [], [], self.timeout)
+        if not ready:
+            os.kill(self.child, signal.SIGKILL)
+            os.waitpid(self.child, 0)
+            self._close_child_pipes()
+            raise TimeoutError("Timed out after %d seconds" % self.timeout)
+        return os.read(self._child_out, 64).strip()
+
+    def _close_child_pipes(self):
+        for fd in (self._child_in, self._child_out):
+            if fd is not None:
+                os.close(fd)
+        self._child_in = self._child_out = None
+        self.child = None
+
+    def stop_child(self):
+        """Shut down the persistent child, if any, once it finishes its
+        current job."""
+        if self._child_in is None:
+            return
+        child = self.child
+        self._close_child_pipes()
+        try:
+            os.waitpid(child, 0)
+        except OSError:
+            pass
+
     def before_fork(self, job):
         """
         hook for making changes immediately before forking to process
@@ -248,39 +538,72 @@ class Worker(object):
         if not job:
             job = self.reserve()
 
+        profile = job._profile
         job_failed = False
         try:
             try:
-                self.working_on(job)
+                profiling.timed(profile, 'bookkeeping', self.working_on, job)
                 job = self.before_process(job)
                 return job.perform()
             except Exception:
                 job_failed = True
-                self._handle_job_exception(job)
+                profiling.timed(profile, 'failure', self._handle_job_exception, job)
             except SystemExit as e:
                 if e.code != 0:
                     job_failed = True
-                    self._handle_job_exception(job)
+                    profiling.timed(profile, 'failure', self._handle_job_exception, job)
 
             if not job_failed:
                 logger.debug('completed job')
                 logger.debug('job details: %s' % job)
         finally:
-            self.done_working(job)
+            profiling.timed(profile, 'bookkeeping', self.done_working, job, job_failed)
+            if profile is not None:
+                profile.record(self.resq, job)
 
     def _handle_job_exception(self, job):
+        """Logs the exception being handled and saves ``job`` as failed.
+        The failed stats are updated by ``done_working``."""
         exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
         logger.exception("%s failed: %s" % (job, exceptionValue))
         job.fail(exceptionTraceback)
-        self.failed()
 
     def reserve(self, timeout=10):
-        logger.debug('checking queues %s' % self.queues)
-        job = self.job_class.reserve(self.queues, self.resq, self.__str__(), timeout=timeout)
+        if self._prefetched:
+            job = self._prefetched.popleft()
+        elif self.prefetch > 1:
+            queues = self.queue_selector.order()
+            logger.debug('checking queues %s' % queues)
+            self._prefetched.extend(self.job_class.reserve_batch(
+                queues, self.resq, self.prefetch, self.__str__(), timeout=timeout,
+                reliable=self.reliable))
+            job = self._prefetched.popleft() if self._prefetched else None
+        else:
+            queues = self.queue_selector.order()
+            logger.debug('checking queues %s' % queues)
+            job = self.job_class.reserve(queues, self.resq, self.__str__(), timeout=timeout,
+                                         reliable=self.reliable)
         if job:
             logger.info('Found job on %s: %s' % (job._queue, job))
             return job
 
+    def requeue_prefetched(self):
+        """Push jobs that were prefetched but never processed back to the
+        head of their queue."""
+        if not self._prefetched:
+            return
+        jobs = list(self._prefetched)
+        self._prefetched.clear()
+        logger.info('returning %d prefetched jobs' % len(jobs))
+        if self.reliable:
+            # nothing is being processed at this point, so everything left
+            # in the in-flight list was prefetched
+            self.resq.requeue_processing(str(self))
+            return
+        for queue in set(job._queue for job in jobs):
+            self.resq.push_front(queue, [job._payload for job in jobs
+                                         if job._queue == queue])
+
     def working_on(self, job):
         logger.debug('marking as working on')
         data = {
@@ -289,35 +612,61 @@ class Worker(object):
             'payload': job._payload
         }
         data = json.dumps(data)
-        self.resq.redis["resque:worker:%s" % str(self)] = data
-        logger.debug("worker:%s" % str(self))
-        logger.debug(self.resq.redis["resque:worker:%s" % str(self)])
+        self.resq.redis.set("resque:worker:%s" % str(self), data)
 
-    def done_working(self, job):
+    def done_working(self, job, failed=False):
+        """Records ``job`` as processed, and as failed if ``failed`` is
+        set, and clears what the worker is working on, in one round-trip."""
         logger.debug('done working on %s', job)
-        self.processed()
-        self.resq.redis.delete("resque:worker:%s" % str(self))
+        pipe = self.resq.redis.pipeline(transaction=False)
+        if failed:
+            self.failed(pipe)
+        self.processed(pipe)
+        pipe.delete("resque:worker:%s" % str(self))
+        if self.record_metrics and job and job.perform_timestamp:
+            metrics.record_job(pipe, job, failed)
+        if self.stats:
+            self.stats.flush_if_due(pipe)
+        pipe.execute()
+        if job:
+            job.ack()
 
-    def processed(self):
-        total_processed = Stat("processed", self.resq)
-        worker_processed = Stat("processed:%s" % str(self), self.resq)
-        total_processed.incr()
-        worker_processed.incr()
+    def processed(self, pipe=None):
+        self._incr_stats("processed", pipe)
 
     def get_processed(self):
-        return Stat("processed:%s" % str(self), self.resq).get()
+        return self._get_stat("processed:%s" % self)
 
-    def failed(self):
-        Stat("failed", self.resq).incr()
-        Stat("failed:%s" % self, self.resq).incr()
+    def failed(self, pipe=None):
+        self._incr_stats("failed", pipe)
 
     def get_failed(self):
-        return Stat("failed:%s" % self, self.resq).get()
+        return self._get_stat("failed:%s" % self)
+
+    def _incr_stats(self, name, pipe=None):
+        """Increments the global and the per-worker ``name`` stat, in the
+        stats buffer when stats are buffered."""
+        for stat in (name, "%s:%s" % (name, self)):
+            if self.stats:
+                self.stats.incr(stat)
+            else:
+                Stat(stat, self.resq).incr(pipe=pipe)
+
+    def _get_stat(self, name):
+        value = Stat(name, self.resq).get()
+        if self.stats:
+            value += self.stats.pending(name)
+        return value
+
+    def flush_stats(self):
+        """Writes out any buffered stats now."""
+        if self.stats:
+            self.stats.flush()
 
     def job(self):
         data = self.resq.redis.get("resque:worker:%s" % self)
         if data:
-            return ResQ.decode(data)
+            return json.loads(data.decode())
         return {}
 
 
@@ -333,7 +682,7 @@ class Worker(object):
     def worker_pids(cls):
         """Returns an array of all pids (as strings) of the workers on
         this machine.  Used when pruning dead workers."""
-        cmd = "ps -A -o pid,command | grep pyres_worker | grep -v grep"
+        cmd = "ps -A -o pid,command | grep -E 'pyres_(async_)?worker' | grep -v grep"
         output = commands.getoutput(cmd)
         if output:
             return map(lambda l: l.strip().split(' ')[0], output.split("\n"))
@@ -341,8 +690,17 @@ class Worker(object):
             return []
 
     @classmethod
-    def run(cls, queues, server="localhost:6379", password=None, interval=None, timeout=None):
-        worker = cls(queues=queues, server=server, password=password, timeout=timeout)
+    def run(cls, queues, server="localhost:6379", password=None, interval=None, timeout=None,
+            prefetch=1, reliable=False, child_max_jobs=1, child_max_memory=None,
+            queue_policy=None, stats_flush_interval=None, stats_flush_jobs=None,
+            profile_rate=None, profile_dir=None, preload=None, record_metrics=False):
+        worker = cls(queues=queues, server=server, password=password, timeout=timeout,
+                     prefetch=prefetch, reliable=reliable, child_max_jobs=child_max_jobs,
+                     child_max_memory=child_max_memory, queue_policy=queue_policy,
+                     stats_flush_interval=stats_flush_interval,
+                     stats_flush_jobs=stats_flush_jobs, profile_rate=profile_rate,
+                     profile_dir=profile_dir, preload=preload,
+                     record_metrics=record_metrics)
         if interval is not None:
             worker.work(interval)
         else:
@@ -32,7 +32,7 @@ setup(
     maintainer='Matt George',
     license='MIT',
     url='http://github.com/binarydud/pyres',
-    packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+    packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
     download_url='http://pypi.python.org/packages/source/p/pyres/pyres-%s.tar.gz' % version,
     include_package_data=True,
     package_data={'': ['requirements.txt']},
@@ -41,6 +41,8 @@ setup(
     pyres_manager=pyres.scripts:pyres_manager
     pyres_scheduler=pyres.scripts:pyres_scheduler
     pyres_worker=pyres.scripts:pyres_worker
+    pyres_async_worker=pyres.scripts:pyres_async_worker
+    pyres_exporter=pyres.scripts:pyres_exporter
     """,
     tests_require=requires + ['pytest',],
     cmdclass={'test': PyTest},
@@ -0,0 +1,92 @@
+import asyncio
+
+from tests import PyResTests
+from pyres.aio import AsyncWorker
+from pyres.worker import Worker
+
+
+class AsyncEcho(object):
+    queue = 'basic'
+    calls = []
+
+    @staticmethod
+    async def perform(name):
+        await asyncio.sleep(0)
+        AsyncEcho.calls.append(name)
+        return name
+
+
+class AsyncError(object):
+    queue = 'basic'
+
+    @staticmethod
+    async def perform():
+        raise Exception("Could not finish job")
+
+
+class AsyncSleep(object):
+    queue = 'basic'
+
+    @staticmethod
+    async def perform(wait_for):
+        await asyncio.sleep(wait_for)
+
+
+class AsyncWorkerTests(PyResTests):
+    def run_jobs(self, worker, count):
+        async def run():
+            for slot in range(count):
+                job = await worker.reserve(1)
+                await worker.process(job, slot)
+        asyncio.run(run())
+
+    def test_process(self):
+        self.resq.enqueue(AsyncEcho, "test1")
+        worker = AsyncWorker(['basic'])
+        self.run_jobs(worker, 1)
+        assert AsyncEcho.calls == ["test1"]
+        assert self.redis.get('resque:stat:processed') == b'1'
+        assert not self.redis.get('resque:stat:failed')
+        assert not self.redis.keys('resque:worker:*')
+
+    def test_failure(self):
+        self.resq.enqueue(AsyncError)
+        worker = AsyncWorker(['basic'])
+        self.run_jobs(worker, 1)
+        assert self.redis.get('resque:stat:failed') == b'1'
+        assert self.redis.llen('resque:failed') == 1
+
+    def test_timeout(self):
+        self.resq.enqueue(AsyncSleep, 5)
+        worker = AsyncWorker(['basic'], timeout=0.2)
+        self.run_jobs(worker, 1)
+        assert self.redis.get('resque:stat:failed') == b'1'
+        assert self.redis.llen('resque:failed') == 1
+
+    def test_work_runs_jobs_concurrently(self):
+        for i in range(4):
+            self.resq.enqueue(AsyncSleep, 0.3)
+        worker = AsyncWorker(['basic'], concurrency=4)
+        async def work():
+            task = asyncio.ensure_future(worker.work(interval=1))
+            await asyncio.sleep(0.5)
+            worker.schedule_shutdown()
+            await task
+        asyncio.run(work())
+        assert self.redis.get('resque:stat:processed') == b'4'
+        assert not self.redis.sismember('resque:workers', str(worker))
+
+    def test_slots_are_registered(self):
+        self.resq.enqueue(AsyncSleep, 0.3)
+        worker = AsyncWorker(['basic'], concurrency=1)
+        async def work():
+            task = asyncio.ensure_future(worker.work(interval=1))
+            await asyncio.sleep(0.15)
+            working = Worker.working(self.resq)
+            worker.schedule_shutdown()
+            await task
+            return working
+        working = asyncio.run(work())
+        assert [str(w) for w in working] == [worker._slot_id(0)]
+        assert not self.redis.smembers('resque:workers')
+        assert not self.redis.keys('resque:worker:*')
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+from datetime import datetime
+
+from tests import PyResTests
+from pyres import cron
+from pyres.job import Job
+from pyres.scheduler import Scheduler
+
+
+class CronExpressionTests(PyResTests):
+    def next(self, expression, dt):
+        return cron.CronExpression(expression).next_after(dt)
+
+    def test_next_after(self):
+        now = datetime(2024, 1, 31, 10, 7, 30)
+        assert self.next('* * * * *', now) == datetime(2024, 1, 31, 10, 8)
+        assert self.next('*/15 * * * *', now) == datetime(2024, 1, 31, 10, 15)
+        assert self.next('5,50 9-11 * * *', now) == datetime(2024, 1, 31, 10, 50)
+        assert self.next('0 0 * * *', now) == datetime(2024, 2, 1, 0, 0)
+        assert self.next('@hourly', now) == datetime(2024, 1, 31, 11, 0)
+        assert self.next('0 12 29 feb *', now) == datetime(2024, 2, 29, 12, 0)
+        assert self.next('30 8 * * mon-fri', datetime(2024, 2, 2, 9, 0)) == datetime(2024, 2, 5, 8, 30)
+        assert self.next('0 0 * * 7', now) == datetime(2024, 2, 4, 0, 0)
+        # both day fields restricted: either one matches
+        assert self.next('0 0 15 * mon', now) == datetime(2024, 2, 5, 0, 0)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, cron.CronExpression, '* * * *')
+        self.assertRaises(ValueError, cron.CronExpression, '60 * * * *')
+        self.assertRaises(ValueError, cron.CronExpression, '* * * foo *')
+        self.assertRaises(ValueError, self.next, '0 0 30 2 *', datetime(2024, 1, 1))
+
+
+class CronScheduleTests(PyResTests):
+    schedule = {
+        'every-minute': {'cron': '* * * * *', 'class': 'tests.Basic', 'args': ['minute']},
+        'hourly': {'cron': '@hourly', 'class': 'tests.Basic', 'queue': 'other',
+                   'args': ['hour']},
+    }
+
+    def test_due(self):
+        now = datetime(2024, 1, 31, 10, 58, 30)
+        schedule = cron.CronSchedule.load(self.schedule, now)
+        assert schedule.next_fire() == datetime(2024, 1, 31, 10, 59)
+        assert schedule.due(now) == []
+        due = schedule.due(datetime(2024, 1, 31, 11, 0, 10))
+        assert [(fire_at, entry.name) for fire_at, entry in due] == [
+            (datetime(2024, 1, 31, 10, 59), 'every-minute'),
+            (datetime(2024, 1, 31, 11, 0), 'hourly')]
+        assert schedule.next_fire() == datetime(2024, 1, 31, 11, 1)
+
+    def test_fire_once(self):
+        now = datetime(2024, 1, 31, 10, 58, 30)
+        first = cron.CronSchedule.load(self.schedule, now)
+        second = cron.CronSchedule.load(self.schedule, now)
+        later = datetime(2024, 1, 31, 11, 0, 10)
+        assert first.fire(self.resq, later) == 2
+        assert second.fire(self.resq, later) == 0
+        assert self.resq.size('basic') == 1
+        job = Job.reserve(['basic'], self.resq)
+        assert job._payload['class'] == 'tests.Basic'
+        assert job._payload['args'] == ['minute']
+        assert job.enqueue_timestamp
+        assert self.resq.size('other') == 1
+        assert 'other' in self.resq.queues()
+
+    def test_invalid_entry(self):
+        self.assertRaises(ValueError, cron.CronSchedule.load,
+                          {'broken': {'class': 'tests.Basic'}})
+        self.assertRaises(ValueError, cron.CronSchedule.load,
+                          {'no-queue': {'cron': '* * * * *', 'class': 'tests.ImportTest'}})
+
+    def test_scheduler(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.schedule, f)
+            scheduler = Scheduler(self.resq, schedule=path)
+            assert len(scheduler.schedule.entries) == 2
+            assert scheduler.sleep_time() <= 60
+            sharded = [Scheduler(self.resq, shard=i, shards=2, schedule=path)
+                       for i in range(2)]
+            assert sum(len(s.schedule.entries) for s in sharded) == 2
+        finally:
+            os.remove(path)
@@ -0,0 +1,53 @@
+from tests import PyResTests, Basic, ErrorObject
+from pyres.exporter import Exporter
+from pyres.job import Job
+from pyres.worker import Worker
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+class ExporterTests(PyResTests):
+    def test_render(self):
+        self.resq.enqueue(Basic, "test1")
+        self.resq.enqueue(ErrorObject)
+        self.resq.enqueue(Basic, "test2")
+        worker = Worker(['basic'], record_metrics=True)
+        worker.register_worker()
+        worker.process(Job.reserve('basic', self.resq))
+        worker.process(Job.reserve('basic', self.resq))
+        text = Exporter(self.resq).render()
+        lines = text.splitlines()
+        assert '# TYPE pyres_queue_length gauge' in lines
+        assert 'pyres_queue_length{queue="basic"} 1' in lines
+        assert 'pyres_jobs_processed_total 2' in lines
+        assert 'pyres_jobs_failed_total 1' in lines
+        assert 'pyres_failed_queue_length 1' in lines
+        assert 'pyres_workers 1' in lines
+        assert 'pyres_delayed_timestamps 0' in lines
+        assert 'pyres_queue_jobs_processed_total{queue="basic"} 2' in lines
+        assert 'pyres_queue_jobs_failed_total{queue="basic"} 1' in lines
+        assert '# TYPE pyres_job_run_seconds histogram' in lines
+        assert 'pyres_job_run_seconds_bucket{le="+Inf",queue="basic"} 2' in lines
+        assert 'pyres_job_run_seconds_count{queue="basic"} 2' in lines
+
+    def test_cache(self):
+        exporter = Exporter(self.resq, cache_ttl=60)
+        first = exporter.render()
+        self.resq.enqueue(Basic, "test1")
+        assert exporter.render() == first
+        exporter.cache_ttl = 0
+        assert exporter.render() != first
+
+    def test_serve(self):
+        exporter = Exporter(self.resq)
+        server = exporter.start('127.0.0.1', 0)
+        try:
+            port = server.server_address[1]
+            body = urlopen('http://127.0.0.1:%s/metrics' % port).read()
+            assert b'pyres_workers 0' in body
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -1,5 +1,5 @@
 from tests import PyResTests, Basic
-from pyres import failure
+from pyres import ResQ, failure
 from pyres.job import Job
 
 class FailureTests(PyResTests):
@@ -55,3 +55,17 @@ class FailureTests(PyResTests):
             module=self.job_class.__module__,
             klass=self.job_class.__name__)
         self.assertEqual(job._payload, {'class':mod_with_class,'args':['test1'],'enqueue_timestamp': job.enqueue_timestamp})
+
+    def test_all_compressed(self):
+        ResQ.compression = 'zlib'
+        ResQ.compression_threshold = 1024
+        try:
+            self.resq.enqueue(self.job_class, "x" * 4096)
+            job = Job.reserve(self.queue_name, self.resq)
+            job.fail(Exception('problem'))
+        finally:
+            ResQ.compression = None
+            ResQ.compression_threshold = 16 * 1024
+        assert self.redis.lindex('resque:failed', 0).startswith(b'@Z:')
+        failures = failure.all(self.resq, 0, 20)
+        assert failures[0]['payload']['args'] == ['x' * 4096]
@@ -57,3 +57,50 @@ class KhanTests(PyResTests):
         assert khan.pool_size == 1
         khan._remove_minion()
         assert khan.pool_size == 0
+
+    def test_prune_dead_minions(self):
+        khan = horde.Khan(pool_size=1, queues=['basic'], reliable=True)
+        khan._setup_logging()
+        khan.setup_resq()
+        self.resq.push('basic', 'in-flight')
+        dead = '%s:%s:basic' % (os.uname()[1], 999999)
+        alive = '%s:%s:basic' % (os.uname()[1], os.getpid())
+        dead_thread = '%s:%s-0:basic' % (os.uname()[1], 999999)
+        self.resq.pop_reliable('basic', dead)
+        self.redis.sadd('resque:minions', dead)
+        self.redis.sadd('resque:minions', alive)
+        self.redis.sadd('resque:minions', dead_thread)
+        khan.prune_dead_minions()
+        assert not self.redis.sismember('resque:minions', dead)
+        assert not self.redis.sismember('resque:minions', dead_thread)
+        assert self.redis.sismember('resque:minions', alive)
+        assert self.resq.peek('basic') == ['in-flight']
+
+    def test_minion_threaded_work(self):
+        import logging, threading
+        minion = horde.Minion(['basic'], 'localhost:6379', None, threads=3)
+        minion.logger = logging.getLogger('pyres.tests')
+        minion.resq = self.resq
+        minion._local = threading.local()
+        for i in range(5):
+            self.resq.enqueue(Basic, "test%d" % i)
+        reserve = minion.reserve
+        def reserve_until_empty():
+            job = reserve()
+            if not self.resq.size('basic'):
+                minion._shutdown = True
+            return job
+        minion.reserve = reserve_until_empty
+        registered = []
+        process = minion.process
+        def process_registered(job):
+            minions = [m.decode() for m in self.redis.smembers('resque:minions')]
+            registered.append(minion._worker_id() in minions)
+            process(job)
+        minion.process = process_registered
+        minion._work_threaded(0)
+        assert self.redis.get('resque:stat:processed') == b'5'
+        assert registered and all(registered)
+        assert not self.redis.smembers('resque:minions')
+        assert not self.redis.keys('resque:minion:*')
+        assert not hasattr(Basic, 'resq')
@@ -1,5 +1,6 @@
 from datetime import datetime
-from tests import PyResTests, Basic, TestProcess, ReturnAllArgsJob
+from tests import PyResTests, Basic, BasicMulti, TestProcess, ReturnAllArgsJob
+import pyres
 from pyres.job import Job
 class JobTests(PyResTests):
     def test_reserve(self):
@@ -9,6 +10,15 @@ class JobTests(PyResTests):
         assert job._payload
         self.assertEqual(job._payload, {'class':'tests.Basic','args':['test1'],'enqueue_timestamp':job.enqueue_timestamp})
     
+    def test_reserve_batch(self):
+        self.resq.enqueue(Basic,"test1")
+        self.resq.enqueue(Basic,"test2")
+        self.resq.enqueue(Basic,"test3")
+        jobs = Job.reserve_batch('basic', self.resq, 2)
+        assert [job._payload['args'] for job in jobs] == [['test1'], ['test2']]
+        assert all(job._queue == 'basic' for job in jobs)
+        assert self.resq.size('basic') == 1
+
     def test_perform(self):
         self.resq.enqueue(Basic,"test1")
         job = Job.reserve('basic',self.resq)
@@ -30,3 +40,26 @@ class JobTests(PyResTests):
         job = Job.reserve('basic',self.resq)
         result = job.perform()
         assert result[0] == dt
+
+    def test_class_cache(self):
+        pyres.clear_class_cache()
+        size = pyres.CLASS_CACHE_SIZE
+        pyres.CLASS_CACHE_SIZE = 2
+        try:
+            assert pyres.safe_str_to_class('tests.Basic') == Basic
+            assert list(pyres._class_cache) == ['tests.Basic']
+            assert pyres.safe_str_to_class('tests.BasicMulti') == BasicMulti
+            pyres.safe_str_to_class('tests.Basic')
+            pyres.safe_str_to_class('tests.ErrorObject')
+            assert list(pyres._class_cache) == ['tests.Basic', 'tests.ErrorObject']
+            pyres.clear_class_cache('tests.Basic')
+            assert list(pyres._class_cache) == ['tests.ErrorObject']
+            pyres.clear_class_cache()
+            assert not pyres._class_cache
+        finally:
+            pyres.CLASS_CACHE_SIZE = size
+
+    def test_preload_classes(self):
+        pyres.clear_class_cache()
+        assert pyres.preload_classes(['tests.Basic', 'tests.World']) == ['tests.World']
+        assert list(pyres._class_cache) == ['tests.Basic']
@@ -0,0 +1,62 @@
+import time
+
+from tests import PyResTests, Basic, ErrorObject, TimeoutJob
+from pyres import metrics
+from pyres.job import Job
+from pyres.worker import Worker
+
+
+class MetricsTests(PyResTests):
+    def test_bucket(self):
+        assert metrics.bucket(0) == 1
+        assert metrics.bucket(1) == 1
+        assert metrics.bucket(1.5) == 2
+        assert metrics.bucket(2400) == 2500
+        assert metrics.bucket(10 ** 9) == 'inf'
+
+    def test_record(self):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for wait in (0.001, 0.002, 0.003, 2.0):
+            metrics.record(pipe, 'basic', wait=wait, run=0.02, now=now)
+        metrics.record(pipe, 'basic', failed=True, now=now)
+        pipe.execute()
+        key = metrics.key('basic', int(now // 60))
+        assert self.redis.ttl(key) > 0
+        assert self.redis.ttl(metrics.total_key('basic')) > 0
+        stats = self.resq.metrics('basic', window=60)
+        assert stats['processed'] == 5
+        assert stats['failed'] == 1
+        assert stats['wait']['count'] == 4
+        assert stats['wait']['p50'] == 2
+        assert stats['wait']['p95'] == 2500
+        assert stats['run']['p99'] == 25
+        assert 0 < stats['throughput'] <= 5
+        assert self.resq.metrics('other')['processed'] == 0
+
+    def test_worker_records_jobs(self):
+        self.resq.enqueue(Basic, "test1")
+        worker = Worker(['basic'])
+        worker.process(Job.reserve('basic', self.resq))
+        assert self.resq.metrics('basic')['processed'] == 0
+
+        self.resq.enqueue(Basic, "test1")
+        self.resq.enqueue(ErrorObject)
+        worker = Worker(['basic'], record_metrics=True)
+        worker.process(Job.reserve('basic', self.resq))
+        worker.process(Job.reserve('basic', self.resq))
+        stats = self.resq.metrics('basic')
+        assert stats['processed'] == 2
+        assert stats['failed'] == 1
+        assert stats['wait']['count'] == 2
+        assert stats['run']['count'] == 2
+
+    def test_worker_records_timeouts(self):
+        self.resq.enqueue(TimeoutJob, 2)
+        worker = Worker(['basic'], timeout=1, record_metrics=True)
+        worker.fork_worker(worker.reserve())
+        stats = self.resq.metrics('basic')
+        assert stats['processed'] == 1
+        assert stats['failed'] == 1
+        assert stats['run']['count'] == 1
+        assert stats['run']['mean'] >= 1000
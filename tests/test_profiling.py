@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+from tests import PyResTests, Basic, ErrorObject
+from pyres import profiling
+from pyres.job import Job
+from pyres.worker import Worker
+
+
+class ProfilingTests(PyResTests):
+    def tearDown(self):
+        profiling.clear(self.resq)
+        super(ProfilingTests, self).tearDown()
+
+    def test_unsampled(self):
+        profiler = profiling.Profiler(0)
+        self.resq.enqueue(Basic, "test1")
+        job = profiler.reserve(self.resq, Job.reserve, 'basic', self.resq)
+        assert job._profile is None
+        assert not self.resq.measure_decode
+
+    def test_worker_records_phases(self):
+        self.resq.enqueue(Basic, "test1")
+        self.resq.enqueue(ErrorObject)
+        worker = Worker(['basic'], profile_rate=1)
+        for i in range(2):
+            job = worker.profiler.reserve(self.resq, worker.reserve, 1)
+            assert job._profile is not None
+            worker.process(job)
+        summary = profiling.summary(self.resq)
+        assert summary['tests.Basic']['count'] == 1
+        for phase in ('reserve', 'decode', 'import', 'perform', 'bookkeeping'):
+            assert summary['tests.Basic'][phase] >= 0
+        assert 'failure' not in summary['tests.Basic']
+        assert summary['tests.ErrorObject']['failure'] > 0
+        assert not self.resq.measure_decode
+
+    def test_cprofile_dump(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.resq.enqueue(Basic, "test1")
+            self.resq.enqueue(Basic, "test2")
+            worker = Worker(['basic'], profile_rate=1, profile_dir=directory)
+            for i in range(2):
+                worker.process(worker.profiler.reserve(self.resq, worker.reserve, 1))
+            assert len(os.listdir(directory)) == 2
+            stats = profiling.load_stats(directory, 'tests.Basic')
+            assert any(func[2] == 'perform' for func in stats.stats)
+            assert profiling.load_stats(directory, 'tests') is None
+        finally:
+            shutil.rmtree(directory)
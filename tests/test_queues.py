@@ -0,0 +1,39 @@
+import unittest
+from pyres.queues import QueueSelector, parse_queues
+
+class QueueSelectorTests(unittest.TestCase):
+    def test_parse_queues(self):
+        assert parse_queues('high:5,low') == (['high', 'low'], {'high': 5, 'low': 1})
+        assert parse_queues(['basic']) == (['basic'], {'basic': 1})
+        assert parse_queues('a:b,c:2') == (['a:b', 'c'], {'a:b': 1, 'c': 2})
+
+    def test_default_policy(self):
+        assert QueueSelector(['high', 'low']).policy == 'strict'
+        assert QueueSelector(['high', 'low'], {'high': 5}).policy == 'weighted'
+        self.assertRaises(ValueError, QueueSelector, ['high'], policy='fastest')
+
+    def test_strict(self):
+        selector = QueueSelector(['high', 'low'])
+        assert selector.order() == ['high', 'low']
+        assert selector.order() == ['high', 'low']
+
+    def test_weighted(self):
+        selector = QueueSelector(['high', 'low'], {'high': 3, 'low': 1})
+        firsts = [selector.order()[0] for i in range(8)]
+        assert firsts.count('high') == 6
+        assert firsts.count('low') == 2
+        assert firsts[:4] != ['high'] * 4
+
+    def test_random(self):
+        selector = QueueSelector(['a', 'b', 'c'], policy='random')
+        orders = [tuple(selector.order()) for i in range(50)]
+        assert all(sorted(o) == ['a', 'b', 'c'] for o in orders)
+        assert len(set(orders)) > 1
+
+    def test_resolve_patterns(self):
+        selector = QueueSelector(['high', 'reports_*', '*'], {'reports_*': 3})
+        known = ['reports_b', 'low', 'high', 'reports_a']
+        assert selector.resolve(known) == ['high', 'reports_a', 'reports_b', 'low']
+        assert selector.weights['reports_a'] == 3
+        assert selector.weights['low'] == 1
+        assert QueueSelector(['reports_*']).resolve(['high']) == []
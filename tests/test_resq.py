@@ -1,8 +1,14 @@
 from tests import PyResTests, Basic, TestProcess
 from pyres import ResQ
+from pyres.payload_store import FilePayloadStore, RedisPayloadStore
 from pyres.worker import Worker
 from pyres.job import Job
 import os
+import datetime
+import shutil
+import threading
+import tempfile
+import time
 class ResQTests(PyResTests):
     def test_enqueue(self):
         self.resq.enqueue(Basic,"test1")
@@ -11,6 +17,25 @@ class ResQTests(PyResTests):
         assert self.redis.llen("resque:queue:basic") == 3
         assert self.redis.sismember('resque:queues','basic')
 
+    def test_enqueue_many(self):
+        total = self.resq.enqueue_many(Basic, [("test%d" % i,) for i in range(25)],
+                                       batch_size=10)
+        assert total == 25
+        assert self.redis.llen("resque:queue:basic") == 25
+        assert self.redis.sismember('resque:queues','basic')
+        assert 'basic' in self.resq._watched_queues
+        job = Job.reserve('basic', self.resq)
+        assert job._payload['class'] == 'tests.Basic'
+        assert job._payload['args'] == ['test0']
+
+    def test_enqueue_many_from_string(self):
+        total = self.resq.enqueue_many_from_string('tests.BasicMulti', 'multi',
+                                                   [('a', 1), ('b', 2)])
+        assert total == 2
+        assert self.resq.size('multi') == 2
+        assert self.resq.peek('multi', 1)[0]['args'] == ['b', 2]
+        assert self.resq.enqueue_many_from_string('tests.Basic', 'multi', []) == 0
+
     def test_push(self):
         self.resq.push('pushq','content-newqueue')
         self.resq.push('pushq','content2-newqueue')
@@ -44,6 +69,61 @@ class ResQTests(PyResTests):
         assert self.redis.llen('resque:queue:pushq2') == 0
         assert self.resq.pop(['pushq1', 'pushq2'], timeout=1) == (None, None)
 
+    def test_pop_batch(self):
+        for i in range(5):
+            self.resq.push('pushq2', 'content-q2-%d' % i)
+        self.resq.push('pushq1', 'content-q1-0')
+        assert self.resq.pop_batch(['pushq1', 'pushq2'], 3) == ('pushq1', ['content-q1-0'])
+        assert self.resq.pop_batch(['pushq1', 'pushq2'], 3) == \
+            ('pushq2', ['content-q2-0', 'content-q2-1', 'content-q2-2'])
+        assert self.redis.llen('resque:queue:pushq2') == 2
+        assert self.resq.pop_batch('pushq2', 3) == ('pushq2', ['content-q2-3', 'content-q2-4'])
+        assert self.resq.pop_batch(['pushq1', 'pushq2'], 3, timeout=1) == (None, [])
+
+    def test_pop_reliable(self):
+        self.resq.push('pushq', 'content-1')
+        self.resq.push('pushq', 'content-2')
+        queue, items = self.resq.pop_reliable('pushq', 'worker-1')
+        assert queue == 'pushq'
+        assert [item for item, entry in items] == ['content-1']
+        assert self.redis.llen('resque:processing:worker-1:moved') == 1
+        self.resq.ack('worker-1', items[0][1])
+        assert self.redis.llen('resque:processing:worker-1:moved') == 0
+        start = time.time()
+        assert self.resq.pop_reliable(['emptyq'], 'worker-1', timeout=1) == (None, [])
+        assert time.time() - start >= 0.9
+        queue, items = self.resq.pop_reliable(['emptyq', 'pushq'], 'worker-1')
+        assert [item for item, entry in items] == ['content-2']
+        assert self.redis.llen('resque:processing:worker-1') == 1
+        self.resq.ack('worker-1', items[0][1])
+        assert self.redis.llen('resque:processing:worker-1') == 0
+        assert self.resq.pop_reliable(['emptyq', 'pushq'], 'worker-1', timeout=0.2) == (None, [])
+
+    def test_pop_reliable_blocks(self):
+        push = threading.Timer(0.2, self.resq.push, ('pushq', 'content-1'))
+        push.start()
+        queue, items = self.resq.pop_reliable('pushq', 'worker-1', timeout=5)
+        assert [item for item, entry in items] == ['content-1']
+
+    def test_requeue_processing(self):
+        for i in range(3):
+            self.resq.push('pushq', 'content-%d' % i)
+        self.resq.push('otherq', 'other')
+        self.resq.pop_reliable('pushq', 'worker-1', count=2)
+        self.resq.pop_reliable('otherq', 'worker-1')
+        assert self.resq.size('pushq') == 1
+        assert self.resq.requeue_processing('worker-1') == 3
+        assert not self.redis.exists('resque:processing:worker-1')
+        assert not self.redis.exists('resque:processing:worker-1:moved')
+        assert self.resq.peek('pushq', 0, 3) == ['content-0', 'content-1', 'content-2']
+        assert self.resq.peek('otherq') == ['other']
+        assert self.resq.requeue_processing('worker-1') == 0
+
+    def test_push_front(self):
+        self.resq.push('pushq', 'content-3')
+        self.resq.push_front('pushq', ['content-1', 'content-2'])
+        assert self.resq.peek('pushq', 0, 3) == ['content-1', 'content-2', 'content-3']
+
     def test_peek(self):
         self.resq.enqueue(Basic,"test1")
         self.resq.enqueue(Basic,"test2")
@@ -74,6 +154,28 @@ class ResQTests(PyResTests):
         info = self.resq.info()
         assert info['workers'] == 1
 
+    def test_snapshot(self):
+        self.resq.enqueue(Basic,"test1")
+        self.resq.enqueue(Basic,"test2")
+        self.resq.enqueue(TestProcess)
+        d = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.resq.enqueue_at(d, Basic, "test3")
+        self.resq.enqueue_at(d, Basic, "test4")
+        self.resq.enqueue_at(d + datetime.timedelta(days=1), Basic, "test5")
+        Worker(['basic']).register_worker()
+        self.redis.incr('resque:stat:processed', 7)
+        snapshot = self.resq.snapshot()
+        assert snapshot.queues == {'basic': 2, 'high': 1}
+        assert snapshot.pending == 3
+        assert snapshot.processed == 7
+        assert snapshot.failed == 0
+        assert snapshot.failed_jobs == 0
+        assert snapshot.workers == 1
+        assert snapshot.minions == 0
+        assert snapshot.delayed_timestamps == 2
+        assert snapshot.delayed_jobs == 3
+        assert self.resq.snapshot(delayed=False).delayed_jobs is None
+
     def test_workers(self):
         worker = Worker(['basic'])
         worker.register_worker()
@@ -120,3 +222,59 @@ class ResQTests(PyResTests):
 
     def test_close(self):
         self.resq.close()
+
+    def test_compression(self):
+        ResQ.compression = 'zlib'
+        ResQ.compression_threshold = 1024
+        try:
+            self.resq.enqueue(Basic, 'x' * 4096)
+            self.resq.enqueue(Basic, 'small')
+            big, small = self.redis.lrange('resque:queue:basic', 0, -1)
+            assert big.startswith(b'@Z:')
+            assert len(big) < 1024
+            assert small.startswith(b'{')
+            assert self.resq.peek('basic', 0, 2)[0]['args'] == ['x' * 4096]
+            assert self.resq.pop('basic')[1]['args'] == ['x' * 4096]
+        finally:
+            ResQ.compression = None
+            ResQ.compression_threshold = 16 * 1024
+        # compressed payloads are still read after turning compression off
+        self.resq.enqueue(Basic, 'x' * 4096)
+        assert self.resq.pop('basic')[1]['args'] == ['small']
+        assert self.resq.pop('basic')[1]['args'] == ['x' * 4096]
+
+    def test_claim_check(self):
+        ResQ.payload_store = RedisPayloadStore()
+        ResQ.claim_check_threshold = 1024
+        try:
+            self.resq.enqueue(Basic, 'x' * 4096)
+            self.resq.enqueue(Basic, 'small')
+            ref, small = self.redis.lrange('resque:queue:basic', 0, -1)
+            assert ref.startswith(b'@R:redis:resque:payload:')
+            assert small.startswith(b'{')
+            key = ref[len('@R:redis:'):]
+            assert self.redis.exists(key)
+            assert self.resq.peek('basic')[0]['args'] == ['x' * 4096]
+            assert self.resq.pop('basic')[1]['args'] == ['x' * 4096]
+            assert not self.redis.exists(key)
+        finally:
+            ResQ.payload_store = None
+            ResQ.claim_check_threshold = 256 * 1024
+
+    def test_claim_check_reliable(self):
+        directory = tempfile.mkdtemp()
+        ResQ.payload_store = FilePayloadStore(directory)
+        ResQ.claim_check_threshold = 1024
+        try:
+            self.resq.enqueue(Basic, 'x' * 4096)
+            assert len(os.listdir(directory)) == 1
+            queue, items = self.resq.pop_reliable(['basic'], 'w1', timeout=1)
+            payload, entry = items[0]
+            assert payload['args'] == ['x' * 4096]
+            assert len(os.listdir(directory)) == 1
+            self.resq.ack('w1', entry)
+            assert os.listdir(directory) == []
+        finally:
+            ResQ.payload_store = None
+            ResQ.claim_check_threshold = 256 * 1024
+            shutil.rmtree(directory)
@@ -1,8 +1,10 @@
 from tests import PyResTests, Basic, TestProcess, ErrorObject
-from pyres import ResQ
+import pyres
+from pyres import ResQ, DELAYED_CHANNEL
 from pyres.job import Job
 from pyres.scheduler import Scheduler
 import os
+import threading
 import datetime
 import time
 class ScheduleTests(PyResTests):
@@ -74,3 +76,167 @@ class ScheduleTests(PyResTests):
         scheduler.schedule_shutdown(19,'')
         assert scheduler._shutdown
         
+
+    def test_promote_delayed(self):
+        past = datetime.datetime.now() + datetime.timedelta(days=-1)
+        first = datetime.datetime(2020, 1, 1, 12, 30)
+        self.resq.enqueue_at(past, Basic, "test1")
+        self.resq.enqueue_at(past + datetime.timedelta(hours=1), Basic, "test2",
+                             first_attempt=first)
+        self.resq.enqueue_at(past + datetime.timedelta(hours=2), Basic, "test3")
+        self.resq.enqueue_at(past + datetime.timedelta(days=2), Basic, "future")
+        assert self.resq.promote_delayed(2) == 2
+        assert self.resq.promote_delayed(2) == 1
+        assert self.resq.promote_delayed(2) == 0
+        assert self.resq.delayed_queue_schedule_size() == 1
+        assert 'basic' in self.resq.queues()
+        jobs = Job.reserve_batch('basic', self.resq, 10)
+        assert [job._payload['args'] for job in jobs] == [['test1'], ['test2'], ['test3']]
+        assert all(job.enqueue_timestamp for job in jobs)
+        assert jobs[1]._payload['first_attempt'] == first
+
+    def test_promote_delayed_compressed(self):
+        ResQ.compression = 'zlib'
+        ResQ.compression_threshold = 0
+        try:
+            past = datetime.datetime.now() + datetime.timedelta(days=-1)
+            self.resq.enqueue_at(past, Basic, "x" * 4096)
+            self.resq.enqueue_at(past, Basic, "test2")
+            scheduler = Scheduler(self.resq)
+            scheduler.handle_delayed_items()
+            assert self.resq.delayed_queue_schedule_size() == 0
+            jobs = Job.reserve_batch('basic', self.resq, 10)
+            assert sorted(job._payload['args'][0] for job in jobs) == ["test2", "x" * 4096]
+        finally:
+            ResQ.compression = None
+            ResQ.compression_threshold = 16 * 1024
+
+    def test_promote_delayed_held(self):
+        past = datetime.datetime.now() + datetime.timedelta(days=-1)
+        self.resq.delayed_push(past, {'class': 'tests.Basic', 'queue': 'basic',
+                                      'args': ['stale'], 'enqueue_timestamp': 1})
+        self.resq.enqueue_at(past, Basic, "test2")
+        key = self.resq.delayed_queue_peek(0, 1)[0]
+        script = self.resq._script('promote_delayed', pyres._PROMOTE_DELAYED_SCRIPT)
+        moved, held = script(args=[repr(time.time()), repr(time.time()), 10, 1, 0, 10])
+        assert moved == 0
+        assert held == [str(key).encode()]
+        assert self.resq.delayed_timestamp_size(key) == 2
+        assert self.resq.promote_delayed() == 2
+        assert self.resq.delayed_queue_schedule_size() == 0
+        jobs = Job.reserve_batch('basic', self.resq, 10)
+        assert [job._payload['args'] for job in jobs] == [['stale'], ['test2']]
+        assert all(job.enqueue_timestamp > 1 for job in jobs)
+
+    def test_delayed_precision_ms(self):
+        ResQ.delayed_precision_ms = True
+        try:
+            d = datetime.datetime(2030, 1, 1, 12, 0, 0, 250000)
+            self.resq.enqueue_at(d, Basic, "test1")
+            self.resq.enqueue_at(d.replace(microsecond=0), Basic, "test1")
+            timestamps = self.resq.delayed_queue_peek(0, 10)
+            assert timestamps == [time.mktime(d.timetuple()), time.mktime(d.timetuple()) + 0.25]
+            assert isinstance(timestamps[0], int)
+            assert self.resq.delayed_timestamp_size(timestamps[1]) == 1
+            assert self.resq.next_delayed_time() == timestamps[0]
+            self.resq.enqueue_at(datetime.datetime.now() - datetime.timedelta(milliseconds=100),
+                                 Basic, "test2")
+            assert self.resq.promote_delayed() == 1
+            assert Job.reserve('basic', self.resq)._payload['args'] == ['test2']
+        finally:
+            ResQ.delayed_precision_ms = False
+
+    def test_scheduler_sleep_time(self):
+        scheduler = Scheduler(self.resq, max_interval=5)
+        assert scheduler.sleep_time() == 5
+        now = datetime.datetime.now()
+        self.resq.enqueue_at(now + datetime.timedelta(seconds=3), Basic, "test1")
+        assert 1 < scheduler.sleep_time() <= 3
+        self.resq.enqueue_at(now - datetime.timedelta(seconds=3), Basic, "test1")
+        assert scheduler.sleep_time() == 0
+
+    def test_scheduler_notify(self):
+        ResQ.delayed_notify = True
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe(DELAYED_CHANNEL)
+        try:
+            scheduler = Scheduler(self.resq, max_interval=0.5)
+            start = time.time()
+            self.resq.enqueue_at(datetime.datetime.now() + datetime.timedelta(days=1),
+                                 Basic, "later")
+            scheduler.wait(pubsub)
+            assert time.time() - start >= 0.5
+            scheduler.max_interval = 30
+            push = threading.Timer(0.2, self.resq.enqueue_at, (datetime.datetime.now(),
+                                                             Basic, "sooner"))
+            start = time.time()
+            push.start()
+            scheduler.wait(pubsub)
+            assert time.time() - start < 5
+        finally:
+            ResQ.delayed_notify = False
+            pubsub.close()
+
+    def test_scheduler_lease(self):
+        leader = Scheduler(self.resq, lease_ttl=10)
+        standby = Scheduler(self.resq, lease_ttl=10)
+        standby.id = 'standby'
+        assert leader.acquire_lease()
+        assert not standby.acquire_lease()
+        assert leader.acquire_lease()
+        assert 0 < self.redis.pttl(leader.lease_key()) <= 10000
+        assert leader.sleep_time() <= 10 / 3.0
+        leader.release_lease()
+        assert not self.redis.exists(leader.lease_key())
+        assert standby.acquire_lease()
+        # the lease expired and was taken over
+        self.redis.set(standby.lease_key(), leader.id)
+        assert not standby.acquire_lease()
+        standby.release_lease()
+        assert self.redis.get(standby.lease_key()) == leader.id.encode()
+
+    def test_promote_delayed_sharded(self):
+        past = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=1)
+        for i in range(6):
+            self.resq.enqueue_at(past + datetime.timedelta(seconds=i), Basic, i)
+        keys = self.resq.delayed_queue_peek(0, 10)
+        even = Scheduler(self.resq, shard=keys[0] % 2, shards=2)
+        assert self.resq.next_delayed_time(even.shard, 2) == keys[0]
+        assert self.resq.next_delayed_time(1 - even.shard, 2) == keys[1]
+        even.batch_size = 2
+        even.handle_delayed_items()
+        assert self.resq.delayed_queue_peek(0, 10) == keys[1::2]
+        assert self.resq.next_delayed_time(even.shard, 2) is None
+        assert even.sleep_time() == even.max_interval
+        jobs = Job.reserve_batch('basic', self.resq, 10)
+        assert [job._payload['args'] for job in jobs] == [[0], [2], [4]]
+        assert self.resq.promote_delayed(10, 1 - even.shard, 2, scan=0) == 0
+        assert self.resq.promote_delayed(10, 1 - even.shard, 2) == 3
+
+    def test_promote_delayed_scan(self):
+        past = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=1)
+        for i in range(5):
+            self.resq.enqueue_at(past + datetime.timedelta(seconds=2 * i), Basic, i)
+        self.resq.enqueue_at(past + datetime.timedelta(seconds=9), Basic, "odd")
+        shard = (self.resq.delayed_queue_peek(0, 1)[0] + 1) % 2
+        assert self.resq.promote_delayed(10, shard, 2, scan=3) == 0
+        assert self.resq.promote_delayed(10, shard, 2, scan=5) == 0
+        assert self.resq.promote_delayed(10, shard, 2, scan=6) == 1
+        assert self.resq.delayed_queue_schedule_size() == 5
+
+    def test_enqueue_in(self):
+        self.resq.enqueue_in(3600, Basic, "test1")
+        timestamp = self.resq.delayed_queue_peek(0, 1)[0]
+        assert 3598 <= timestamp - time.time() <= 3600
+        assert self.resq.delayed_timestamp_peek(timestamp, 0, 1)[0]['args'] == ['test1']
+
+    def test_enqueue_at_many(self):
+        d = datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(days=1)
+        items = [(d + datetime.timedelta(seconds=i % 3), [i]) for i in range(10)]
+        assert self.resq.enqueue_at_many(Basic, items, batch_size=4) == 10
+        keys = self.resq.delayed_queue_peek(0, 10)
+        assert keys == [int(time.mktime(d.timetuple())) + i for i in range(3)]
+        assert self.resq.delayed_timestamp_size(keys[0]) == 4
+        assert [item['args'] for item in self.resq.delayed_timestamp_peek(keys[1], 0, 3)] == \
+            [[1], [4], [7]]
+        assert self.resq.delayed_queue_schedule_size() == 10
@@ -0,0 +1,49 @@
+from datetime import datetime
+from tests import PyResTests, Basic
+from pyres import ResQ, serializers
+
+
+class SerializerTests(PyResTests):
+    def tearDown(self):
+        ResQ.serializer = serializers.default
+        super(SerializerTests, self).tearDown()
+
+    def test_round_trip(self):
+        payload = {'class': 'tests.Basic', 'args': ['test1', 2**70],
+                   'dt': datetime(1972, 1, 22)}
+        for name in serializers.available():
+            serializer = serializers.get(name)
+            data = serializer.dumps(payload)
+            assert serializer.loads(data) == payload
+            if not isinstance(data, bytes):
+                assert serializer.loads(data.encode('utf-8')) == payload
+
+    def test_json_compatible(self):
+        payload = {'class': 'tests.Basic', 'args': ['test1'], 'dt': datetime(2020, 1, 1, 12, 30)}
+        json = serializers.get('json')
+        for name in ('json', 'orjson'):
+            if name in serializers.available():
+                serializer = serializers.get(name)
+                assert json.loads(serializer.dumps(payload)) == payload
+                assert serializer.loads(json.dumps(payload)) == payload
+
+    def test_stdlib_only_values(self):
+        payload = {'class': 'tests.Basic', 'args': [float('inf'), u'\ud800']}
+        data = serializers.get('json').dumps(payload)
+        for name in ('json', 'orjson'):
+            if name in serializers.available():
+                assert serializers.get(name).loads(data) == payload
+
+    def test_unknown_serializer(self):
+        self.assertRaises(ValueError, serializers.get, 'pickle')
+
+    def test_resq_serializer(self):
+        calls = []
+        def dumps(values):
+            calls.append(values)
+            return serializers.get('json').dumps(values)
+        serializers.register('counting', dumps, serializers.get('json').loads)
+        ResQ.serializer = 'counting'
+        self.resq.enqueue(Basic, 'test1')
+        assert len(calls) == 1
+        assert self.resq.pop('basic')[1]['args'] == ['test1']
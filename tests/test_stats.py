@@ -1,5 +1,5 @@
 from tests import PyResTests
-from pyres import Stat
+from pyres import Stat, StatBuffer
 class StatTests(PyResTests):
     def test_incr(self):
         stat_obj = Stat('test_stat', self.resq)
@@ -34,3 +34,27 @@ class StatTests(PyResTests):
         assert self.redis.exists('resque:stat:test_stat')
         stat_obj.clear()
         assert not self.redis.exists('resque:stat:test_stat')
+
+    def test_buffer_flush_jobs(self):
+        stats = StatBuffer(self.resq, flush_interval=None, flush_jobs=3)
+        stats.incr('test_stat')
+        stats.incr('test_stat', 2)
+        assert not stats.due()
+        assert not self.redis.exists('resque:stat:test_stat')
+        assert stats.pending('test_stat') == 3
+        stats.incr('other_stat')
+        assert stats.due()
+        stats.flush_if_due()
+        assert self.redis.get('resque:stat:test_stat') == b'3'
+        assert self.redis.get('resque:stat:other_stat') == b'1'
+        assert stats.pending('test_stat') == 0
+        assert not stats.due()
+
+    def test_buffer_flush_interval(self):
+        stats = StatBuffer(self.resq, flush_interval=60)
+        stats.incr('test_stat')
+        assert not stats.due()
+        stats._last_flush -= 60
+        assert stats.due()
+        stats.flush()
+        assert self.redis.get('resque:stat:test_stat') == b'1'
@@ -36,8 +36,10 @@ class WorkerTests(PyResTests):
         worker.register_worker()
         name = "%s:%s:%s" % (os.uname()[1],os.getpid(),'basic')
         assert self.redis.sismember('resque:workers',name)
+        assert self.redis.exists('resque:worker:%s:started' % name)
         worker.unregister_worker()
         assert name not in self.redis.smembers('resque:workers')
+        assert not self.redis.exists('resque:worker:%s:started' % name)
 
     def test_working_on(self):
         name = "%s:%s:%s" % (os.uname()[1],os.getpid(),'basic')
@@ -75,6 +77,61 @@ class WorkerTests(PyResTests):
         assert self.redis.get("resque:stat:failed:%s" % name).decode() == str(2)
         assert worker.get_failed() == 2
 
+    def test_prefetch(self):
+        for i in range(3):
+            self.resq.enqueue(Basic, "test%d" % i)
+        worker = Worker(['basic'], prefetch=2)
+        job = worker.reserve()
+        assert job._payload['args'] == ['test0']
+        assert self.resq.size('basic') == 1
+        assert len(worker._prefetched) == 1
+        worker.requeue_prefetched()
+        assert not worker._prefetched
+        assert [p['args'] for p in self.resq.peek('basic', 0, 2)] == [['test1'], ['test2']]
+
+    def test_reliable_process_acks_job(self):
+        self.resq.enqueue(Basic, "test1")
+        worker = Worker(['basic'], reliable=True)
+        job = worker.reserve()
+        assert self.redis.llen('resque:processing:%s:moved' % worker) == 1
+        worker.process(job)
+        assert self.redis.llen('resque:processing:%s:moved' % worker) == 0
+
+    def test_prune_dead_workers_requeues_in_flight_jobs(self):
+        self.resq.enqueue(Basic, "test1")
+        dead = Worker(['basic'], reliable=True)
+        dead.pid = 999999
+        dead.register_worker()
+        dead.reserve()
+        assert self.resq.size('basic') == 0
+        worker = Worker(['basic'])
+        worker.prune_dead_workers()
+        assert not self.redis.sismember('resque:workers', str(dead))
+        assert not self.redis.exists('resque:processing:%s:moved' % dead)
+        assert self.resq.size('basic') == 1
+
+    def test_weighted_queues(self):
+        worker = Worker(['high:2', 'low'])
+        assert worker.queues == ['high', 'low']
+        assert str(worker).endswith(':high,low')
+        for i in range(3):
+            self.resq.enqueue_from_string('tests.Basic', 'high', 'h%d' % i)
+            self.resq.enqueue_from_string('tests.Basic', 'low', 'l%d' % i)
+        queues = [worker.reserve()._queue for i in range(3)]
+        assert queues.count('low') == 1
+
+    def test_wildcard_queues(self):
+        worker = Worker(['reports_*'])
+        assert worker.reserve(timeout=1) is None
+        self.resq.enqueue_from_string('tests.Basic', 'reports_acme', 'test1')
+        self.resq.enqueue_from_string('tests.Basic', 'other', 'test2')
+        # resolved queues are cached until the next refresh
+        assert worker.reserve(timeout=1) is None
+        worker.queue_selector._resolved_at = 0
+        job = worker.reserve(timeout=1)
+        assert job._queue == 'reports_acme'
+        assert worker.reserve(timeout=1) is None
+
     def test_process(self):
         name = "%s:%s:%s" % (os.uname()[1],os.getpid(),'basic')
         self.resq.enqueue(Basic,"test1")
@@ -114,6 +171,45 @@ class WorkerTests(PyResTests):
         assert self.redis.get("resque:stat:failed").decode() == str(1)
         assert self.redis.get("resque:stat:failed:%s" % name).decode() == str(1)
 
+    def test_done_working_failed(self):
+        name = "%s:%s:%s" % (os.uname()[1],os.getpid(),'basic')
+        self.resq.enqueue(Basic,"test1")
+        job = Job.reserve('basic', self.resq)
+        worker = Worker(['basic'])
+        worker.working_on(job)
+        worker.done_working(job, failed=True)
+        assert not self.redis.exists("resque:worker:%s" % name)
+        assert worker.get_processed() == 1
+        assert worker.get_failed() == 1
+        assert self.redis.get("resque:stat:failed").decode() == str(1)
+
+    def test_buffered_stats(self):
+        name = "%s:%s:%s" % (os.uname()[1],os.getpid(),'basic')
+        worker = Worker(['basic'], stats_flush_jobs=100)
+        for i in range(3):
+            self.resq.enqueue(Basic,"test1")
+            job = Job.reserve('basic', self.resq)
+            worker.process(job)
+        worker.failed()
+        assert not self.redis.exists("resque:stat:processed")
+        assert worker.get_processed() == 3
+        assert worker.get_failed() == 1
+        worker.flush_stats()
+        assert self.redis.get("resque:stat:processed").decode() == str(3)
+        assert self.redis.get("resque:stat:processed:%s" % name).decode() == str(3)
+        assert self.redis.get("resque:stat:failed").decode() == str(1)
+        assert worker.get_processed() == 3
+
+    def test_buffered_stats_forked(self):
+        worker = Worker(['basic'], stats_flush_jobs=100)
+        for i in range(2):
+            self.resq.enqueue(Basic, "test%d" % i)
+            worker.fork_worker(worker.reserve())
+        assert not self.redis.exists("resque:stat:processed")
+        assert worker.get_processed() == 2
+        worker.flush_stats()
+        assert self.redis.get("resque:stat:processed") == b'2'
+
     def test_get_job(self):
         worker = Worker(['basic'])
         self.resq.enqueue(Basic,"test1")
@@ -212,6 +308,15 @@ class WorkerTests(PyResTests):
         worker.fork_worker(worker.reserve())
         assert worker.get_failed() == 1
 
+    def test_fork_worker_notices_child_exit_immediately(self):
+        worker = Worker(['basic'], timeout=5)
+        self.resq.enqueue(Basic, "test1")
+        job = worker.reserve()
+        start = time.time()
+        worker.fork_worker(job)
+        assert time.time() - start < 0.4
+        assert worker.get_failed() == 0
+
     def test_detect_crashed_workers_as_failures(self):
         worker = Worker(['basic'])
         self.resq.enqueue(CrashJob)
@@ -272,6 +377,48 @@ class WorkerTests(PyResTests):
         assert worker.job() == {}
         assert worker.get_failed() == 0
 
+    def test_persistent_child_is_reused_and_recycled(self):
+        worker = Worker(['basic'], child_max_jobs=2)
+        for i in range(3):
+            self.resq.enqueue(Basic, "test%d" % i)
+
+        worker.fork_worker(worker.reserve())
+        child = worker.child
+        assert child
+        worker.fork_worker(worker.reserve())
+        assert worker.child is None
+        worker.fork_worker(worker.reserve())
+        assert worker.child and worker.child != child
+        worker.stop_child()
+        assert worker.child is None
+        assert worker.get_failed() == 0
+
+    def test_persistent_child_timeout(self):
+        worker = Worker(['basic'], timeout=1, child_max_jobs=5)
+        self.resq.enqueue(TimeoutJob, 2)
+        worker.fork_worker(worker.reserve())
+        assert worker.get_failed() == 1
+        assert worker.child is None
+
+    def test_persistent_child_crash(self):
+        worker = Worker(['basic'], child_max_jobs=5)
+        self.resq.enqueue(CrashJob)
+        worker.fork_worker(worker.reserve())
+        assert worker.get_failed() == 1
+        assert worker.child is None
+
+    def test_persistent_child_exception(self):
+        class BrokenWorker(Worker):
+            def after_fork(self, job):
+                raise ValueError('broken')
+
+        worker = BrokenWorker(['basic'], child_max_jobs=5)
+        self.resq.enqueue(Basic, "test1")
+        worker.fork_worker(worker.reserve())
+        assert worker.get_failed() == 1
+        assert worker.child is None
+        assert worker.job() == {}
+
     def test_retries_give_up_eventually(self):
         now = datetime.datetime.now()
         self.set_current_time(now)